@@ -1,48 +1,69 @@
 import os
 from youtube import video_pred
 from image import image_pred
-from PIL import Image
-import streamlit as st
 import traceback
 import sys
+from isplutils import telemetry
 
 ALLOWED_VIDEO_EXTENSIONS = {'mp4'}
 ALLOWED_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png'}
+# Inference precision, "fp32" or "bf16". bf16 falls back to fp32 on unsupported hardware.
+PRECISION = os.environ.get('DEEPFAKE_PRECISION', 'fp32')
+# Test-time augmentation: "1" to classify flipped and rescaled views of each face, aggregated with DEEPFAKE_TTA_POLICY
+TTA = os.environ.get('DEEPFAKE_TTA', '0') == '1'
+TTA_POLICY = os.environ.get('DEEPFAKE_TTA_POLICY', 'mean')
+# Telemetry: DEEPFAKE_TELEMETRY=1 collects per-stage spans and counters (JSON lines to DEEPFAKE_TELEMETRY_LOG),
+# DEEPFAKE_METRICS_PORT also serves them as Prometheus text on http://<host>:<port>/metrics
+if os.environ.get('DEEPFAKE_METRICS_PORT'):
+    telemetry.serve(int(os.environ['DEEPFAKE_METRICS_PORT']))
+# Profiling: DEEPFAKE_PROFILE=1 profiles every request, profile=True a single one (traces in DEEPFAKE_PROFILE_DIR)
+# Errors: process_image and process_video return (message, -1) when a request fails, or re-raise the exception
+# with raise_errors=True (service.py tells the client errors from the server ones by their type)
 
 
 def allowed_file(filename, accepted_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in accepted_extensions
 
 
-def process_image(image, model, dataset, threshold):
+def process_image(image, model, dataset, threshold, profile=None, raise_errors=False):
 
+    telemetry.count('requests', kind='image')
     try:
-        Image.open(image).convert("RGB").save("uploads/check.jpg", "JPEG")
-        print("hii")
-        output_string, pred = image_pred(
-            image_path='uploads/check.jpg', model=model, dataset=dataset, threshold=threshold)
+        with telemetry.span('api.process_image', model=model, dataset=dataset):
+            # Decoded in memory, no file is written: concurrent requests are independent.
+            # The front-ends display the upload first, which leaves the stream at its end
+            image.seek(0)
+            output_string, pred = image_pred(
+                image=image.read(), image_path=None, model=model, dataset=dataset, threshold=threshold,
+                precision=PRECISION, tta=TTA, tta_policy=TTA_POLICY, profile=profile)
         return output_string,pred
 
     except Exception as e:
+        telemetry.count('request_errors', kind='image')
+        if raise_errors:
+            raise
         return str(e),-1
 
-    finally:
-        # Ensure the temporary video file is deleted
-        # if image_path and os.path.exists(image_path):
-        os.remove("uploads/check.jpg")
 
+def process_video(video_path, model, dataset, threshold, frames, profile=None, raise_errors=False):
 
-def process_video(video_path, model, dataset, threshold, frames):
-
+    telemetry.count('requests', kind='video')
     try:
-        output_string, pred = video_pred(video_path=video_path, model=model,
-                                         dataset=dataset, threshold=threshold, frames=frames)
+        with telemetry.span('api.process_video', model=model, dataset=dataset, frames=frames):
+            output_string, pred = video_pred(video_path=video_path, model=model,
+                                             dataset=dataset, threshold=threshold, frames=frames,
+                                             precision=PRECISION, tta=TTA, tta_policy=TTA_POLICY,
+                                             profile=profile)
 
         return output_string,pred
 
     except Exception as e:
         # Handle any errors during processing
-        return traceback.print_exception(*sys.exc_info()) ,-1
+        telemetry.count('request_errors', kind='video')
+        traceback.print_exception(*sys.exc_info())
+        if raise_errors:
+            raise
+        return str(e),-1
 
     finally:
         # Ensure the temporary video file is deleted
@@ -17,6 +17,7 @@ from torch import nn as nn
 from torch.nn import functional as F
 from torchvision import transforms
 
+from isplutils import telemetry
 from . import externals
 
 """
@@ -33,9 +34,23 @@ class FeatureExtractor(nn.Module):
     def features(self, x: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
 
+    def __call__(self, x: torch.Tensor, *args, **kwargs):
+        if not telemetry.enabled():
+            return super(FeatureExtractor, self).__call__(x, *args, **kwargs)
+        telemetry.count('faces_classified', len(x), net=type(self).__name__)
+        with telemetry.span('fornet.forward', net=type(self).__name__, batch=len(x)):
+            return super(FeatureExtractor, self).__call__(x, *args, **kwargs)
+
     def get_trainable_parameters(self):
         return self.parameters()
 
+    @property
+    def supports_attention(self) -> bool:
+        """
+        Whether forward_with_attention() returns attention maps
+        """
+        return hasattr(self, 'features_with_attention')
+
     @staticmethod
     def get_normalizer():
         return transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
@@ -72,6 +87,15 @@ class EfficientNetB4(EfficientNetGen):
         super(EfficientNetB4, self).__init__(model='efficientnet-b4')
 
 
+class EfficientNetB0(EfficientNetGen):
+    """
+    Small student for distillation from the B4 models (see distill.py), about 3x faster per face on CPU
+    """
+
+    def __init__(self):
+        super(EfficientNetB0, self).__init__(model='efficientnet-b0')
+
+
 """
 EfficientNetAutoAtt
 """
@@ -121,7 +145,15 @@ class EfficientNetAutoAtt(EfficientNet):
 
         return att
 
-    def extract_features(self, x: torch.Tensor) -> torch.Tensor:
+    def extract_features_with_attention(self, x: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+        """
+        Features and attention map from a single pass through the backbone
+        :param x: (N, 3, H, W) input batch
+        :return: (N, C, H', W') features, (N, 1, H'', W'') attention map
+        """
+        # Placeholder
+        att = None
+
         # Stem
         x = self._swish(self._bn0(self._conv_stem(x)))
 
@@ -138,7 +170,10 @@ class EfficientNetAutoAtt(EfficientNet):
         # Head
         x = self._swish(self._bn1(self._conv_head(x)))
 
-        return x
+        return x, att
+
+    def extract_features(self, x: torch.Tensor) -> torch.Tensor:
+        return self.extract_features_with_attention(x)[0]
 
 
 class EfficientNetGenAutoAtt(FeatureExtractor):
@@ -162,6 +197,25 @@ class EfficientNetGenAutoAtt(FeatureExtractor):
         x = self.classifier(x)
         return x
 
+    def features_with_attention(self, x: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+        x, att = self.efficientnet.extract_features_with_attention(x)
+        x = self.efficientnet._avg_pooling(x)
+        x = x.flatten(start_dim=1)
+        return x, att
+
+    def forward_with_attention(self, x: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+        """
+        Scores and attention maps in a single forward pass, instead of forward() followed by get_attention()
+        :param x: (N, 3, H, W) input batch
+        :return: (N, 1) logits, (N, 1, H'', W'') attention maps
+        """
+        telemetry.count('faces_classified', len(x), net=type(self).__name__)
+        with telemetry.span('fornet.forward_with_attention', net=type(self).__name__, batch=len(x)):
+            x, att = self.features_with_attention(x)
+            x = self.efficientnet._dropout(x)
+            x = self.classifier(x)
+        return x, att
+
     def get_attention(self, x: torch.Tensor) -> torch.Tensor:
         return self.efficientnet.get_attention(x)
 
@@ -214,6 +268,10 @@ class SiameseTuning(FeatureExtractor):
         x = self.feat_ext.features(x)
         return x
 
+    @property
+    def supports_attention(self) -> bool:
+        return hasattr(self.feat_ext, 'features_with_attention')
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         if self.lastonly:
             with torch.no_grad():
@@ -223,6 +281,24 @@ class SiameseTuning(FeatureExtractor):
         x = self.classifier(x)
         return x
 
+    def forward_with_attention(self, x: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+        """
+        Scores and attention maps in a single forward pass, for feature extractors with attention
+        :param x: (N, 3, H, W) input batch
+        :return: (N, 1) logits, (N, 1, H'', W'') attention maps
+        """
+        if not hasattr(self.feat_ext, 'features_with_attention'):
+            raise NotImplementedError('The feature extractor does not provide attention maps')
+        telemetry.count('faces_classified', len(x), net=type(self).__name__)
+        with telemetry.span('fornet.forward_with_attention', net=type(self).__name__, batch=len(x)):
+            if self.lastonly:
+                with torch.no_grad():
+                    x, att = self.feat_ext.features_with_attention(x)
+            else:
+                x, att = self.feat_ext.features_with_attention(x)
+            x = self.classifier(x)
+        return x, att
+
     def get_trainable_parameters(self):
         if self.lastonly:
             return self.classifier.parameters()
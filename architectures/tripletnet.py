@@ -9,6 +9,8 @@ Sara Mandelli
 Luca Bondi
 Paolo Bestagini
 """
+import torch
+
 from . import fornet
 from .fornet import FeatureExtractor
 
@@ -28,10 +30,9 @@ class TripletNet(FeatureExtractor):
         return self.feat_ext.features(x)
 
     def forward(self, x1, x2, x3):
-        x1 = self.features(x1)
-        x2 = self.features(x2)
-        x3 = self.features(x3)
-        return x1, x2, x3
+        # Anchors, positives and negatives go through the feature extractor as a single batch
+        x = self.features(torch.cat((x1, x2, x3)))
+        return torch.split(x, [len(x1), len(x2), len(x3)])
 
 
 class EfficientNetB4(TripletNet):
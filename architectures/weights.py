@@ -9,6 +9,13 @@ Sara Mandelli
 Luca Bondi
 Paolo Bestagini
 """
+import json
+import os
+
+import torch
+from torch.utils.model_zoo import load_url
+
+from isplutils import telemetry
 
 weight_url = {
 'EfficientNetAutoAttB4ST_DFDC':'https://f002.backblazeb2.com/file/icpr2020/EfficientNetAutoAttB4ST_DFDC_bestval-4df0ef7d2f380a5955affa78c35d0942ac1cd65229510353b252737775515a33.pth',
@@ -21,4 +28,61 @@ weight_url = {
 'EfficientNetB4_FFPP':'https://f002.backblazeb2.com/file/icpr2020/EfficientNetB4_FFPP_bestval-93aaad84946829e793d1a67ed7e0309b535e2f2395acb4f8d16b92c0616ba8d7.pth',
 'Xception_DFDC':'https://f002.backblazeb2.com/file/icpr2020/Xception_DFDC_bestval-e826cdb64d73ef491e6b8ff8fce0e1e1b7fc1d8e2715bc51a56280fff17596f9.pth',
 'Xception_FFPP':'https://f002.backblazeb2.com/file/icpr2020/Xception_FFPP_bestval-bb119e4913cb8f816cd28a03f81f4c603d6351bf8e3f8e3eb99eebc923aecd22.pth',
-}
\ No newline at end of file
+}
+
+# Registry of locally trained weights (e.g. distilled students), JSON mapping keys to paths or URLs
+registry_path = os.environ.get('DEEPFAKE_WEIGHTS_REGISTRY', os.path.join('weights', 'registry.json'))
+
+
+def load_registry(path: str = registry_path):
+    """
+    Add the entries of a JSON registry to weight_url. Relative paths are relative to the registry file
+    :param path: registry file
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    for key, location in entries.items():
+        if '://' not in location and not os.path.isabs(location):
+            location = os.path.join(os.path.dirname(os.path.abspath(path)), location)
+        weight_url[key] = location
+
+
+def register(key: str, location: str, path: str = registry_path):
+    """
+    Add weights to weight_url and to a JSON registry, so that they can be selected by key in later runs
+    :param key: '<model>_<dataset>', as the released weights
+    :param location: path or URL of the state dict
+    :param path: registry file
+    """
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            entries = json.load(f)
+    entries[key] = os.path.relpath(os.path.abspath(location), os.path.dirname(os.path.abspath(path))) \
+        if '://' not in location else location
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(entries, f, indent=2, sort_keys=True)
+    load_registry(path)
+
+
+def load_state_dict(key: str, map_location=None) -> dict:
+    """
+    State dict of registered weights, downloaded (and hash-checked) for URLs or read from disk for local paths
+    :param key: '<model>_<dataset>', e.g. 'EfficientNetAutoAttB4_DFDC'
+    :param map_location:
+    :return:
+    """
+    location = weight_url[key]
+    with telemetry.span('weights.load', key=key):
+        if '://' in location:
+            if telemetry.enabled():
+                cached = os.path.exists(os.path.join(torch.hub.get_dir(), 'checkpoints',
+                                                     os.path.basename(location.split('?')[0])))
+                telemetry.count('cache_hits' if cached else 'cache_misses', cache='weights')
+            return load_url(location, map_location=map_location, check_hash=True)
+        return torch.load(location, map_location=map_location)
+
+
+if os.path.exists(registry_path):
+    load_registry(registry_path)
@@ -0,0 +1,49 @@
+"""
+Compare the score plus attention map cost of EfficientNetAutoAtt: extract_features followed by get_attention, as in
+the explanation notebooks, against the single pass of extract_features_with_attention.
+
+The backbone is built without pretrained weights, timings and outputs do not depend on them.
+
+Example:
+    python benchmarks/attention.py --batch 8 --iters 5
+"""
+import argparse
+import time
+
+import torch
+
+import common  # noqa: F401, puts the repository root on sys.path
+
+from architectures.fornet import EfficientNetAutoAtt
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    net = EfficientNetAutoAtt.from_name('efficientnet-b4')
+    net.init_att('efficientnet-b4', 0)
+    net.eval()
+    x = torch.randn(args.batch, 3, args.size, args.size)
+
+    with torch.no_grad():
+        features, att = net.extract_features(x), net.get_attention(x)
+        fused_features, fused_att = net.extract_features_with_attention(x)
+        print('Max abs difference: features {:.2e} attention {:.2e}'.format(
+            (features - fused_features).abs().max().item(), (att - fused_att).abs().max().item()))
+        for name, run in [('features + get_attention', lambda: (net.extract_features(x), net.get_attention(x))),
+                          ('features only', lambda: net.extract_features(x)),
+                          ('fused', lambda: net.extract_features_with_attention(x))]:
+            t0 = time.perf_counter()
+            for _ in range(args.iters):
+                run()
+            print('{:24s} {:8.1f} ms/face'.format(name, 1e3 * (time.perf_counter() - t0) / args.iters / args.batch))
+
+
+if __name__ == '__main__':
+    main()
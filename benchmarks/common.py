@@ -0,0 +1,257 @@
+"""
+Synthetic data shared by the benchmarks, and the reference results of the original FaceExtractor.
+
+Importing this module puts the repository root on sys.path, so that the benchmarks, run as
+python benchmarks/<name>.py, can import the packages of the repository.
+"""
+import sys
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from blazeface import FaceExtractor
+from isplutils.face_store import FaceStore
+
+
+def record_names(num_records: int, frames_per_video: int = 32) -> list:
+    """
+    Record names of the faces DataFrames, one subject per frame
+    """
+    return ['video{:05d}/fr{:03d}_subj0.jpg'.format(idx // frames_per_video, idx % frames_per_video)
+            for idx in range(num_records)]
+
+
+def make_face_store(root: Path, num_records: int, size: int, seed: int, fake_ratio: float = 0.2,
+                    face_fn: Callable[[np.random.Generator, bool], np.ndarray] = None) -> (pd.DataFrame, FaceStore):
+    """
+    FaceStore filled with synthetic faces, and its faces DataFrame
+    :param root: folder of the store
+    :param num_records:
+    :param size: face size
+    :param seed:
+    :param fake_ratio: fraction of the records labelled fake
+    :param face_fn: face of a record from the random generator and the label, random pixels if not set
+    :return: the DataFrame and the store, open for reading
+    """
+    rng = np.random.default_rng(seed)
+    names = record_names(num_records)
+    labels = rng.random(num_records) < fake_ratio
+    df = pd.DataFrame({'video': np.arange(num_records) // 32, 'frame': np.arange(num_records) % 32,
+                       'left': 10, 'top': 10, 'right': 10 + size, 'bottom': 10 + size, 'label': labels},
+                      index=names)
+    store = FaceStore.create(root, names, size)
+    for slot, label in enumerate(labels):
+        if face_fn is not None:
+            store.put(slot, face_fn(rng, label))
+        else:
+            store.put(slot, rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8))
+    store.flush()
+    return df, FaceStore(root)
+
+
+def _save_frame(rng: np.random.Generator, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    frame = rng.integers(0, 256, size=(108, 192, 3), dtype=np.uint8)
+    Image.fromarray(frame).resize((1920, 1080), Image.BILINEAR).save(path, quality=95)
+
+
+def _random_box(rng: np.random.Generator, min_side: int, max_side: int) -> dict:
+    side = int(rng.integers(min_side, max_side))
+    top, left = int(rng.integers(0, 1080 - side)), int(rng.integers(0, 1920 - side))
+    return {'left': left, 'top': top, 'right': left + side, 'bottom': top + side}
+
+
+def make_faces(root: Path, num: int, seed: int) -> pd.DataFrame:
+    """
+    Synthetic 1080p frames with one face box each, written to a faces folder
+    :return: the faces DataFrame, indexed by the frame paths
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    for idx in range(num):
+        name = 'video{:03d}/fr{:03d}_subj0.jpg'.format(idx // 10, idx % 10)
+        _save_frame(rng, root.joinpath(name))
+        records.append(dict(name=name, **_random_box(rng, 100, 400), label=bool(idx % 2)))
+    return pd.DataFrame(records).set_index('name')
+
+
+def make_frames(root: Path, num_frames: int, faces_per_frame: int, seed: int) -> pd.DataFrame:
+    """
+    Synthetic 1080p frames with several face boxes each, written to a faces folder
+    :return: the faces DataFrame, with the path of the frame of each face
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    for frame_idx in range(num_frames):
+        path = 'video{:03d}/fr{:03d}.jpg'.format(frame_idx // 10, frame_idx % 10)
+        _save_frame(rng, root.joinpath(path))
+        for subject in range(faces_per_frame):
+            records.append(dict(name=path.replace('.jpg', '_subj{:d}.jpg'.format(subject)), path=path,
+                                video=frame_idx // 10, frame=frame_idx % 10, **_random_box(rng, 150, 600),
+                                label=bool(frame_idx % 2)))
+    return pd.DataFrame(records).set_index('name')
+
+
+def make_faces_df(dataset: str, num_videos: int, seed: int) -> pd.DataFrame:
+    """
+    Faces DataFrame with the columns of the DFDC ('dfdc') or FF++ ('ffpp') one, 32 frames per video
+    """
+    rng = np.random.default_rng(seed)
+    frames = 32
+    videos = np.repeat(['{:s}{:06d}.mp4'.format(dataset, idx) for idx in range(num_videos)], frames)
+    num = len(videos)
+    df = pd.DataFrame({
+        'video': videos,
+        'label': np.repeat(rng.random(num_videos) < 0.8, frames),
+        'original': np.repeat(['{:s}{:06d}.mp4'.format(dataset, idx) for idx in
+                               rng.integers(0, num_videos, num_videos)], frames),
+        'frame': np.tile(np.arange(frames) * 10, num_videos),
+        'subject': 0,
+        'height': 1080, 'width': 1920,
+        'left': rng.integers(0, 1500, num), 'top': rng.integers(0, 700, num),
+    })
+    df['right'] = df['left'] + 300
+    df['bottom'] = df['top'] + 300
+    for kp in range(1, 7):
+        df['kp{:d}x'.format(kp)] = rng.random(num) * 1920
+        df['kp{:d}y'.format(kp)] = rng.random(num) * 1080
+    if dataset == 'dfdc':
+        df['folder'] = np.repeat(rng.integers(0, 50, num_videos), frames)
+    else:
+        df['source'] = np.repeat(rng.choice(['youtube', 'Deepfakes', 'Face2Face', 'FaceSwap', 'NeuralTextures'],
+                                            num_videos), frames)
+        df['quality'] = 'c23'
+    df.index = ['{}/fr{:03d}_subj0.png'.format(video, frame) for video, frame in zip(df['video'], df['frame'])]
+    return df
+
+
+def make_ffpp_df(num_frames: int, seed: int) -> pd.DataFrame:
+    """
+    FF++ faces DataFrame with the split columns only: 1000 youtube videos and their 4 manipulations, rows shuffled
+    """
+    rng = np.random.default_rng(seed)
+    records = []
+    originals = ['{:03d}'.format(idx) for idx in rng.permutation(1000)]
+    for source in ['youtube', 'Deepfakes', 'Face2Face', 'FaceSwap', 'NeuralTextures']:
+        for original in originals:
+            video = original if source == 'youtube' else '{}_{}'.format(original, source)
+            records.append(pd.DataFrame({
+                'video': video, 'original': np.nan if source == 'youtube' else original, 'source': source,
+                'quality': 'c23', 'label': source != 'youtube', 'frame': np.arange(num_frames)}))
+    df = pd.concat(records, ignore_index=True)
+    df.index = ['{}/fr{:03d}_subj0.png'.format(video, frame) for video, frame in zip(df['video'], df['frame'])]
+    # Shuffle the rows, as faces of different videos are interleaved in the real DataFrame
+    return df.iloc[rng.permutation(len(df))]
+
+
+def random_detections(num_frames: int, num_faces: int, height: int, width: int, seed: int) -> list:
+    """
+    BlazeFace-like detections: per frame a (num_faces, 17) tensor of boxes, keypoints and scores
+    """
+    rng = np.random.default_rng(seed)
+    detections = []
+    for _ in range(num_frames):
+        det = np.zeros((num_faces, 17), dtype=np.float32)
+        size = rng.uniform(60, 300, size=num_faces)
+        det[:, 0] = rng.uniform(0, height - size)
+        det[:, 1] = rng.uniform(0, width - size)
+        det[:, 2] = det[:, 0] + size
+        det[:, 3] = det[:, 1] + size
+        for k in range(6):
+            det[:, 4 + 2 * k] = det[:, 1] + rng.uniform(0.2, 0.8, size=num_faces) * size
+            det[:, 5 + 2 * k] = det[:, 0] + rng.uniform(0.2, 0.8, size=num_faces) * size
+        det[:, 16] = rng.uniform(0.75, 1, size=num_faces)
+        detections.append(torch.from_numpy(det))
+    return detections
+
+
+class StubDetector:
+    """
+    Stands in for BlazeFace in a FaceExtractor: nothing is found in the tiles, nms returns the given detections
+    """
+    input_size = (128, 128)
+
+    def __init__(self, detections: list):
+        self.detections = detections
+
+    def predict_on_batch(self, tiles: np.ndarray, apply_nms: bool = False) -> list:
+        return [torch.zeros((0, 17)) for _ in tiles]
+
+    def nms(self, detections: list) -> list:
+        return self.detections[:len(detections)]
+
+
+def dict_results(extractor: FaceExtractor, frames: np.ndarray, detections: list, frame_size: tuple) -> list:
+    """
+    Per-frame dictionaries built as the original FaceExtractor did, crops as views of the frames
+    :param extractor:
+    :param frames: (num_frames, H, W, 3) array
+    :param detections: per frame a (num_faces, 17) tensor, as returned by BlazeFace.nms
+    :param frame_size: (width, height)
+    """
+    results = []
+    for i, (frame, det) in enumerate(zip(frames, detections)):
+        frameref_detections = extractor._add_margin_to_detections(det, frame_size, 0.2).numpy()
+        raw_detections = det.numpy()
+        sort_idxs = np.argsort(raw_detections[:, 16])[::-1]
+        results.append({'video_idx': 0,
+                        'frame_idx': i,
+                        'frame_w': frame_size[0],
+                        'frame_h': frame_size[1],
+                        'frame': frame,
+                        'faces': extractor._crop_faces(frame, frameref_detections[sort_idxs]),
+                        'kpts': extractor._crop_kpts(frame, raw_detections[sort_idxs], 0.3),
+                        'detections': frameref_detections[sort_idxs],
+                        'scores': list(raw_detections[sort_idxs, 16])})
+    return results
+
+
+def max_abs_diff(results, references: list) -> float:
+    """
+    Largest difference of faces, keypoint crops, detections and scores between FaceExtractor results and the
+    dict_results of the same detections, inf if the number of frames, faces or the crop shapes differ
+    """
+    if len(results) != len(references):
+        return np.inf
+    diff = 0.
+    for result, reference in zip(results, references):
+        crops = [(a, b) for key in ['faces', 'detections'] for a, b in [(list(result[key]), list(reference[key]))]]
+        crops.append(([kpt for kpts in result['kpts'] for kpt in kpts],
+                      [kpt for kpts in reference['kpts'] for kpt in kpts]))
+        crops.append((result['scores'], reference['scores']))
+        for values, ref_values in crops:
+            if len(values) != len(ref_values):
+                return np.inf
+            for value, ref_value in zip(values, ref_values):
+                value, ref_value = np.asarray(value, dtype=np.float64), np.asarray(ref_value, dtype=np.float64)
+                if value.shape != ref_value.shape:
+                    return np.inf
+                if value.size:
+                    diff = max(diff, float(np.abs(value - ref_value).max()))
+    return diff
+
+
+def check_extractor(num_frames: int, num_faces: int, height: int, width: int, seed: int) -> (float, float):
+    """
+    Compare FaceExtractor.process_video and process_image with the original per-frame dictionaries, on random
+    frames and detections
+    :return: max_abs_diff of process_video and of process_image
+    """
+    frames = np.random.default_rng(seed).integers(0, 256, size=(num_frames, height, width, 3), dtype=np.uint8)
+    detections = random_detections(num_frames, num_faces, height, width, seed)
+    extractor = FaceExtractor(video_read_fn=lambda path: (frames, list(range(num_frames))),
+                              facedet=StubDetector(detections))
+    references = dict_results(extractor, frames, detections, (width, height))
+    video_diff = max_abs_diff(extractor.process_video('video.mp4'), references)
+    image_diff = 0.
+    for frame, det, reference in zip(frames, detections, references):
+        image = FaceExtractor(facedet=StubDetector([det])).process_image(img=frame)
+        image_diff = max(image_diff, max_abs_diff([image], [reference]))
+    return video_diff, image_diff
@@ -0,0 +1,67 @@
+"""
+Measure the per-sample overhead of FrameFaceIterableDataset and FrameFaceDatasetTest.
+
+Faces are served from a FaceStore filled with random small faces, so that decoding does not hide the cost of
+the datasets themselves. Two DataFrames are used, as when training on several datasets. The script reports the
+time per sample when iterating the datasets directly and the DataLoader throughput.
+
+Example:
+    python benchmarks/dataset_overhead.py --records 20000 --workers 0 2
+"""
+import argparse
+import tempfile
+import time
+from itertools import islice
+from pathlib import Path
+
+from albumentations.pytorch import ToTensorV2
+from torch.utils.data import DataLoader
+
+from common import make_face_store
+
+from isplutils.data import FrameFaceIterableDataset, FrameFaceDatasetTest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=20000, help='Records in each of the two DataFrames')
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=32)
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stores, dfs = [], []
+        for idx in range(2):
+            df, store = make_face_store(Path(tmp).joinpath(str(idx)), args.records, args.size, args.seed + idx)
+            dfs.append(df)
+            stores.append(store)
+
+        train = FrameFaceIterableDataset(roots=[tmp, tmp], dfs=dfs, size=args.size, scale='scale',
+                                         num_samples=args.samples, transformer=ToTensorV2(), seed=args.seed,
+                                         face_stores=stores)
+        test = FrameFaceDatasetTest(root=tmp, df=dfs[0], size=args.size, scale='scale', transformer=ToTensorV2(),
+                                    face_store=stores[0])
+
+        t0 = time.perf_counter()
+        num = sum(1 for _ in islice(iter(train), args.samples))
+        print('FrameFaceIterableDataset {:8.1f} us/sample'.format(1e6 * (time.perf_counter() - t0) / num))
+        t0 = time.perf_counter()
+        num = min(args.samples, len(test))
+        for item in range(num):
+            test[item]
+        print('FrameFaceDatasetTest     {:8.1f} us/sample'.format(1e6 * (time.perf_counter() - t0) / num))
+
+        for workers in args.workers:
+            for name, dataset in [('FrameFaceIterableDataset', train), ('FrameFaceDatasetTest', test)]:
+                loader = DataLoader(dataset, batch_size=args.batch, num_workers=workers)
+                t0 = time.perf_counter()
+                num = sum(len(batch[0]) for batch in loader)
+                print('{:24s} {:8.1f} samples/s DataLoader with {:d} workers'.format(
+                    name, num / (time.perf_counter() - t0), workers))
+
+
+if __name__ == '__main__':
+    main()
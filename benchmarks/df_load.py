@@ -0,0 +1,86 @@
+"""
+Report load time and resident memory of the faces DataFrames as pickle, Parquet and Arrow IPC.
+
+Pickles given with --dfdc / --ffpp are converted to a temporary folder, otherwise synthetic tables with the columns
+of the DFDC and FF++ faces DataFrames are generated. Each load runs in a fresh process, which reports the wall time
+of read_df and the growth of its resident and peak resident memory (Linux only), with all the columns and with the
+columns used for training only. Pages of memory-mapped Arrow files become resident as they are accessed.
+
+Example:
+    python benchmarks/df_load.py --dfdc dfdc_faces.pkl --ffpp ffpp_faces.pkl
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+from common import ROOT, make_faces_df
+
+from convert_faces_df import categorical_columns
+from isplutils.split import write_df
+
+training_columns = ['video', 'label', 'original', 'frame', 'left', 'top', 'right', 'bottom']
+
+_load_script = '''
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+from isplutils.split import read_df
+import pyarrow, pyarrow.ipc, pyarrow.parquet
+
+
+def memory():
+    with open('/proc/self/status') as f:
+        status = dict(line.split(':', 1) for line in f)
+    return {key: int(status[key].split()[0]) for key in ['VmRSS', 'VmHWM']}
+
+
+columns = json.loads(sys.argv[3])
+mem0 = memory()
+t0 = time.perf_counter()
+df = read_df(sys.argv[2], columns=columns)
+elapsed = time.perf_counter() - t0
+mem1 = memory()
+print(json.dumps({'time': elapsed, 'rss': mem1['VmRSS'] - mem0['VmRSS'], 'peak': mem1['VmHWM'] - mem0['VmHWM']}))
+'''
+
+
+def measure(path: Path, columns: list) -> dict:
+    out = subprocess.run([sys.executable, '-c', _load_script, str(ROOT), str(path),
+                          json.dumps(columns)], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dfdc', type=str, help='Pickled DFDC faces DataFrame')
+    parser.add_argument('--ffpp', type=str, help='Pickled FF++ faces DataFrame')
+    parser.add_argument('--videos', type=int, default=20000, help='Videos of the synthetic tables')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for dataset, path in [('dfdc', args.dfdc), ('ffpp', args.ffpp)]:
+            df = pd.read_pickle(path) if path else make_faces_df(dataset, args.videos, args.seed)
+            pickle_path = Path(tmp).joinpath(dataset + '.pkl')
+            df.to_pickle(pickle_path)
+            categorical = categorical_columns(df, 0.5)
+            paths = {'pickle': pickle_path}
+            for ext in ['parquet', 'arrow']:
+                paths[ext] = Path(tmp).joinpath('{}.{}'.format(dataset, ext))
+                write_df(df, paths[ext], categorical=categorical)
+            columns = [col for col in training_columns if col in df.columns]
+            print('{:s}: {:d} records, categorical: {}'.format(dataset, len(df), ', '.join(categorical)))
+            for name, file_path in paths.items():
+                for projection, cols in [('all columns', None), ('training columns', columns)]:
+                    result = measure(file_path, cols)
+                    print('  {:8s} {:17s} {:8.1f} MiB on disk {:8.3f} s RSS {:8.1f} MiB peak {:8.1f} MiB'.format(
+                        name, projection, file_path.stat().st_size / 2 ** 20, result['time'], result['rss'] / 1024,
+                        result['peak'] / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Measure the per-frame cost of building the FaceExtractor results with eager and lazy crops.
+
+Synthetic detections are generated for a batch of frames. The eager path cuts every face and
+keypoint crop like the original FaceExtractor did, the lazy path packs them into a
+FaceExtractionResult and only accesses the best face, as image_pred and video_pred do.
+Time and Python allocations (tracemalloc) per frame are reported for both. The crops, detections and scores of
+FaceExtractor.process_video and process_image are checked against the eager ones on random frames.
+
+Example:
+    python benchmarks/face_crops.py --frames 100 --faces 4
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from common import check_extractor, random_detections
+
+from blazeface import FaceExtractor, FaceExtractionResult
+
+
+def eager(extractor: FaceExtractor, frames: np.ndarray, detections: list, frame_size: tuple) -> list:
+    results = []
+    for frame, det in zip(frames, detections):
+        frameref_detections = extractor._add_margin_to_detections(det, frame_size, 0.2)
+        faces = extractor._crop_faces(frame, frameref_detections)
+        kpts = extractor._crop_kpts(frame, det, 0.3)
+        scores = list(det[:, 16].cpu().numpy())
+        sort_idxs = np.argsort(scores)[::-1]
+        results.append(([faces[i] for i in sort_idxs], [kpts[i] for i in sort_idxs],
+                        frameref_detections.cpu().numpy()[sort_idxs], [scores[i] for i in sort_idxs]))
+    return [result[0][0] for result in results]
+
+
+def lazy(extractor: FaceExtractor, frames: np.ndarray, detections: list, frame_size: tuple) -> list:
+    counts, frameref_detections, kpt_boxes = extractor._pack_detections(detections, frame_size)
+    results = FaceExtractionResult(buffers=[frames], video_idxs=[0], frame_idxs=[range(len(frames))],
+                                   counts=[counts], detections=[frameref_detections], kpt_boxes=[kpt_boxes])
+    return [result['faces'][0] for result in results]
+
+
+def measure(fn, *args, repeats: int) -> (float, int):
+    fn(*args)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        fn(*args)
+    elapsed = (time.perf_counter() - t0) / repeats
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--faces', type=int, default=2, help='Detections per frame')
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    frames = np.zeros((args.frames, args.height, args.width, 3), dtype=np.uint8)
+    detections = random_detections(args.frames, args.faces, args.height, args.width, args.seed)
+    extractor = FaceExtractor()
+    frame_size = (args.width, args.height)
+
+    for name, fn in [('eager', eager), ('lazy', lazy)]:
+        elapsed, peak = measure(fn, extractor, frames, detections, frame_size, repeats=args.repeats)
+        print('{:6s} {:8.1f} us/frame {:8.1f} KiB/frame peak allocations'.format(
+            name, 1e6 * elapsed / args.frames, peak / 1024 / args.frames))
+
+    video_diff, image_diff = check_extractor(min(args.frames, 8), args.faces, args.height, args.width, args.seed)
+    print('Max abs difference (process_video): {:.4f}'.format(video_diff))
+    print('Max abs difference (process_image): {:.4f}'.format(image_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Measure the memory held by the FaceExtractor results of one video, excluding the frame pixels.
+
+Synthetic detections are generated for the frames of a video. The dict path builds one dictionary
+per frame with the same content the original FaceExtractor returned (crops as views of the frame,
+detections, scores), the columnar path packs them into a FaceExtractionResult. The frame buffer is
+allocated before tracing starts, so only the per-frame metadata are counted. The faces, keypoint crops, detections
+and scores of FaceExtractor.process_video and process_image are checked against the dictionaries on random frames.
+
+Example:
+    python benchmarks/face_results.py --frames 100 --faces 2
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from common import check_extractor, dict_results, random_detections
+
+from blazeface import FaceExtractor, FaceExtractionResult
+
+
+def columnar(extractor: FaceExtractor, frames: np.ndarray, detections: list, frame_size: tuple) -> FaceExtractionResult:
+    counts, frameref_detections, kpt_boxes = extractor._pack_detections(detections, frame_size)
+    return FaceExtractionResult(buffers=[frames], video_idxs=[0], frame_idxs=[range(len(frames))], counts=[counts],
+                                detections=[frameref_detections], kpt_boxes=[kpt_boxes])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--faces', type=int, default=2, help='Detections per frame')
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    frames = np.zeros((args.frames, args.height, args.width, 3), dtype=np.uint8)
+    detections = random_detections(args.frames, args.faces, args.height, args.width, args.seed)
+    extractor = FaceExtractor()
+    frame_size = (args.width, args.height)
+
+    for name, fn in [('dicts', dict_results), ('columnar', columnar)]:
+        fn(extractor, frames, detections, frame_size)
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        result = fn(extractor, frames, detections, frame_size)
+        elapsed = time.perf_counter() - t0
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        print('{:8s} {:8.1f} KiB/video retained {:8.2f} ms/video'.format(name, retained / 1024, 1000 * elapsed))
+
+    video_diff, image_diff = check_extractor(min(args.frames, 8), args.faces, args.height, args.width, args.seed)
+    print('Max abs difference (process_video): {:.4f}'.format(video_diff))
+    print('Max abs difference (process_image): {:.4f}'.format(image_diff))
+
+
+if __name__ == '__main__':
+    main()
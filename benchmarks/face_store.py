@@ -0,0 +1,58 @@
+"""
+Compare the samples per second of FrameFaceDatasetTest reading faces from the JPEG autocache and from a FaceStore.
+
+Synthetic 1080p frames with one face box each are written to a temporary faces folder. The autocache is filled
+by a first pass of load_face, the store by build_face_store.build, then both are read in the same random order.
+Only ToTensorV2 is applied, so the timings are dominated by face loading.
+
+Example:
+    python benchmarks/face_store.py --faces 2000 --size 224
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from common import make_faces
+
+from build_face_store import build
+from isplutils.data import FrameFaceDatasetTest
+from isplutils.face_store import FaceStore, face_store_path
+
+
+def samples_per_second(dataset: FrameFaceDatasetTest, order: np.ndarray) -> float:
+    t0 = time.perf_counter()
+    for item in order:
+        dataset[item]
+    return len(order) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--faces', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        df = make_faces(root, args.faces, args.seed)
+        order = np.random.default_rng(args.seed).permutation(len(df))
+
+        jpeg = FrameFaceDatasetTest(root=tmp, df=df, size=args.size, scale='scale')
+        for item in range(len(jpeg)):
+            jpeg[item]
+
+        store = FaceStore.create(face_store_path(tmp, 'scale', args.size), df.index, args.size)
+        build({('scale', args.size): store}, df, tmp)
+        packed = FrameFaceDatasetTest(root=tmp, df=df, size=args.size, scale='scale',
+                                      face_store=FaceStore(store.path))
+
+        print('JPEG autocache {:10.1f} samples/s'.format(samples_per_second(jpeg, order)))
+        print('FaceStore      {:10.1f} samples/s'.format(samples_per_second(packed, order)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Compare per-face loading with frame-grouped batched loading in FrameFaceDatasetTest.
+
+Synthetic 1080p JPEG frames with several faces each are written to a temporary faces folder; the records of the
+same frame share it through the 'path' column. Per-face loading calls dataset[i] for every face of a batch and
+starts from an empty autocache, batched loading goes through __getitems__ with batches from
+FrameGroupedBatchSampler, with and without reduced-size JPEG decoding.
+
+Example:
+    python benchmarks/frame_loading.py --frames 100 --faces_per_frame 4 --size 224
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from albumentations.pytorch import ToTensorV2
+
+from common import make_frames
+
+from isplutils.data import FrameFaceDatasetTest, FrameGroupedBatchSampler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--faces_per_frame', type=int, default=4)
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        df = make_frames(Path(tmp), args.frames, args.faces_per_frame, args.seed)
+        batches = list(FrameGroupedBatchSampler(df, args.batch, shuffle=True, seed=args.seed))
+
+        exact = FrameFaceDatasetTest(root=tmp, df=df, size=args.size, scale='scale', transformer=ToTensorV2(),
+                                     draft=False)
+        draft = FrameFaceDatasetTest(root=tmp, df=df, size=args.size, scale='scale', transformer=ToTensorV2(),
+                                     draft=True)
+
+        timings = {}
+        t0 = time.perf_counter()
+        reference = [[exact[item] for item in batch] for batch in batches]
+        timings['per face'] = time.perf_counter() - t0
+        for name, dataset in [('grouped', exact), ('grouped+draft', draft)]:
+            shutil.rmtree(Path(tmp).joinpath('autocache'), ignore_errors=True)
+            t0 = time.perf_counter()
+            outputs = [dataset.__getitems__(batch) for batch in batches]
+            timings[name] = time.perf_counter() - t0
+            diff = max((a[0].int() - b[0].int()).abs().max().item()
+                       for ref, out in zip(reference, outputs) for a, b in zip(ref, out))
+            print('{:14s} max abs difference from per-face loading: {:d}'.format(name, diff))
+
+        for name, elapsed in timings.items():
+            print('{:14s} {:8.1f} samples/s'.format(name, len(df) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
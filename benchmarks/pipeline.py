@@ -0,0 +1,264 @@
+"""
+Stage-level benchmark of the whole detection pipeline, on synthetic videos.
+
+Videos with two rendered faces moving across a textured background are written with cv2.VideoWriter at each
+requested resolution. For every (resolution, frame count) the stages are timed independently, each on the output
+of the previous one:
+
+    read_frames       VideoReader.read_frames
+    tile_frames       FaceExtractor._tile_frames
+    detect            BlazeFace.predict_on_batch, without NMS
+    untile            FaceExtractor._resize_detections and _untile_detections
+    nms               BlazeFace.nms
+    crop              FaceExtractor._crop_faces, on the boxes of the rendered faces
+    preprocess        utils.get_transformer, one face at a time
+    preprocess_batch  utils.FaceBatchTransformer.from_frames
+    forward           classifier forward on one face per frame
+    aggregate         utils.aggregate, every policy
+
+Crop and later stages use the boxes of the rendered faces, so their workload does not depend on the detector.
+Each stage is repeated and its median time is written to a JSON report. With --baseline, the medians are compared
+with a previous report and the script exits with status 1 if a stage is slower than allowed by --threshold
+(relative, overridden per stage with --stage_threshold) and by more than --min_ms. A stage that cannot run
+(e.g. missing weights) is reported with its error, the stages that need its output are reported as skipped, and
+both are left out of the comparison.
+
+Example:
+    python benchmarks/pipeline.py --resolutions 480p 1080p 4k --frames 8 32 --output bench.json
+    python benchmarks/pipeline.py --baseline bench.json --threshold 0.2 --stage_threshold forward=0.1
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import cv2
+import numpy as np
+import torch
+
+import common  # noqa: F401, puts the repository root on sys.path
+
+from architectures import fornet, weights
+from blazeface import BlazeFace, FaceExtractor, VideoReader
+from isplutils import utils
+
+resolutions = {
+    '480p': (854, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+
+aggregate_policies = ['mean', 'sigmean', 'meanp', 'median', 'sigmedian', 'maxabs', 'avgvoting', 'voting']
+
+
+def face_boxes(frame_idx: int, num_frames: int, width: int, height: int) -> np.ndarray:
+    """
+    Boxes of the rendered faces in a frame
+    :return: (2, 4) array (ymin, xmin, ymax, xmax)
+    """
+    boxes = []
+    for face, (rel_size, rel_y) in enumerate([(0.35, 0.2), (0.2, 0.55)]):
+        side = int(rel_size * height)
+        progress = frame_idx / max(num_frames - 1, 1)
+        x = int((0.1 + 0.6 * (progress if face == 0 else 1 - progress)) * (width - side))
+        y = int(rel_y * height)
+        boxes.append((y, x, y + side, x + side))
+    return np.array(boxes, dtype=np.float32)
+
+
+def write_video(path: str, width: int, height: int, num_frames: int, seed: int):
+    rng = np.random.default_rng(seed)
+    background = cv2.resize(rng.integers(60, 200, size=(height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8),
+                            (width, height), interpolation=cv2.INTER_CUBIC)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 25, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError('Cannot write {}'.format(path))
+    for frame_idx in range(num_frames):
+        frame = background.copy()
+        for ymin, xmin, ymax, xmax in face_boxes(frame_idx, num_frames, width, height).astype(int):
+            cx, cy, side = (xmin + xmax) // 2, (ymin + ymax) // 2, xmax - xmin
+            cv2.ellipse(frame, (cx, cy), (int(side * 0.38), int(side * 0.48)), 0, 0, 360, (120, 160, 210), -1)
+            for dx in (-1, 1):
+                cv2.circle(frame, (cx + dx * int(side * 0.15), cy - int(side * 0.1)), max(side // 20, 1),
+                           (40, 30, 30), -1)
+            cv2.ellipse(frame, (cx, cy + int(side * 0.2)), (int(side * 0.15), int(side * 0.05)), 0, 0, 180,
+                        (60, 60, 150), max(side // 40, 1))
+        writer.write(frame)
+    writer.release()
+
+
+def timed(fn: Callable, repeats: int) -> (object, List[float]):
+    """
+    :return: output of the last call, wall time of each call in seconds
+    """
+    times = []
+    out = None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t0)
+    return out, times
+
+
+def load_net(name: str, weights_key: str, device: torch.device) -> torch.nn.Module:
+    net = getattr(fornet, name)()
+    if weights_key:
+        net.load_state_dict(weights.load_state_dict(weights_key, map_location='cpu'))
+    return net.eval().to(device)
+
+
+def run_config(video_path: str, num_frames: int, size: (int, int), facedet: BlazeFace, net: torch.nn.Module,
+               args: argparse.Namespace, device: torch.device) -> Dict[str, dict]:
+    extractor = FaceExtractor(facedet=facedet)
+    target_size = facedet.input_size
+    results = {}
+
+    def stage(name: str, fn: Callable, needs: List[str] = ()):
+        failed = [need for need in needs if 'median_ms' not in results.get(need, {})]
+        if failed:
+            results[name] = {'skipped': 'needs {}'.format(', '.join(failed))}
+            print('  {:18s} skipped, needs {}'.format(name, ', '.join(failed)))
+            return None
+        try:
+            out, times = timed(fn, args.repeats)
+        except Exception as e:
+            results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+            print('  {:18s} error: {}'.format(name, results[name]['error']))
+            return None
+        results[name] = {'median_ms': 1e3 * float(np.median(times)), 'min_ms': 1e3 * float(np.min(times)),
+                         'per_frame_ms': 1e3 * float(np.median(times)) / num_frames}
+        print('  {:18s} {:10.2f} ms {:8.3f} ms/frame'.format(name, results[name]['median_ms'],
+                                                            results[name]['per_frame_ms']))
+        return out
+
+    reader = VideoReader(verbose=False)
+    frames, frame_idxs = stage('read_frames',
+                               lambda: reader.read_frames(video_path, num_frames=num_frames)) or (None, None)
+    tiles, resize_info = stage('tile_frames', lambda: extractor._tile_frames(frames, target_size),
+                               needs=['read_frames']) or (None, None)
+    with torch.no_grad():
+        detections = stage('detect', lambda: facedet.predict_on_batch(tiles, apply_nms=False), needs=['tile_frames'])
+    untiled = stage('untile', lambda: extractor._untile_detections(
+        len(frames), (frames.shape[2], frames.shape[1]),
+        extractor._resize_detections(detections, target_size, resize_info)), needs=['detect'])
+    stage('nms', lambda: facedet.nms(untiled), needs=['untile'])
+
+    boxes = [np.pad(face_boxes(idx, args.video_frames, *size), ((0, 0), (0, 13))) for idx in frame_idxs] \
+        if frame_idxs is not None else None
+    faces = stage('crop', lambda: [face for frame, frame_boxes in zip(frames, boxes)
+                                   for face in extractor._crop_faces(frame, frame_boxes)], needs=['read_frames'])
+    normalizer = net.get_normalizer() if net is not None else fornet.FeatureExtractor.get_normalizer()
+    stage('preprocess', lambda: torch.stack([
+        utils.get_transformer(args.face, args.size, normalizer, train=False)(image=face)['image'] for face in faces]),
+          needs=['crop'])
+    transf = utils.FaceBatchTransformer(args.face, args.size, normalizer, device=device)
+    batch = stage('preprocess_batch', lambda: transf.from_frames(
+        frames, np.stack([frame_boxes[0, :4] for frame_boxes in boxes]), np.arange(len(frames))),
+                  needs=['read_frames'])
+    if net is None:
+        results['forward'] = {'error': 'classifier not available'}
+        logits = np.random.default_rng(0).normal(size=len(frames)) if frames is not None else None
+        aggregate_needs = ['read_frames']
+    else:
+        with torch.no_grad():
+            logits = stage('forward', lambda: net(batch).float().cpu().numpy().flatten(), needs=['preprocess_batch'])
+        aggregate_needs = ['forward']
+    stage('aggregate', lambda: [utils.aggregate(logits, deadzone=0, pre_mult=1, policy=policy, post_mult=1,
+                                                clipmargin=1e-6) for policy in aggregate_policies],
+          needs=aggregate_needs)
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float,
+            stage_thresholds: Dict[str, float], min_ms: float) -> List[str]:
+    """
+    :param min_ms: slowdowns smaller than this are timing noise, never a regression
+    :return: descriptions of the stages slower than allowed
+    """
+    regressions = []
+    print('{:34s} {:>10s} {:>10s} {:>8s}'.format('stage', 'baseline', 'current', 'change'))
+    for key in sorted(set(results) & set(baseline)):
+        if 'median_ms' not in results[key] or 'median_ms' not in baseline[key]:
+            continue
+        old, new = baseline[key]['median_ms'], results[key]['median_ms']
+        change = new / old - 1 if old > 0 else 0.
+        limit = stage_thresholds.get(key.rsplit('/', 1)[1], threshold)
+        flag = ' REGRESSION' if change > limit and new - old > min_ms else ''
+        print('{:34s} {:10.2f} {:10.2f} {:+7.1%}{}'.format(key, old, new, change, flag))
+        if flag:
+            regressions.append('{} {:+.1%} (limit {:+.1%})'.format(key, change, limit))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolutions', type=str, nargs='+', default=['480p', '1080p', '4k'],
+                        choices=list(resolutions))
+    parser.add_argument('--frames', type=int, nargs='+', default=[8, 32], help='Frames read per video')
+    parser.add_argument('--video_frames', type=int, default=64, help='Length of the synthetic videos')
+    parser.add_argument('--net', type=str, default='EfficientNetAutoAttB4')
+    parser.add_argument('--weights', type=str, help='Registered classifier weights, e.g. EfficientNetAutoAttB4_DFDC. '
+                                                    'Timings do not depend on them')
+    parser.add_argument('--face', type=str, default='scale', choices=['scale', 'tight'])
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help='JSON report')
+    parser.add_argument('--baseline', type=str, help='JSON report of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative slowdown')
+    parser.add_argument('--min_ms', type=float, default=1., help='Slowdowns below this many ms are ignored')
+    parser.add_argument('--stage_threshold', type=str, nargs='*', default=[],
+                        help='Per-stage allowed slowdown, as stage=value')
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    root = Path(__file__).resolve().parents[1]
+    facedet = BlazeFace().to(device)
+    facedet.load_weights(str(root.joinpath('blazeface', 'blazeface.pth')))
+    facedet.load_anchors(str(root.joinpath('blazeface', 'anchors.npy')))
+    try:
+        net = load_net(args.net, args.weights, device)
+    except Exception as e:
+        print('Classifier not available: {}: {}'.format(type(e).__name__, e))
+        net = None
+
+    report = {
+        'meta': {'python': platform.python_version(), 'torch': torch.__version__, 'opencv': cv2.__version__,
+                 'device': str(device), 'cpu_count': os.cpu_count(), 'threads': torch.get_num_threads(),
+                 'platform': platform.platform(), 'net': args.net, 'face': args.face, 'size': args.size,
+                 'repeats': args.repeats},
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for resolution in args.resolutions:
+            width, height = resolutions[resolution]
+            video_path = os.path.join(tmp, '{}.mp4'.format(resolution))
+            write_video(video_path, width, height, args.video_frames, args.seed)
+            for num_frames in args.frames:
+                print('{} {:d} frames'.format(resolution, num_frames))
+                results = run_config(video_path, num_frames, (width, height), facedet, net, args, device)
+                for name, result in results.items():
+                    report['results']['{}/{:d}/{}'.format(resolution, num_frames, name)] = result
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        stage_thresholds = {name: float(value) for name, value in
+                            (item.split('=', 1) for item in args.stage_threshold)}
+        regressions = compare(report['results'], baseline, args.threshold, stage_thresholds, args.min_ms)
+        if regressions:
+            print('Regressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
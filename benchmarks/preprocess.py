@@ -0,0 +1,80 @@
+"""
+Compare the per-face albumentations pipeline with the batched FaceBatchTransformer.
+
+Random face crops of realistic sizes are transformed by both pipelines, and the same faces are
+also cropped and resized straight from their frame with FaceBatchTransformer.from_frames.
+The script reports the maximum absolute difference between the outputs and the time per batch.
+
+Example:
+    python benchmarks/preprocess.py --batch 32 --policy scale
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+import torch
+
+import common  # noqa: F401, puts the repository root on sys.path
+
+from architectures.fornet import FeatureExtractor
+from isplutils import utils
+
+
+def random_faces(num: int, seed: int) -> (np.ndarray, np.ndarray, list):
+    """
+    :return: a 1080p frame, (num, 4) face boxes (ymin, xmin, ymax, xmax) and the corresponding crops
+    """
+    rng = np.random.default_rng(seed)
+    frame = cv2.GaussianBlur(rng.integers(0, 256, size=(1080, 1920, 3), dtype=np.uint8), (5, 5), 2)
+    boxes = []
+    for _ in range(num):
+        h, w = rng.integers(40, 600, size=2)
+        y, x = rng.integers(0, 1080 - h), rng.integers(0, 1920 - w)
+        boxes.append((y, x, y + h, x + w))
+    boxes = np.array(boxes)
+    faces = [frame[y0:y1, x0:x1] for y0, x0, y1, x1 in boxes]
+    return frame, boxes, faces
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--policy', default='scale', choices=['scale', 'tight'])
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    normalizer = FeatureExtractor.get_normalizer()
+    frame, boxes, faces = random_faces(args.batch, args.seed)
+    frame_idxs = np.zeros(len(boxes), dtype=np.int64)
+
+    transf = utils.get_transformer(args.policy, args.size, normalizer, train=False)
+    batch_transf = utils.FaceBatchTransformer(args.policy, args.size, normalizer, device=device)
+
+    reference = torch.stack([transf(image=face)['image'] for face in faces]).to(device)
+    batched = batch_transf(faces)
+    from_frames = batch_transf.from_frames([frame], boxes, frame_idxs)
+    print('Max abs difference (batched): {:.4f}'.format((reference - batched).abs().max().item()))
+    print('Max abs difference (from frames): {:.4f}'.format((reference - from_frames).abs().max().item()))
+    print('Tolerance (1 grey level): {:.4f}'.format(1 / 255 / min(normalizer.std)))
+
+    for name, fn in [
+        ('albumentations', lambda: torch.stack([transf(image=face)['image'] for face in faces]).to(device)),
+        ('batched', lambda: batch_transf(faces)),
+        ('from frames', lambda: batch_transf.from_frames([frame], boxes, frame_idxs)),
+    ]:
+        fn()
+        t0 = time.perf_counter()
+        for _ in range(args.repeats):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - t0) / args.repeats
+        print('{:15s} {:8.2f} ms/batch'.format(name, 1000 * elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Load generator for service.py: latency percentiles and throughput at increasing concurrency.
+
+At each concurrency level, that many clients send the same file back to back for --duration seconds (after
+--warmup requests, not measured). Latency is measured per request on the client, p50/p95/p99 over the successful
+ones; throughput counts successful requests per second. Rejected (429/503) and failed requests are counted by status,
+a client waits --backoff seconds after a rejection.
+
+Example:
+    python service.py --workers 2 --queue 8 &
+    python benchmarks/service_load.py --url http://localhost:8000 --file video.mp4 --frames 16 \
+        --concurrency 1 2 4 8 16 --duration 30 --out load.json
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib import error, request
+
+import numpy as np
+
+
+def multipart(fields: dict, filename: str, content: bytes) -> (bytes, str):
+    """
+    Body and content type of a multipart/form-data request with the form fields and one file
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            boundary, name, value).encode('utf-8'))
+    parts.append('--{}\r\nContent-Disposition: form-data; name="file"; filename="{}"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, filename).encode('utf-8'))
+    parts.append(content)
+    parts.append('\r\n--{}--\r\n'.format(boundary).encode('utf-8'))
+    return b''.join(parts), 'multipart/form-data; boundary={}'.format(boundary)
+
+
+def send(url: str, body: bytes, content_type: str, timeout: float) -> (int, float):
+    """
+    :return: HTTP status (0 for connection errors) and latency [s]
+    """
+    t0 = time.perf_counter()
+    req = request.Request(url, data=body, headers={'Content-Type': content_type}, method='POST')
+    try:
+        with request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except error.HTTPError as e:
+        status = e.code
+    except (error.URLError, OSError):
+        status = 0
+    return status, time.perf_counter() - t0
+
+
+def run_level(url: str, body: bytes, content_type: str, concurrency: int, duration: float, timeout: float,
+              backoff: float) -> dict:
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        while time.perf_counter() < deadline:
+            status, latency = send(url, body, content_type, timeout)
+            with lock:
+                statuses[status] += 1
+                if status == 200:
+                    latencies.append(latency)
+            if status in (429, 503):
+                time.sleep(backoff)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - t0
+
+    result = {'concurrency': concurrency, 'requests': sum(statuses.values()), 'ok': len(latencies),
+              'statuses': {str(status): num for status, num in sorted(statuses.items())},
+              'throughput_rps': len(latencies) / elapsed}
+    for q in [50, 95, 99]:
+        result['p{:d}_ms'.format(q)] = float(np.percentile(latencies, q) * 1e3) if latencies else None
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8000', help='Base URL of service.py')
+    parser.add_argument('--file', required=True, help='Image (jpg, jpeg, png) or video (mp4) to send')
+    parser.add_argument('--model', help='Model, the service default if not set')
+    parser.add_argument('--dataset', help='Training dataset, the service default if not set')
+    parser.add_argument('--frames', type=int, help='Frames per video, the service default if not set')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--duration', type=float, default=30, help='Seconds per concurrency level')
+    parser.add_argument('--warmup', type=int, default=2, help='Requests sent before the measures')
+    parser.add_argument('--backoff', type=float, default=0.1, help='Wait after a 429 or 503 [s]')
+    parser.add_argument('--timeout', type=float, default=300, help='Client timeout per request [s]')
+    parser.add_argument('--out', help='Optional path of the JSON report')
+    args = parser.parse_args()
+
+    kind = 'video' if args.file.lower().endswith('.mp4') else 'image'
+    url = '{}/v1/{}'.format(args.url.rstrip('/'), kind)
+    fields = {name: value for name, value in [('model', args.model), ('dataset', args.dataset),
+                                              ('frames', args.frames)] if value is not None}
+    with open(args.file, 'rb') as f:
+        body, content_type = multipart(fields, os.path.basename(args.file), f.read())
+
+    for _ in range(args.warmup):
+        status, latency = send(url, body, content_type, args.timeout)
+        if status != 200:
+            print('Warmup request failed with status {:d}'.format(status))
+
+    print('{:>11s} {:>8s} {:>6s} {:>9s} {:>9s} {:>9s} {:>9s}  statuses'.format(
+        'concurrency', 'requests', 'ok', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    results = []
+    for concurrency in args.concurrency:
+        result = run_level(url, body, content_type, concurrency, args.duration, args.timeout, args.backoff)
+        results.append(result)
+        print('{:>11d} {:>8d} {:>6d} {:>9s} {:>9s} {:>9s} {:>9.2f}  {}'.format(
+            concurrency, result['requests'], result['ok'],
+            *['{:.0f}'.format(result[key]) if result[key] is not None else '-' for key in ['p50_ms', 'p95_ms',
+                                                                                            'p99_ms']],
+            result['throughput_rps'], result['statuses']))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'url': url, 'file': args.file, 'duration': args.duration, 'levels': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare the split materialization of isplutils.split with the per-video loop it replaces.
+
+A synthetic FF++ faces DataFrame (1000 youtube videos, 4 manipulations each) is pickled to a temporary folder.
+The script checks that the vectorized selection returns the same records as the loop for every split, then
+times the loop, the vectorized selection, and make_splits with a cold and a warm split cache.
+
+Example:
+    python benchmarks/split.py --frames 50 --dataset ff-c23-720-140-140-10fpv
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from common import make_ffpp_df
+
+from isplutils import split as splits
+
+
+def loop_split_df(df: pd.DataFrame, dataset: str, split: str) -> pd.DataFrame:
+    st0 = np.random.get_state()
+    np.random.seed(41)
+    crf = dataset.split('-')[1]
+    random_youtube_videos = np.random.permutation(
+        df[(df['source'] == 'youtube') & (df['quality'] == crf)]['video'].unique())
+    split_orig = {'train': random_youtube_videos[:720], 'val': random_youtube_videos[720:720 + 140],
+                  'test': random_youtube_videos[720 + 140:]}[split]
+    split_df = pd.concat((df[df['original'].isin(split_orig)], df[df['video'].isin(split_orig)]), axis=0)
+    if dataset.endswith('fpv'):
+        fpv = int(dataset.rsplit('-', 1)[1][:-3])
+        idxs = []
+        for video in split_df['video'].unique():
+            idxs.append(np.random.choice(split_df[split_df['video'] == video].index, fpv, replace=False))
+        idxs = np.concatenate(idxs)
+        split_df = split_df.loc[idxs]
+    np.random.set_state(st0)
+    return split_df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=50, help='Faces per video')
+    parser.add_argument('--dataset', type=str, default='ff-c23-720-140-140-10fpv')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        df_path = str(Path(tmp).joinpath('ffpp_faces.pkl'))
+        make_ffpp_df(args.frames, args.seed).to_pickle(df_path)
+        df = splits.read_df(df_path)
+        print('Records: {:d}'.format(len(df)))
+
+        for split in ['train', 'val', 'test']:
+            t0 = time.perf_counter()
+            reference = loop_split_df(df, args.dataset, split)
+            t1 = time.perf_counter()
+            split_df = splits.get_split_df(df, args.dataset, split)
+            t2 = time.perf_counter()
+            print('{:5s} same records: {} loop {:8.3f} s vectorized {:8.3f} s'.format(
+                split, reference.index.equals(split_df.index), t1 - t0, t2 - t1))
+
+        dbs = {split: [args.dataset] for split in ['train', 'val', 'test']}
+        for name in ['cold cache', 'warm cache']:
+            t0 = time.perf_counter()
+            splits.make_splits(None, df_path, None, tmp, dbs)
+            print('make_splits {:s} {:8.3f} s'.format(name, time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Measure the concatenated TripletNet forward and the semi-hard negative mining of FrameFaceTripletIterableDataset.
+
+The forward is timed on a small convolutional feature extractor, running anchors, positives and negatives as three
+batches and as one. Mining is evaluated on a FaceStore of synthetic faces whose brightness depends on the label,
+so that the feature extractor separates the classes in part: the script reports the fraction of triplets with a
+non-zero triplet loss, the ones that produce a gradient, with random and with mined negatives.
+
+Example:
+    python benchmarks/triplet.py --records 2000 --triplets 2000
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+from common import make_face_store
+
+from architectures.fornet import FeatureExtractor
+from architectures.tripletnet import TripletNet
+from isplutils.data_siamese import EmbeddingBank, FrameFaceTripletIterableDataset
+
+
+class SmallNet(FeatureExtractor):
+    def __init__(self):
+        super(SmallNet, self).__init__()
+        self.conv = nn.Sequential(nn.Conv2d(3, 32, 3, stride=2), nn.BatchNorm2d(32), nn.ReLU(),
+                                  nn.Conv2d(32, 64, 3, stride=2), nn.BatchNorm2d(64), nn.ReLU())
+
+    def features(self, x: torch.Tensor) -> torch.Tensor:
+        return self.conv(x.float() / 255).mean(dim=(2, 3))
+
+
+class SmallTripletNet(TripletNet):
+    def __init__(self):
+        super(SmallTripletNet, self).__init__(feat_ext=SmallNet)
+
+
+def labelled_face(size: int):
+    def face_fn(rng: np.random.Generator, label: bool) -> np.ndarray:
+        brightness = rng.normal(140 if label else 115, 20)
+        return np.clip(rng.normal(brightness, 40, (size, size, 3)), 0, 255).astype(np.uint8)
+    return face_fn
+
+
+def useful_fraction(net: TripletNet, dataset: FrameFaceTripletIterableDataset, margin: float) -> float:
+    triplets = list(dataset)
+    with torch.no_grad():
+        a, p, n = net(*[torch.stack(batch) for batch in zip(*triplets)])
+    loss = (a - p).norm(dim=1) - (a - n).norm(dim=1) + margin
+    return (loss > 0).float().mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--triplets', type=int, default=2000)
+    parser.add_argument('--candidates', type=int, default=16)
+    parser.add_argument('--margin', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    net = SmallTripletNet().eval()
+    x1, x2, x3 = [torch.randint(0, 256, (args.batch, 3, args.size, args.size), dtype=torch.uint8) for _ in range(3)]
+    with torch.no_grad():
+        for name, forward in [('three batches', lambda: [net.features(x) for x in (x1, x2, x3)]),
+                              ('concatenated', lambda: net(x1, x2, x3))]:
+            forward()
+            t0 = time.perf_counter()
+            for _ in range(args.iters):
+                forward()
+            print('Forward {:14s} {:8.2f} ms/iteration'.format(name, 1e3 * (time.perf_counter() - t0) / args.iters))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        df, store = make_face_store(Path(tmp), args.records, args.size, args.seed, fake_ratio=0.5,
+                                    face_fn=labelled_face(args.size))
+        kwargs = dict(roots=[tmp], dfs=[df], size=args.size, scale='scale', num_triplets=args.triplets,
+                      seed=args.seed, face_stores=[store])
+        random_negatives = FrameFaceTripletIterableDataset(**kwargs)
+        bank = EmbeddingBank(len(random_negatives.records), dim=64)
+        mined_negatives = FrameFaceTripletIterableDataset(embedding_bank=bank, mining_candidates=args.candidates,
+                                                          mining_margin=args.margin, **kwargs)
+        t0 = time.perf_counter()
+        bank.refresh(net, mined_negatives)
+        print('Bank refresh         {:8.2f} ms/record'.format(1e3 * (time.perf_counter() - t0) / len(bank)))
+        print('Triplets with non-zero loss, random negatives {:6.1%}'.format(
+            useful_fraction(net, random_negatives, args.margin)))
+        print('Triplets with non-zero loss, mined negatives  {:6.1%}'.format(
+            useful_fraction(net, mined_negatives, args.margin)))
+
+
+if __name__ == '__main__':
+    main()
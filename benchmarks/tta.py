@@ -0,0 +1,76 @@
+"""
+Measure the evaluation throughput of FrameFaceDatasetTest with test-time augmentation.
+
+Synthetic faces are written to a temporary faces folder and their autocache is filled beforehand. The per-view
+path loads the face and builds the pipeline once for every augmentation, as FrameFaceDatasetTest used to do;
+the dataset now loads each face once and applies the prebuilt pipelines in memory.
+
+Example:
+    python benchmarks/tta.py --faces 200 --views 4 8
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import albumentations as A
+import torch
+from albumentations.pytorch import ToTensorV2
+
+from common import make_faces
+
+from isplutils.data import FrameFaceDatasetTest, load_face
+
+augmentations = [
+    A.NoOp(),
+    A.HorizontalFlip(p=1),
+    A.VerticalFlip(p=1),
+    A.Transpose(p=1),
+    A.Blur(p=1),
+    A.RandomBrightnessContrast(p=1),
+    A.ToGray(p=1),
+    A.RandomRotate90(p=1),
+]
+
+
+def per_view(dataset: FrameFaceDatasetTest, item: int) -> torch.Tensor:
+    record = dataset.df.iloc[item]
+    return torch.stack([load_face(record=record, root=dataset.root, size=dataset.size, scale=dataset.scale,
+                                  transformer=A.Compose([aug_transf, dataset.transformer]))
+                        for aug_transf in dataset.aug_transformers])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--faces', type=int, default=200)
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--views', type=int, nargs='+', default=[4, 8])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    transformer = A.Compose([A.Normalize(), ToTensorV2()])
+    with tempfile.TemporaryDirectory() as tmp:
+        df = make_faces(Path(tmp), args.faces, args.seed)
+        warmup = FrameFaceDatasetTest(root=tmp, df=df, size=args.size, scale='scale', transformer=transformer)
+        for item in range(len(warmup)):
+            warmup[item]
+
+        for views in args.views:
+            dataset = FrameFaceDatasetTest(root=tmp, df=df, size=args.size, scale='scale', transformer=transformer,
+                                           aug_transformers=augmentations[:views])
+            for name, fn in [('per view', lambda item: per_view(dataset, item)),
+                             ('load once', lambda item: dataset[item][0])]:
+                t0 = time.perf_counter()
+                for item in range(len(dataset)):
+                    fn(item)
+                elapsed = time.perf_counter() - t0
+                print('{:d} views {:10s} {:8.1f} faces/s'.format(views, name, len(dataset) / elapsed))
+
+        # The first four augmentations are deterministic, both paths must give the same views
+        dataset = FrameFaceDatasetTest(root=tmp, df=df, size=args.size, scale='scale', transformer=transformer,
+                                       aug_transformers=augmentations[:4])
+        print('Max abs difference: {:.4f}'.format((per_view(dataset, 0) - dataset[0][0]).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,3 @@
 from .blazeface import BlazeFace
-from .face_extract import FaceExtractor
+from .face_extract import FaceExtractor, FaceExtractionResult
 from .read_video import VideoReader
@@ -5,6 +5,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from isplutils import telemetry
+
 
 class BlazeBlock(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1):
@@ -160,6 +162,10 @@ class BlazeFace(nn.Module):
         """Which device (CPU or GPU) is being used by this model?"""
         return self.classifier_8.weight.device
 
+    def _dtype(self):
+        """Which precision (fp32 or bf16) is being used by this model?"""
+        return self.classifier_8.weight.dtype
+
     def load_weights(self, path):
         self.load_state_dict(torch.load(path))
         self.eval()
@@ -190,6 +196,7 @@ class BlazeFace(nn.Module):
 
         return self.predict_on_batch(img.unsqueeze(0))[0]
 
+    @telemetry.timed('blazeface.predict_on_batch')
     def predict_on_batch(self, x: np.ndarray or torch.Tensor, apply_nms: bool = True) -> List[torch.Tensor]:
         """Makes a prediction on a batch of images.
 
@@ -217,18 +224,23 @@ class BlazeFace(nn.Module):
 
         # 1. Preprocess the images into tensors:
         x = x.to(self._device())
-        x = self._preprocess(x)
+        x = self._preprocess(x).to(self._dtype())
 
         # 2. Run the neural network:
         with torch.no_grad():
             out: torch.Tensor = self.__call__(x)
 
+        # Box decoding and score thresholding are sensitive to rounding,
+        # so they always run in fp32 whatever the network precision.
+        out = [o.float() for o in out]
+
         # 3. Postprocess the raw predictions:
         detections = self._tensors_to_detections(out[0], out[1], self.anchors)
 
         # 4. Non-maximum suppression to remove overlapping detections:
         return self.nms(detections) if apply_nms else detections
 
+    @telemetry.timed('blazeface.nms')
     def nms(self, detections: List[torch.Tensor]) -> List[torch.Tensor]:
         """Filters out overlapping detections."""
         filtered_detections = []
@@ -1,5 +1,6 @@
 import os
-from typing import Tuple, List
+from collections.abc import MutableMapping
+from typing import Callable, Sequence, Tuple, List
 
 import cv2
 import numpy as np
@@ -7,6 +8,195 @@ import torch
 from PIL import Image
 
 from blazeface import BlazeFace
+from isplutils import telemetry
+
+
+class LazyCrops(Sequence):
+    """List-like collection of the crops of a frame.
+
+    Each crop is cut out of the frame the first time it is accessed, so
+    callers that only look at the best face, or never touch the keypoints,
+    do not pay for the other crops.
+    """
+
+    def __init__(self, crop_fn: Callable, frame: np.ndarray, detections: np.ndarray):
+        """Creates a new LazyCrops.
+
+        Arguments:
+            crop_fn: a function that takes in a frame and a NumPy array of
+                detections and returns a list with one crop per detection
+            frame: a NumPy array of shape (H, W, 3)
+            detections: a NumPy array of shape (num_detections, 17)
+        """
+        self._crop_fn = crop_fn
+        self._frame = frame
+        self._detections = detections
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._detections)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return LazyCrops(self._crop_fn, self._frame, self._detections[item])
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('crop index out of range')
+        if item not in self._cache:
+            self._cache[item] = self._crop_fn(self._frame, self._detections[item:item + 1])[0]
+        return self._cache[item]
+
+
+class FrameFaces(MutableMapping):
+    """Dict-like view of the faces found in one frame of a FaceExtractionResult.
+
+    Supports the same keys as the per-frame dictionaries FaceExtractor used
+    to return. Values are built from the columnar arrays on access; assigned
+    values are kept by the parent result and take precedence.
+    """
+    __slots__ = ('_result', '_idx')
+
+    def __init__(self, result: 'FaceExtractionResult', idx: int):
+        self._result = result
+        self._idx = idx
+
+    def __getitem__(self, key):
+        return self._result._get(self._idx, key)
+
+    def __setitem__(self, key, value):
+        self._result._overrides.setdefault(self._idx, {})[key] = value
+
+    def __delitem__(self, key):
+        raise TypeError('Keys cannot be removed from FrameFaces')
+
+    def __iter__(self):
+        return iter(self._result._keys(self._idx))
+
+    def __len__(self):
+        return len(self._result._keys(self._idx))
+
+    def __repr__(self):
+        return 'FrameFaces({})'.format({key: self[key] for key in self if key not in ('frame', 'faces', 'kpts')})
+
+
+class FaceExtractionResult(Sequence):
+    """Columnar storage for the faces found in a set of frames.
+
+    Frames stay in the per-video buffers returned by the video reader and
+    crops are views into them. Per-frame metadata are contiguous arrays,
+    and the detections of all frames are packed in a single array: the
+    faces of frame i are detections[offsets[i]:offsets[i + 1]], sorted by
+    descending confidence.
+
+    Indexing returns a dict-like FrameFaces for backward compatibility.
+    """
+    __slots__ = ('buffers', 'buffer_idxs', 'buffer_pos', 'video_idxs', 'frame_idxs', 'frame_sizes', 'offsets',
+                 'detections', 'kpt_boxes', 'frame_keys', '_overrides')
+
+    video_keys = ('video_idx', 'frame_idx', 'frame_w', 'frame_h', 'frame', 'faces', 'kpts', 'detections', 'scores')
+    image_keys = ('frame_w', 'frame_h', 'faces', 'kpts', 'detections', 'scores')
+
+    def __init__(self, buffers: List[np.ndarray], video_idxs: List[int], frame_idxs: List[List[int]],
+                 counts: List[np.ndarray], detections: List[np.ndarray], kpt_boxes: List[np.ndarray],
+                 frame_keys: Tuple[str, ...] = video_keys):
+        """Creates a new FaceExtractionResult.
+
+        Arguments:
+            buffers: one NumPy array of shape (num_frames, H, W, 3) per video
+            video_idxs: the index of each video
+            frame_idxs: for each video, the index of each frame in the video
+            counts: for each video, a NumPy array with the number of faces in each frame
+            detections: for each video, a NumPy array of shape (num_faces, 17)
+                with the detections including margin, grouped by frame
+            kpt_boxes: for each video, a NumPy array of shape (num_faces, 4)
+                with the boxes without margin, used for the keypoint crops
+            frame_keys: the keys exposed by each FrameFaces
+        """
+        num_frames = [len(buffer) for buffer in buffers]
+        self.buffers = buffers
+        self.buffer_idxs = np.repeat(np.arange(len(buffers), dtype=np.int32), num_frames)
+        self.buffer_pos = np.concatenate([np.arange(n, dtype=np.int32) for n in num_frames] + [
+            np.zeros(0, dtype=np.int32)])
+        self.video_idxs = np.repeat(np.asarray(video_idxs, dtype=np.int32), num_frames)
+        self.frame_idxs = np.concatenate([np.asarray(idxs, dtype=np.int32) for idxs in frame_idxs] + [
+            np.zeros(0, dtype=np.int32)])
+        self.frame_sizes = np.repeat(np.array([(buffer.shape[2], buffer.shape[1]) for buffer in buffers],
+                                              dtype=np.int32).reshape(-1, 2), num_frames, axis=0)
+        self.offsets = np.concatenate(([0], np.cumsum(np.concatenate(list(counts) + [np.zeros(0, np.int64)]))))
+        self.offsets = self.offsets.astype(np.int64)
+        self.detections = np.concatenate(list(detections) + [np.zeros((0, 17), dtype=np.float32)])
+        self.kpt_boxes = np.concatenate(list(kpt_boxes) + [np.zeros((0, 4), dtype=np.float32)])
+        self.frame_keys = frame_keys
+        self._overrides = {}
+
+    def __len__(self):
+        return len(self.buffer_idxs)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('frame index out of range')
+        return FrameFaces(self, item)
+
+    @property
+    def num_faces(self) -> np.ndarray:
+        """Number of faces in each frame."""
+        return np.diff(self.offsets)
+
+    @property
+    def frames(self) -> List[np.ndarray]:
+        """The frames, as views of the video buffers."""
+        return [self.frame(i) for i in range(len(self))]
+
+    def frame(self, idx: int) -> np.ndarray:
+        return self.buffers[self.buffer_idxs[idx]][self.buffer_pos[idx]]
+
+    def best_faces(self) -> (np.ndarray, np.ndarray):
+        """Returns the index of the frames with at least one face, and a
+        NumPy array of shape (num_frames_with_faces, 17) with the detection
+        of the most confident face of each of them.
+
+        Values assigned through FrameFaces (e.g. by keep_only_best_face) are
+        not taken into account.
+        """
+        frame_pos = np.flatnonzero(self.num_faces > 0)
+        return frame_pos, self.detections[self.offsets[frame_pos]]
+
+    def _keys(self, idx: int) -> Tuple[str, ...]:
+        overrides = self._overrides.get(idx, {})
+        return self.frame_keys + tuple(key for key in overrides if key not in self.frame_keys)
+
+    def _get(self, idx: int, key: str):
+        overrides = self._overrides.get(idx)
+        if overrides is not None and key in overrides:
+            return overrides[key]
+        if key not in self.frame_keys:
+            raise KeyError(key)
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        if key == 'video_idx':
+            return int(self.video_idxs[idx])
+        if key == 'frame_idx':
+            return int(self.frame_idxs[idx])
+        if key == 'frame_w':
+            return int(self.frame_sizes[idx, 0])
+        if key == 'frame_h':
+            return int(self.frame_sizes[idx, 1])
+        if key == 'frame':
+            return self.frame(idx)
+        if key == 'faces':
+            return LazyCrops(FaceExtractor._crop_faces, self.frame(idx), self.detections[start:end])
+        if key == 'kpts':
+            kpt_detections = self.detections[start:end].copy()
+            kpt_detections[:, :4] = self.kpt_boxes[start:end]
+            return LazyCrops(lambda f, d: FaceExtractor._crop_kpts(f, d, 0.3), self.frame(idx), kpt_detections)
+        if key == 'detections':
+            return self.detections[start:end]
+        if key == 'scores':
+            return list(self.detections[start:end, 16])
 
 
 class FaceExtractor:
@@ -25,12 +215,13 @@ class FaceExtractor:
         self.video_read_fn = video_read_fn
         self.facedet = facedet
 
-    def process_image(self, path: str = None, img: Image.Image or np.ndarray = None) -> dict:
+    @telemetry.timed('faces.process_image')
+    def process_image(self, path: str = None, img: Image.Image or np.ndarray = None) -> FrameFaces:
         """
         Process a single image
         :param path: Path to the image
         :param img: image
-        :return:
+        :return: dict-like FrameFaces with frame_w, frame_h, faces, kpts, detections and scores
         """
 
         if img is not None and path is not None:
@@ -41,12 +232,16 @@ class FaceExtractor:
         target_size = self.facedet.input_size
 
         if img is None:
+            if telemetry.enabled():
+                telemetry.count('bytes_read', os.path.getsize(str(path)), source='image')
             img = np.asarray(Image.open(str(path)))
         else:
             img = np.asarray(img)
 
         # Split the frames into several tiles. Resize the tiles to 128x128.
-        tiles, resize_info = self._tile_frames(np.expand_dims(img, 0), target_size)
+        with telemetry.span('faces.tile_frames'):
+            tiles, resize_info = self._tile_frames(np.expand_dims(img, 0), target_size)
+        telemetry.count('tiles', len(tiles))
         # tiles has shape (num_tiles, target_size, target_size, 3)
         # resize_info is a list of four elements [resize_factor_y, resize_factor_x, 0, 0]
 
@@ -54,54 +249,58 @@ class FaceExtractor:
         # one for each tile in the batch.
         detections = self.facedet.predict_on_batch(tiles, apply_nms=False)
 
-        # Convert the detections from 128x128 back to the original frame size.
-        detections = self._resize_detections(detections, target_size, resize_info)
+        with telemetry.span('faces.untile'):
+            # Convert the detections from 128x128 back to the original frame size.
+            detections = self._resize_detections(detections, target_size, resize_info)
 
-        # Because we have several tiles for each frame, combine the predictions
-        # from these tiles. The result is a list of PyTorch tensors, but now one
-        # for each frame (rather than each tile).
-        num_frames = 1
-        frame_size = (img.shape[1], img.shape[0])
-        detections = self._untile_detections(num_frames, frame_size, detections)
+            # Because we have several tiles for each frame, combine the predictions
+            # from these tiles. The result is a list of PyTorch tensors, but now one
+            # for each frame (rather than each tile).
+            num_frames = 1
+            frame_size = (img.shape[1], img.shape[0])
+            detections = self._untile_detections(num_frames, frame_size, detections)
 
         # The same face may have been detected in multiple tiles, so filter out
         # overlapping detections. This is done separately for each frame.
         detections = self.facedet.nms(detections)
 
-        # Crop the faces out of the original frame.
-        frameref_detections = self._add_margin_to_detections(detections[0], frame_size, 0.2)
-        faces = self._crop_faces(img, frameref_detections)
-        kpts = self._crop_kpts(img, detections[0], 0.3)
-
-        # Add additional information about the frame and detections.
-        scores = list(detections[0][:, 16].cpu().numpy())
-        frame_dict = {"frame_w": frame_size[0],
-                      "frame_h": frame_size[1],
-                      "faces": faces,
-                      "kpts": kpts,
-                      "detections": frameref_detections.cpu().numpy(),
-                      "scores": scores,
-                      }
-
-        # Sort faces by descending confidence
-        frame_dict = self._soft_faces_by_descending_score(frame_dict)
-
-        return frame_dict
-
-    def _soft_faces_by_descending_score(self, frame_dict: dict) -> dict:
-        if len(frame_dict['scores']) > 1:
-            sort_idxs = np.argsort(frame_dict['scores'])[::-1]
-            new_faces = [frame_dict['faces'][i] for i in sort_idxs]
-            new_kpts = [frame_dict['kpts'][i] for i in sort_idxs]
-            new_detections = frame_dict['detections'][sort_idxs]
-            new_scores = [frame_dict['scores'][i] for i in sort_idxs]
-            frame_dict['faces'] = new_faces
-            frame_dict['kpts'] = new_kpts
-            frame_dict['detections'] = new_detections
-            frame_dict['scores'] = new_scores
-        return frame_dict
-
-    def process_videos(self, input_dir, filenames, video_idxs) -> List[dict]:
+        # Pack the detections, sorted by descending confidence. Crops are
+        # only cut out of the frame when accessed.
+        counts, frameref_detections, kpt_boxes = self._pack_detections(detections, frame_size)
+        telemetry.count('detections', len(frameref_detections))
+        result = FaceExtractionResult(buffers=[np.expand_dims(img, 0)], video_idxs=[0], frame_idxs=[[0]],
+                                      counts=[counts], detections=[frameref_detections], kpt_boxes=[kpt_boxes],
+                                      frame_keys=FaceExtractionResult.image_keys)
+
+        return result[0]
+
+    def _pack_detections(self, detections: List[torch.Tensor], frame_size: Tuple[int, int]) -> (
+            np.ndarray, np.ndarray, np.ndarray):
+        """Packs the detections of a set of frames of the same size into
+        contiguous arrays, sorted by frame and then by descending confidence.
+
+        Arguments:
+            detections: a list of PyTorch tensors of shape (num_detections, 17),
+                one for each frame
+            frame_size: (width, height)
+
+        Returns a NumPy array with the number of faces in each frame, a NumPy
+        array of shape (num_faces, 17) with the detections including margin
+        and a NumPy array of shape (num_faces, 4) with the boxes without margin.
+        """
+        counts = np.array([len(d) for d in detections], dtype=np.int64)
+        if counts.sum() == 0:
+            return counts, np.zeros((0, 17), dtype=np.float32), np.zeros((0, 4), dtype=np.float32)
+        raw_detections = torch.cat(detections)
+        frameref_detections = self._add_margin_to_detections(raw_detections, frame_size, 0.2).cpu().numpy()
+        raw_detections = raw_detections.cpu().numpy()
+
+        frame_of_face = np.repeat(np.arange(len(counts)), counts)
+        sort_idxs = np.lexsort((-raw_detections[:, 16], frame_of_face))
+        return counts, frameref_detections[sort_idxs], raw_detections[sort_idxs, :4]
+
+    @telemetry.timed('faces.process_videos')
+    def process_videos(self, input_dir, filenames, video_idxs) -> FaceExtractionResult:
         """For the specified selection of videos, grabs one or more frames
         from each video, runs the face detector, and tries to find the faces
         in each frame.
@@ -116,27 +315,30 @@ class FaceExtractor:
             video_idxs: one or more indices from the filenames list; these
                 are the videos we'll actually process
 
-        Returns a list of dictionaries, one for each frame read from each video.
+        Returns a FaceExtractionResult, a sequence with one dict-like FrameFaces
+        for each frame read from each video.
 
-        This dictionary contains:
+        Each FrameFaces contains:
             - video_idx: the video this frame was taken from
             - frame_idx: the index of the frame in the video
             - frame_w, frame_h: original dimensions of the frame
-            - faces: a list containing zero or more NumPy arrays with a face crop
+            - faces: a list-like LazyCrops of zero or more NumPy arrays with a face crop
+            - kpts: a list-like LazyCrops with the 6 keypoint crops of each face
+            - detections: a NumPy array of shape (num_faces, 17) with the face boxes
             - scores: a list array with the confidence score for each face crop
 
+        Faces are sorted by descending confidence. Crops are views of the frame
+        and are only computed the first time they are accessed. The columnar
+        arrays of FaceExtractionResult can be used directly instead.
+
         If reading a video failed for some reason, it will not appear in the
         output array. Note that there's no guarantee a given video will actually
         have num_frames results (as soon as a reading problem is encountered for
         a video, we continue with the next video).
         """
-        target_size = self.facedet.input_size
-
         videos_read = []
         frames_read = []
         frames = []
-        tiles = []
-        resize_info = []
 
         for video_idx in video_idxs:
             # Read the full-size frames from this video.
@@ -154,22 +356,58 @@ class FaceExtractor:
             frames.append(my_frames)
             frames_read.append(my_idxs)
 
+        return self._detect_faces(videos_read, frames, frames_read)
+
+    @telemetry.timed('faces.process_frames')
+    def process_frames(self, frames: np.ndarray, frame_idxs: List[int]) -> FaceExtractionResult:
+        """Face extraction on frames already read from a single video, for
+        instance a chunk from VideoReader.iter_frames.
+
+        Arguments:
+            frames: a NumPy array of shape (num_frames, H, W, 3)
+            frame_idxs: the index of each frame in the video
+
+        Returns a FaceExtractionResult, as process_video.
+        """
+        return self._detect_faces([0], [frames], [frame_idxs])
+
+    def _detect_faces(self, video_idxs: List[int], frames: List[np.ndarray],
+                      frame_idxs: List[List[int]]) -> FaceExtractionResult:
+        """Runs the face detector on the frames of one or more videos.
+
+        Arguments:
+            video_idxs: the index of each video
+            frames: for each video, a NumPy array of shape (num_frames, H, W, 3)
+            frame_idxs: for each video, the index of each frame in the video
+
+        Returns a FaceExtractionResult.
+        """
+        target_size = self.facedet.input_size
+
+        tiles = []
+        resize_info = []
+        for my_frames in frames:
             # Split the frames into several tiles. Resize the tiles to 128x128.
-            my_tiles, my_resize_info = self._tile_frames(my_frames, target_size)
+            with telemetry.span('faces.tile_frames'):
+                my_tiles, my_resize_info = self._tile_frames(my_frames, target_size)
             tiles.append(my_tiles)
             resize_info.append(my_resize_info)
 
         if len(tiles) == 0:
-            return []
+            return FaceExtractionResult(buffers=[], video_idxs=[], frame_idxs=[], counts=[], detections=[],
+                                        kpt_boxes=[])
         # Put all the tiles for all the frames from all the videos into
         # a single batch.
         batch = np.concatenate(tiles)
+        telemetry.count('tiles', len(batch))
 
         # Run the face detector. The result is a list of PyTorch tensors,
         # one for each image in the batch.
         all_detections = self.facedet.predict_on_batch(batch, apply_nms=False)
 
-        result = []
+        counts = []
+        frameref_detections = []
+        kpt_boxes = []
         offs = 0
         for v in range(len(tiles)):
             # Not all videos may have the same number of tiles, so find which
@@ -178,44 +416,30 @@ class FaceExtractor:
             detections = all_detections[offs:offs + num_tiles]
             offs += num_tiles
 
-            # Convert the detections from 128x128 back to the original frame size.
-            detections = self._resize_detections(detections, target_size, resize_info[v])
+            with telemetry.span('faces.untile'):
+                # Convert the detections from 128x128 back to the original frame size.
+                detections = self._resize_detections(detections, target_size, resize_info[v])
 
-            # Because we have several tiles for each frame, combine the predictions
-            # from these tiles. The result is a list of PyTorch tensors, but now one
-            # for each frame (rather than each tile).
-            num_frames = frames[v].shape[0]
-            frame_size = (frames[v].shape[2], frames[v].shape[1])
-            detections = self._untile_detections(num_frames, frame_size, detections)
+                # Because we have several tiles for each frame, combine the predictions
+                # from these tiles. The result is a list of PyTorch tensors, but now one
+                # for each frame (rather than each tile).
+                num_frames = frames[v].shape[0]
+                frame_size = (frames[v].shape[2], frames[v].shape[1])
+                detections = self._untile_detections(num_frames, frame_size, detections)
 
             # The same face may have been detected in multiple tiles, so filter out
             # overlapping detections. This is done separately for each frame.
             detections = self.facedet.nms(detections)
 
-            for i in range(len(detections)):
-                # Crop the faces out of the original frame.
-                frameref_detections = self._add_margin_to_detections(detections[i], frame_size, 0.2)
-                faces = self._crop_faces(frames[v][i], frameref_detections)
-                kpts = self._crop_kpts(frames[v][i], detections[i], 0.3)
-
-                # Add additional information about the frame and detections.
-                scores = list(detections[i][:, 16].cpu().numpy())
-                frame_dict = {"video_idx": videos_read[v],
-                              "frame_idx": frames_read[v][i],
-                              "frame_w": frame_size[0],
-                              "frame_h": frame_size[1],
-                              "frame": frames[v][i],
-                              "faces": faces,
-                              "kpts": kpts,
-                              "detections": frameref_detections.cpu().numpy(),
-                              "scores": scores,
-                              }
-                # Sort faces by descending confidence
-                frame_dict = self._soft_faces_by_descending_score(frame_dict)
-
-                result.append(frame_dict)
-
-        return result
+            # Pack the detections of all the frames, sorted by descending confidence.
+            my_counts, my_detections, my_kpt_boxes = self._pack_detections(detections, frame_size)
+            telemetry.count('detections', len(my_detections))
+            counts.append(my_counts)
+            frameref_detections.append(my_detections)
+            kpt_boxes.append(my_kpt_boxes)
+
+        return FaceExtractionResult(buffers=frames, video_idxs=video_idxs, frame_idxs=frame_idxs, counts=counts,
+                                    detections=frameref_detections, kpt_boxes=kpt_boxes)
 
     def process_video(self, video_path):
         """Convenience method for doing face extraction on a single video."""
@@ -374,41 +598,47 @@ class FaceExtractor:
         detections[:, 3] = torch.clamp(detections[:, 3] + offset, max=frame_size[0])  # xmax
         return detections
 
-    def _crop_faces(self, frame: np.ndarray, detections: torch.Tensor) -> List[np.ndarray]:
+    @staticmethod
+    def _crop_faces(frame: np.ndarray, detections: np.ndarray or torch.Tensor) -> List[np.ndarray]:
         """Copies the face region(s) from the given frame into a set
         of new NumPy arrays.
 
         Arguments:
             frame: a NumPy array of shape (H, W, 3)
-            detections: a PyTorch tensor of shape (num_detections, 17)
+            detections: a NumPy array or PyTorch tensor of shape (num_detections, 17)
 
         Returns a list of NumPy arrays, one for each face crop. If there
         are no faces detected for this frame, returns an empty list.
         """
+        if isinstance(detections, torch.Tensor):
+            detections = detections.cpu().numpy()
         faces = []
         for i in range(len(detections)):
-            ymin, xmin, ymax, xmax = detections[i, :4].cpu().numpy().astype(np.int32)
+            ymin, xmin, ymax, xmax = detections[i, :4].astype(np.int32)
             face = frame[ymin:ymax, xmin:xmax, :]
             faces.append(face)
         return faces
 
-    def _crop_kpts(self, frame: np.ndarray, detections: torch.Tensor, face_fraction: float):
+    @staticmethod
+    def _crop_kpts(frame: np.ndarray, detections: np.ndarray or torch.Tensor, face_fraction: float):
         """Copies the parts region(s) from the given frame into a set
         of new NumPy arrays.
 
         Arguments:
             frame: a NumPy array of shape (H, W, 3)
-            detections: a PyTorch tensor of shape (num_detections, 17)
+            detections: a NumPy array or PyTorch tensor of shape (num_detections, 17)
             face_fraction: float between 0 and 1 indicating how big are the parts to be extracted w.r.t the whole face
 
         Returns a list of NumPy arrays, one for each face crop. If there
         are no faces detected for this frame, returns an empty list.
         """
+        if isinstance(detections, torch.Tensor):
+            detections = detections.cpu().numpy()
         faces = []
         for i in range(len(detections)):
             kpts = []
             size = int(face_fraction * min(detections[i, 2] - detections[i, 0], detections[i, 3] - detections[i, 1]))
-            kpts_coords = detections[i, 4:16].cpu().numpy().astype(np.int32)
+            kpts_coords = detections[i, 4:16].astype(np.int32)
             for kpidx in range(6):
                 kpx, kpy = kpts_coords[kpidx * 2:kpidx * 2 + 2]
                 kpt = frame[kpy - size // 2:kpy - size // 2 + size, kpx - size // 2:kpx - size // 2 + size, ]
@@ -1,6 +1,10 @@
+import os
+
 import cv2
 import numpy as np
 
+from isplutils import telemetry
+
 
 class VideoReader:
     """Helper class for reading one or more frames from a video file."""
@@ -48,6 +52,60 @@ class VideoReader:
         capture.release()
         return result
 
+    def iter_frames(self, path, num_frames, chunk_size):
+        """Reads the same frames as read_frames, chunk_size frames at a
+        time, so that only one chunk of frames is in memory. The video is
+        decoded once.
+
+        Arguments:
+            path: the video file
+            num_frames: how many frames to read
+            chunk_size: how many frames to return at a time
+
+        Yields tuples of a NumPy array of shape (<= chunk_size, height, width, 3)
+        and the list of the indices of these frames. Reading stops if
+        loading a frame fails.
+        """
+        assert num_frames > 0 and chunk_size > 0
+
+        capture = cv2.VideoCapture(path)
+        try:
+            frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            if frame_count <= 0: return
+            frame_idxs = np.unique(np.linspace(0, frame_count - 1, num_frames, endpoint=True, dtype=np.int32))
+            if telemetry.enabled() and os.path.exists(path):
+                telemetry.count('videos_read')
+                telemetry.count('bytes_read', os.path.getsize(path), source='video')
+
+            frames = []
+            idxs_read = []
+            num_read = 0
+            for frame_idx in range(frame_idxs[-1] + 1):
+                if not capture.grab():
+                    if self.verbose:
+                        print("Error grabbing frame %d from movie %s" % (frame_idx, path))
+                    break
+                telemetry.count('frames_decoded')
+                if frame_idx == frame_idxs[num_read]:
+                    ret, frame = capture.retrieve()
+                    if not ret or frame is None:
+                        if self.verbose:
+                            print("Error retrieving frame %d from movie %s" % (frame_idx, path))
+                        break
+                    frames.append(self._postprocess_frame(frame))
+                    idxs_read.append(frame_idx)
+                    num_read += 1
+                    if len(frames) == chunk_size:
+                        telemetry.count('frames_read', len(frames))
+                        yield np.stack(frames), idxs_read
+                        frames = []
+                        idxs_read = []
+            if len(frames) > 0:
+                telemetry.count('frames_read', len(frames))
+                yield np.stack(frames), idxs_read
+        finally:
+            capture.release()
+
     def read_random_frames(self, path, num_frames, seed=None):
         """Picks the frame indices at random.
         
@@ -95,9 +153,20 @@ class VideoReader:
         return result
 
     def _read_frames_at_indices(self, path, capture, frame_idxs):
+        with telemetry.span('video.read_frames'):
+            result = self._read_frames_at_indices_impl(path, capture, frame_idxs)
+        if telemetry.enabled():
+            telemetry.count('videos_read')
+            telemetry.count('frames_read', len(result[1]) if result is not None else 0)
+            if os.path.exists(path):
+                telemetry.count('bytes_read', os.path.getsize(path), source='video')
+        return result
+
+    def _read_frames_at_indices_impl(self, path, capture, frame_idxs):
         try:
             frames = []
             idxs_read = []
+            frames_decoded = 0
             for frame_idx in range(frame_idxs[0], frame_idxs[-1] + 1):
                 # Get the next frame, but don't decode if we're not using it.
                 ret = capture.grab()
@@ -105,6 +174,7 @@ class VideoReader:
                     if self.verbose:
                         print("Error grabbing frame %d from movie %s" % (frame_idx, path))
                     break
+                frames_decoded += 1
 
                 # Need to look at this frame?
                 current = len(idxs_read)
@@ -119,6 +189,7 @@ class VideoReader:
                     frames.append(frame)
                     idxs_read.append(frame_idx)
 
+            telemetry.count('frames_decoded', frames_decoded)
             if len(frames) > 0:
                 return np.stack(frames), idxs_read
             if self.verbose:
@@ -0,0 +1,217 @@
+"""
+Pack the faces of the faces DataFrames into memory-mapped FaceStores, or verify existing ones.
+
+The stores replace the per-face JPEG autocache: faces are extracted from the original frames with extract_bb and
+written, lossless, into a single uint8 array per (face policy, size). Records are grouped by source frame and
+extracted by a pool of worker processes, each frame is decoded once for all the requested policies and sizes.
+Slots already filled are skipped, so an interrupted build resumes where it stopped.
+With --verify, a random subset of the filled slots is extracted again and compared.
+
+Example:
+    python build_face_store.py --dfdc_faces_df_path dfdc_faces.pkl --dfdc_faces_dir faces/dfdc --dataset dfdc-35-5-10 \
+        --split train val --face scale crop --size 224 256 --workers 8
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+from isplutils.data import frame_groups, source_paths
+from isplutils.face_store import FaceStore, face_store_path, store_policies
+from isplutils.split import load_df, make_splits, available_datasets
+from isplutils.utils import extract_bb
+
+
+def extract_face(record: pd.Series, root: str, scale: str, size: int) -> np.ndarray:
+    """
+    Extract a face from its original frame
+    :param record: row of the faces DataFrame
+    :param root: root folder for frames cache
+    :param scale: face policy
+    :param size: face size
+    :return: (height, width, 3) uint8 array
+    """
+    frame = Image.open(os.path.join(root, str(record['path'] if 'path' in record else record.name)))
+    bb = record['left'], record['top'], record['right'], record['bottom']
+    face = np.array(extract_bb(frame, bb=bb, size=size, scale=scale))
+    if len(face.shape) != 3:
+        raise RuntimeError('Incorrect format: {}'.format(record.name))
+    return face
+
+
+_worker_stores = {}
+
+
+def _init_worker(store_paths: Dict[Tuple[str, int], str]):
+    _worker_stores.clear()
+    for key, path in store_paths.items():
+        _worker_stores[key] = FaceStore(path, mode='r+')
+
+
+def _extract_chunk(root: str, paths: List[str], bbs: np.ndarray, targets: List[List[Tuple[Tuple[str, int], int]]]) -> (
+        int, int):
+    """
+    Extract the faces of a chunk of records for all the pending (face policy, size) targets
+    :param root: root folder for frames cache
+    :param paths: source image of each record, records of the same image are adjacent
+    :param bbs: (num_records, 4) bounding boxes (left, top, right, bottom)
+    :param targets: for each record, the (store key, slot) pairs to fill
+    :return: number of faces written, number of records that could not be read
+    """
+    written = errors = 0
+    frame_path = frame = None
+    for path, bb, record_targets in zip(paths, bbs, targets):
+        try:
+            # Decode each frame once, extract every face, policy and size from it
+            if path != frame_path:
+                frame_path, frame = path, None
+                frame = Image.open(os.path.join(root, path))
+                frame.load()
+            if frame is None:
+                raise RuntimeError('Unreadable frame: {}'.format(path))
+            for (scale, size), slot in record_targets:
+                face = np.array(extract_bb(frame, bb=bb, size=size, scale=scale))
+                if len(face.shape) != 3:
+                    raise RuntimeError('Incorrect format: {}'.format(path))
+                _worker_stores[(scale, size)].put(slot, face)
+                written += 1
+        except KeyboardInterrupt as e:
+            # We want keybord interrupts to be propagated
+            raise e
+        except (OSError, IOError, RuntimeError) as e:
+            print('Error while reading: {}'.format(path))
+            print(e)
+            errors += 1
+    for store in _worker_stores.values():
+        store.flush()
+    return written, errors
+
+
+def build(stores: Dict[Tuple[str, int], FaceStore], df: pd.DataFrame, root: str, workers: int = 0,
+          chunk_size: int = 256):
+    """
+    Fill the stores with the faces of df. Records are grouped by source frame and split in chunks, each chunk is
+    extracted by a worker process that decodes every frame once for all the stores. Slots are marked as filled
+    as soon as they are written, so an interrupted build resumes from the missing faces only.
+    :param stores: {(face policy, size): store}, open for writing
+    :param df: faces DataFrame, or a subset of the DataFrame the stores were created from
+    :param root: root folder for frames cache
+    :param workers: number of worker processes, 0 to extract in the current process
+    :param chunk_size: minimum number of records per task
+    """
+    keys = list(stores)
+    slots = np.stack([stores[key].slots(df.index) for key in keys], axis=1)
+    if (slots < 0).any():
+        raise ValueError('{:d} records are not in the stores'.format((slots < 0).any(axis=1).sum()))
+    pending = np.stack([~stores[key].filled[slots[:, i]] for i, key in enumerate(keys)], axis=1)
+    todo = np.flatnonzero(pending.any(axis=1))
+    print('Faces to extract: {:d}/{:d} records, {:d} faces'.format(len(todo), len(df), pending.sum()))
+    if len(todo) == 0:
+        return
+
+    bbs = df[['left', 'top', 'right', 'bottom']].values
+    paths = source_paths(df)
+    tasks = []
+    chunk = []
+    for group in frame_groups(df.iloc[todo]):
+        chunk.extend(todo[group])
+        if len(chunk) >= chunk_size:
+            tasks.append(chunk)
+            chunk = []
+    if len(chunk):
+        tasks.append(chunk)
+    tasks = [(root, [paths[pos] for pos in chunk], bbs[chunk],
+              [[(key, slots[pos, i]) for i, key in enumerate(keys) if pending[pos, i]] for pos in chunk])
+             for chunk in tasks]
+
+    store_paths = {key: str(store.path) for key, store in stores.items()}
+    written = errors = 0
+    with tqdm(total=len(todo)) as progress:
+        if workers > 0:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(store_paths,)) as pool:
+                futures = {pool.submit(_extract_chunk, *task): len(task[1]) for task in tasks}
+                for future in as_completed(futures):
+                    chunk_written, chunk_errors = future.result()
+                    written, errors = written + chunk_written, errors + chunk_errors
+                    progress.update(futures[future])
+        else:
+            _init_worker(store_paths)
+            for task in tasks:
+                chunk_written, chunk_errors = _extract_chunk(*task)
+                written, errors = written + chunk_written, errors + chunk_errors
+                progress.update(len(task[1]))
+    print('Faces written: {:d} Records with errors: {:d}'.format(written, errors))
+
+
+def verify(store: FaceStore, df: pd.DataFrame, root: str, scale: str, size: int, num: int, seed: int) -> int:
+    slots = store.slots(df.index)
+    filled = np.flatnonzero(store.filled[slots])
+    print('Filled slots: {:d}/{:d}'.format(len(filled), len(df)))
+    if 0 < num < len(filled):
+        filled = np.random.RandomState(seed).choice(filled, num, replace=False)
+    mismatches = 0
+    for pos in tqdm(filled):
+        if not np.array_equal(store.get(slots[pos]), extract_face(df.iloc[pos], root, scale, size)):
+            print('Mismatch: {}'.format(df.index[pos]))
+            mismatches += 1
+    print('Verified: {:d} Mismatches: {:d}'.format(len(filled), mismatches))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dfdc_faces_df_path', type=str, help='Path to the Pandas Dataframe obtained from extract_faces.py on the DFDC dataset.')
+    parser.add_argument('--dfdc_faces_dir', type=str, help='Path to the directory containing the faces extracted from the DFDC dataset.')
+    parser.add_argument('--ffpp_faces_df_path', type=str, help='Path to the Pandas Dataframe obtained from extract_faces.py on the FF++ dataset.')
+    parser.add_argument('--ffpp_faces_dir', type=str, help='Path to the directory containing the faces extracted from the FF++ dataset.')
+    parser.add_argument('--dataset', type=str, nargs='+', required=True, choices=available_datasets)
+    parser.add_argument('--split', type=str, nargs='*', choices=['train', 'val', 'test'],
+                        help='Only extract the faces of these splits. All the faces are extracted by default')
+    parser.add_argument('--face', type=str, nargs='+', default=['scale'], choices=store_policies)
+    parser.add_argument('--size', type=int, nargs='+', default=[224])
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes, 0 to disable')
+    parser.add_argument('--chunk', type=int, default=256, help='Minimum number of records per task')
+    parser.add_argument('--verify', type=int, nargs='?', const=1000, default=None,
+                        help='Verify a random subset of the filled slots (0 for all) instead of building')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Stores always index the full faces DataFrame of a root, so that they serve every split
+    if args.split:
+        split_dict = make_splits(args.dfdc_faces_df_path, args.ffpp_faces_df_path, args.dfdc_faces_dir,
+                                 args.ffpp_faces_dir, {split: args.dataset for split in args.split})
+    targets = {}
+    for dataset in args.dataset:
+        df, root = load_df(args.dfdc_faces_df_path, args.ffpp_faces_df_path, args.dfdc_faces_dir,
+                           args.ffpp_faces_dir, dataset)
+        full_df, names = targets.get(root, (df, pd.Index([])))
+        if args.split:
+            names = names.union(pd.Index(np.concatenate([split_dict[split][dataset][0].index for split in args.split])))
+        else:
+            names = df.index
+        targets[root] = (full_df, names)
+
+    failed = False
+    for root, (full_df, names) in targets.items():
+        df = full_df.loc[names]
+        for scale in args.face:
+            for size in args.size:
+                print('{} {} {:d}'.format(root, scale, size))
+                path = face_store_path(root, scale, size)
+                if args.verify is not None:
+                    failed |= verify(FaceStore(path), df, root, scale, size, args.verify, args.seed) > 0
+        if args.verify is None:
+            stores = {(scale, size): FaceStore.create(face_store_path(root, scale, size), full_df.index, size)
+                      for scale in args.face for size in args.size}
+            build(stores, df, root, workers=args.workers, chunk_size=args.chunk)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Convert pickled faces DataFrames to Parquet or Arrow IPC, for memory-mapped loading with isplutils.split.load_df.
+
+String columns with few distinct values (video, original, source, ...) are stored as categorical. The converted
+file is written next to the pickle with the extension of the format, and is checked against the pickle before
+the script exits.
+
+Example:
+    python convert_faces_df.py dfdc_faces.pkl ffpp_faces.pkl --format arrow
+"""
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+from isplutils.split import columnar_formats, read_df, write_df
+
+
+def categorical_columns(df: pd.DataFrame, max_ratio: float) -> list:
+    """
+    String columns worth storing as categorical
+    :param df: faces DataFrame
+    :param max_ratio: maximum ratio of distinct values to rows
+    :return: column names
+    """
+    return [col for col in df.columns
+            if (pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col]))
+            and df[col].nunique() <= max_ratio * len(df)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('df_path', type=str, nargs='+', help='Pickled faces DataFrames')
+    parser.add_argument('--format', type=str, default='arrow', choices=list(columnar_formats))
+    parser.add_argument('--categorical', type=str, nargs='*',
+                        help='Columns to store as categorical. By default the string columns with at most '
+                             '--max_ratio distinct values per row')
+    parser.add_argument('--max_ratio', type=float, default=0.5)
+    args = parser.parse_args()
+
+    for path in args.df_path:
+        df = pd.read_pickle(path)
+        categorical = args.categorical if args.categorical is not None else categorical_columns(df, args.max_ratio)
+        dst = Path(path).with_suffix(columnar_formats[args.format])
+        write_df(df, dst, categorical=categorical)
+        converted = read_df(str(dst))
+        if not converted.astype(df.dtypes.to_dict()).equals(df):
+            raise RuntimeError('Converted DataFrame differs from {}'.format(path))
+        print('{} -> {} ({:d} records, categorical: {})'.format(path, dst, len(df), ', '.join(categorical)))
+
+
+if __name__ == '__main__':
+    main()
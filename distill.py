@@ -0,0 +1,212 @@
+"""
+Distill one or more fornet teachers into a smaller fornet student (EfficientNetB0 by default).
+
+Training faces come from FrameFaceIterableDataset, as for the teachers. The student learns the temperature-softened
+scores of the teachers, averaged in logit space for an ensemble, together with the ground truth labels.
+The student with the lowest validation loss is saved and registered in the weights registry as
+<student>_<tag>, so that it can be selected like the released models, e.g. image_pred(model='EfficientNetB0').
+At the end, teachers and student are compared on the validation faces: loss, accuracy, ROC AUC and throughput.
+
+Example:
+    python distill.py --teachers EfficientNetAutoAttB4_DFDC EfficientNetB4_DFDC --student EfficientNetB0 --tag DFDC \
+        --dfdc_faces_df_path dfdc_faces.pkl --dfdc_faces_dir faces/dfdc --traindb dfdc-35-5-10 --valdb dfdc-35-5-10
+"""
+import argparse
+import os
+import time
+from typing import List
+
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+from torch import nn
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from tqdm import tqdm
+
+from architectures import fornet, weights
+from isplutils import utils
+from isplutils.data import FrameFaceIterableDataset
+from isplutils.face_store import open_face_store
+from isplutils.split import available_datasets, make_splits
+
+
+def load_teacher(key: str, device: torch.device) -> nn.Module:
+    """
+    :param key: registered weights, '<model>_<dataset>'
+    """
+    net = getattr(fornet, key.rsplit('_', 1)[0])()
+    net.load_state_dict(weights.load_state_dict(key, map_location='cpu'))
+    return net.eval().to(device)
+
+
+def renormalize(x: torch.Tensor, src: transforms.Normalize, dst: transforms.Normalize) -> torch.Tensor:
+    """
+    Convert a batch normalized for one network to the normalization of another one
+    """
+    if list(src.mean) == list(dst.mean) and list(src.std) == list(dst.std):
+        return x
+    src_mean, src_std, dst_mean, dst_std = [torch.tensor(v, device=x.device, dtype=x.dtype).view(1, -1, 1, 1)
+                                            for v in (src.mean, src.std, dst.mean, dst.std)]
+    return (x * src_std + src_mean - dst_mean) / dst_std
+
+
+def teacher_logits(teachers: List[nn.Module], x: torch.Tensor, normalizer: transforms.Normalize) -> torch.Tensor:
+    """
+    Ensemble logits, average of the logits of the teachers
+    :param x: batch normalized for the student
+    :param normalizer: student normalizer
+    """
+    with torch.no_grad():
+        return torch.stack([teacher(renormalize(x, normalizer, teacher.get_normalizer())) for teacher in teachers]
+                           ).mean(dim=0)
+
+
+def distillation_loss(student: torch.Tensor, teacher: torch.Tensor, labels: torch.Tensor, temperature: float,
+                      alpha: float) -> torch.Tensor:
+    """
+    Weighted sum of the binary cross-entropy with the teacher scores softened by temperature (scaled by
+    temperature^2, as in Hinton et al.) and of the binary cross-entropy with the labels
+    """
+    soft = nn.functional.binary_cross_entropy_with_logits(student / temperature, torch.sigmoid(teacher / temperature))
+    hard = nn.functional.binary_cross_entropy_with_logits(student, labels)
+    return alpha * temperature ** 2 * soft + (1 - alpha) * hard
+
+
+def predict(nets: List[nn.Module], loader: DataLoader, normalizer: transforms.Normalize, device: torch.device) -> (
+        List[np.ndarray], np.ndarray):
+    """
+    Logits of each network (a list is an ensemble, averaged) on all the batches of loader
+    :return: list of logits arrays, one for each entry of nets, labels
+    """
+    logits = [[] for _ in nets]
+    labels = []
+    with torch.no_grad():
+        for x, y in loader:
+            x = x.to(device)
+            for idx, net in enumerate(nets):
+                members = net if isinstance(net, list) else [net]
+                logits[idx].append(teacher_logits(members, x, normalizer).cpu().numpy().flatten())
+            labels.append(y.numpy().flatten().astype(np.float32))
+    return [np.concatenate(l) for l in logits], np.concatenate(labels)
+
+
+def metrics(logits: np.ndarray, labels: np.ndarray) -> dict:
+    loss = nn.functional.binary_cross_entropy_with_logits(torch.from_numpy(logits), torch.from_numpy(labels)).item()
+    auc = roc_auc_score(labels, logits) if 0 < labels.sum() < len(labels) else float('nan')
+    return {'loss': loss, 'accuracy': float(((logits > 0) == (labels > 0.5)).mean()), 'auc': auc}
+
+
+def throughput(net: nn.Module, size: int, batch_size: int, device: torch.device, iters: int = 3) -> float:
+    """
+    :return: faces per second of the forward pass
+    """
+    x = torch.randn(batch_size, 3, size, size, device=device)
+    with torch.no_grad():
+        net(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        for _ in range(iters):
+            net(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return iters * batch_size / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--teachers', type=str, nargs='+', required=True, help='Registered teacher weights')
+    parser.add_argument('--student', type=str, default='EfficientNetB0', help='fornet class of the student')
+    parser.add_argument('--tag', type=str, required=True, help='Student is registered as <student>_<tag>')
+    parser.add_argument('--dfdc_faces_df_path', type=str, help='Path to the Pandas Dataframe obtained from extract_faces.py on the DFDC dataset.')
+    parser.add_argument('--dfdc_faces_dir', type=str, help='Path to the directory containing the faces extracted from the DFDC dataset.')
+    parser.add_argument('--ffpp_faces_df_path', type=str, help='Path to the Pandas Dataframe obtained from extract_faces.py on the FF++ dataset.')
+    parser.add_argument('--ffpp_faces_dir', type=str, help='Path to the directory containing the faces extracted from the FF++ dataset.')
+    parser.add_argument('--traindb', type=str, nargs='+', required=True, choices=available_datasets)
+    parser.add_argument('--valdb', type=str, nargs='+', required=True, choices=available_datasets)
+    parser.add_argument('--face', type=str, default='scale', choices=['scale', 'tight'])
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--maxiter', type=int, default=20000)
+    parser.add_argument('--valint', type=int, default=500, help='Validation interval (iterations)')
+    parser.add_argument('--valsamples', type=int, default=6000)
+    parser.add_argument('--temperature', type=float, default=2.)
+    parser.add_argument('--alpha', type=float, default=0.9, help='Weight of the distillation term')
+    parser.add_argument('--workers', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=41)
+    parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--models_dir', type=str, default='weights/distill')
+    parser.add_argument('--registry', type=str, default=weights.registry_path)
+    args = parser.parse_args()
+
+    device = torch.device('cuda:{:d}'.format(args.device)) if torch.cuda.is_available() else torch.device('cpu')
+    torch.manual_seed(args.seed)
+
+    teachers = [load_teacher(key, device) for key in args.teachers]
+    student = getattr(fornet, args.student)().to(device)
+    normalizer = student.get_normalizer()
+
+    splits = make_splits(args.dfdc_faces_df_path, args.ffpp_faces_df_path, args.dfdc_faces_dir,
+                         args.ffpp_faces_dir, {'train': args.traindb, 'val': args.valdb})
+    train_dfs, train_roots = zip(*splits['train'].values())
+    val_dfs, val_roots = zip(*splits['val'].values())
+    train_dataset = FrameFaceIterableDataset(
+        roots=train_roots, dfs=train_dfs, size=args.size, scale=args.face,
+        num_samples=args.maxiter * args.batch, seed=args.seed,
+        transformer=utils.get_transformer(args.face, args.size, normalizer, train=True),
+        face_stores=[open_face_store(root, args.face, args.size) for root in train_roots])
+    val_dataset = FrameFaceIterableDataset(
+        roots=val_roots, dfs=val_dfs, size=args.size, scale=args.face, num_samples=args.valsamples, seed=args.seed,
+        transformer=utils.get_transformer(args.face, args.size, normalizer, train=False),
+        face_stores=[open_face_store(root, args.face, args.size) for root in val_roots])
+    train_loader = DataLoader(train_dataset, batch_size=args.batch, num_workers=args.workers)
+    val_loader = DataLoader(val_dataset, batch_size=args.batch, num_workers=args.workers)
+
+    optimizer = torch.optim.Adam(student.get_trainable_parameters(), lr=args.lr)
+    os.makedirs(args.models_dir, exist_ok=True)
+    out_path = os.path.join(args.models_dir, '{}_{}_bestval.pth'.format(args.student, args.tag))
+    best_loss = np.inf
+    iteration = 0
+    for x, y in tqdm(train_loader, total=args.maxiter):
+        student.train()
+        x, y = x.to(device), y.to(device).float()
+        target = teacher_logits(teachers, x, normalizer)
+        loss = distillation_loss(student(x), target, y, args.temperature, args.alpha)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        iteration += 1
+
+        if iteration % args.valint == 0 or iteration == args.maxiter:
+            student.eval()
+            (val_logits,), val_labels = predict([student], val_loader, normalizer, device)
+            val_metrics = metrics(val_logits, val_labels)
+            print('Iteration {:d} train loss {:.4f} val loss {loss:.4f} accuracy {accuracy:.4f} AUC {auc:.4f}'.format(
+                iteration, loss.item(), **val_metrics))
+            if val_metrics['loss'] < best_loss:
+                best_loss = val_metrics['loss']
+                torch.save(student.state_dict(), out_path)
+        if iteration >= args.maxiter:
+            break
+
+    weights.register('{}_{}'.format(args.student, args.tag), out_path, path=args.registry)
+    print('Registered {}_{}: {}'.format(args.student, args.tag, out_path))
+
+    # Teachers vs student
+    student.load_state_dict(torch.load(out_path, map_location=device))
+    student.eval()
+    names = args.teachers + (['ensemble'] if len(teachers) > 1 else []) + ['{}_{}'.format(args.student, args.tag)]
+    nets = teachers + ([teachers] if len(teachers) > 1 else []) + [student]
+    logits, labels = predict(nets, val_loader, normalizer, device)
+    print('{:40s} {:>8s} {:>8s} {:>8s} {:>10s}'.format('model', 'loss', 'accuracy', 'AUC', 'faces/s'))
+    for name, net, net_logits in zip(names, nets, logits):
+        speed = sum(1 / throughput(member, args.size, args.batch, device) for member in
+                    (net if isinstance(net, list) else [net])) ** -1
+        print('{:40s} {loss:8.4f} {accuracy:8.4f} {auc:8.4f} {:10.1f}'.format(name, speed,
+                                                                              **metrics(net_logits, labels)))
+
+
+if __name__ == '__main__':
+    main()
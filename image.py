@@ -1,16 +1,16 @@
+import os
+
 import torch
-from torch.utils.model_zoo import load_url
-from PIL import Image
 from scipy.special import expit
 import sys
-import streamlit as st
 sys.path.append('..')
 
-from blazeface import FaceExtractor, BlazeFace
-from architectures import fornet,weights
-from isplutils import utils
+from blazeface import FaceExtractor
+import models
+from isplutils import profiling, telemetry, utils
 
-def image_pred(threshold=0.5,model='EfficientNetAutoAttB4',dataset='DFDC',image_path="notebook/samples/lynaeydofd_fr0.jpg"):
+@profiling.profiled('image', path_arg='image_path', params=('model', 'dataset', 'precision', 'tta'), data_arg='image')
+def image_pred(threshold=0.5,model='EfficientNetAutoAttB4',dataset='DFDC',image_path="notebook/samples/lynaeydofd_fr0.jpg",precision='fp32',tta=False,tta_policy='mean',return_attention=False,image=None):
     """
     Choose an architecture between
     - EfficientNetB4
@@ -18,6 +18,7 @@ def image_pred(threshold=0.5,model='EfficientNetAutoAttB4',dataset='DFDC',image_
     - EfficientNetAutoAttB4
     - EfficientNetAutoAttB4ST
     - Xception
+    - EfficientNetB0 (students trained with distill.py, registered in weights/registry.json)
     """
     net_model = model
 
@@ -28,37 +29,83 @@ def image_pred(threshold=0.5,model='EfficientNetAutoAttB4',dataset='DFDC',image_
     """
     train_db = dataset
 
+    """
+    Choose an inference precision between
+    - fp32
+    - bf16 (falls back to fp32 if the hardware does not support it)
+    """
+
+    """
+    Test-time augmentation: with tta=True the face is also classified flipped and slightly rescaled, all the views
+    in the same batch, and the scores are aggregated with tta_policy (one of the utils.aggregate policies)
+    """
+
+    """
+    Input: image_path, or image, the encoded image (e.g. the bytes of an upload), decoded in memory. Either way the
+    image is rotated according to its EXIF orientation
+    """
+
+    """
+    Profiling: with profile=True (or DEEPFAKE_PROFILE=1) the call is run under torch.profiler and a sampling profiler,
+    the traces are written to DEEPFAKE_PROFILE_DIR (see isplutils/profiling.py)
+    """
+
+    """
+    Attention: with return_attention=True the attention map of the face is returned as a third value, a
+    (1, face_size, face_size) heatmap aligned with the face crop, computed in the same forward pass as the score.
+    Only models with attention (EfficientNetAutoAttB4, EfficientNetAutoAttB4ST) provide it
+    """
     device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
     face_policy = 'scale'
     face_size = 224
+    precision = utils.resolve_precision(precision, device)
+    dtype = utils.precision_dtypes[precision]
 
-    model_url = weights.weight_url['{:s}_{:s}'.format(net_model,train_db)]
-    net = getattr(fornet,net_model)().eval().to(device)
-    
-    net.load_state_dict(load_url(model_url,map_location=device,check_hash=True))
+    net = models.classifier(net_model, train_db, device, dtype)
+    if return_attention and not net.supports_attention:
+        raise ValueError('{:s} does not provide attention maps'.format(net_model))
 
-    transf = utils.get_transformer(face_policy, face_size, net.get_normalizer(), train=False)
-    
-    facedet = BlazeFace().to(device)
-    facedet.load_weights("blazeface/blazeface.pth")
+    transf = utils.FaceBatchTransformer(face_policy, face_size, net.get_normalizer(), device=device)
     
-    facedet.load_anchors("blazeface/anchors.npy")
+    facedet = models.face_detector(device, dtype)
     face_extractor = FaceExtractor(facedet=facedet)
-    print(image_path,"image_path")
-    im_real = Image.open(image_path)
+    if image is None:
+        image = image_path
+        if telemetry.enabled():
+            telemetry.count('bytes_read', os.path.getsize(image_path), source='image')
+    elif telemetry.enabled() and isinstance(image, (bytes, bytearray)):
+        telemetry.count('bytes_read', len(image), source='image')
+    im_real = utils.load_image(image)
     im_real_faces = face_extractor.process_image(img=im_real)
-    im_real_face = im_real_faces['faces'][0] # take the face with the highest confidence score found by BlazeFace
-    
-    faces_t = torch.stack( [ transf(image=im)['image'] for im in [im_real_face] ] )
+    if len(im_real_faces['detections']) == 0:
+        raise ValueError('No face found in {}'.format(image_path if image is image_path else 'the image'))
+
+    # take the face with the highest confidence score found by BlazeFace, cropped straight from the image
+    if tta:
+        faces_t = transf.from_frames_tta([im_real], im_real_faces['detections'][:1], [0])
+    else:
+        faces_t = transf.from_frames([im_real], im_real_faces['detections'][:1], [0])
 
     with torch.no_grad():
-        faces_pred = torch.sigmoid(net(faces_t.to(device))).cpu().numpy().flatten()
-    print("hii1")
+        # The final sigmoid always runs in fp32
+        if return_attention:
+            faces_logits, faces_att = net.forward_with_attention(faces_t.to(device, dtype))
+            # With TTA the first view is the original crop
+            faces_att = utils.attention_heatmaps(faces_att[:1], face_size)
+        else:
+            faces_logits = net(faces_t.to(device, dtype))
+        faces_logits = faces_logits.float().cpu().numpy().flatten()
+    if tta:
+        faces_logits = utils.tta_aggregate(faces_logits, 1, tta_policy)
+    faces_pred = expit(faces_logits)
 
              
     if faces_pred.mean()>threshold:
-        return "fake",faces_pred.mean()
+        result = "fake",faces_pred.mean()
     else:
-        return "real",faces_pred.mean()
+        result = "real",faces_pred.mean()
+    if return_attention:
+        return result + (faces_att,)
+    return result
     
     
@@ -10,6 +10,8 @@ Luca Bondi
 Paolo Bestagini
 """
 import os
+import sys
+from collections import defaultdict
 from pathlib import Path
 from typing import List
 
@@ -19,22 +21,106 @@ import pandas as pd
 import torch
 from PIL import Image
 from albumentations.pytorch import ToTensorV2
-from torch.utils.data import Dataset, IterableDataset
+from torch.utils.data import Dataset, IterableDataset, Sampler
+
+from . import telemetry
+from .face_store import FaceStore
+from .utils import extract_bb, extract_bbs, face_crop_boxes
+
+
+def source_paths(df: pd.DataFrame) -> np.ndarray:
+    """
+    Images the faces are extracted from, relative to the faces root folder.
+    Records can share the same image through an optional 'path' column, otherwise each record name is an image
+    :param df: faces DataFrame
+    :return: array of paths, one for each record
+    """
+    if 'path' in df.columns:
+        return df['path'].astype(str).values
+    return np.array([str(name) for name in df.index])
+
+
+def frame_groups(df: pd.DataFrame) -> List[np.ndarray]:
+    """
+    Group the records of a faces DataFrame by source frame: by 'path' if available, by the 'video' and 'frame'
+    columns otherwise, or by record name (faces are named <video>/fr<frame>_subj<subject>.jpg)
+    :param df: faces DataFrame
+    :return: list of arrays of positions in df, one for each frame
+    """
+    if 'path' in df.columns:
+        keys = df['path']
+    elif {'video', 'frame'}.issubset(df.columns):
+        keys = [df['video'], df['frame']]
+    else:
+        keys = pd.Index([str(name) for name in df.index]).str.rsplit('_', n=1).str[0]
+    return list(df.groupby(keys, sort=False, observed=True).indices.values())
 
-from .utils import extract_bb
 
+class FaceRecords:
+    """
+    Contiguous NumPy columns of one or more faces DataFrames, addressed by integer position.
 
-def load_face(record: pd.Series, root: str, size: int, scale: str, transformer: A.BasicTransform) -> torch.Tensor:
-    path = os.path.join(str(root), str(record.name))
-    autocache = size < 256 or scale == 'tight'
+    The datasets compile their DataFrames once at construction, so that loading a sample does not need any pandas
+    lookup. Source paths are interned: each distinct path is stored once and records refer to it by index.
+    """
+
+    def __init__(self, dfs: List[pd.DataFrame]):
+        """
+
+        :param dfs: faces DataFrames, with 'left', 'top', 'right', 'bottom' and 'label' columns
+        """
+        self.names = np.concatenate([np.array([str(name) for name in df.index], dtype=object) for df in dfs])
+        path_table, path_idxs = np.unique(np.concatenate([source_paths(df) for df in dfs]), return_inverse=True)
+        self.path_table = np.array([sys.intern(str(path)) for path in path_table], dtype=object)
+        self.path_idxs = path_idxs.astype(np.int32)
+        self.bbs = np.concatenate([df[['left', 'top', 'right', 'bottom']].values for df in dfs]).astype(np.int32)
+        self.labels = np.concatenate([df['label'].values for df in dfs])
+        self.df_idxs = np.repeat(np.arange(len(dfs), dtype=np.int32), [len(df) for df in dfs])
+
+    def __len__(self):
+        return len(self.names)
+
+    def path(self, pos: int) -> str:
+        return self.path_table[self.path_idxs[pos]]
+
+    def paths(self, positions: np.ndarray) -> np.ndarray:
+        return self.path_table[self.path_idxs[positions]]
+
+
+def load_face(record: pd.Series, root: str, size: int, scale: str, transformer: A.BasicTransform,
+              store: FaceStore = None, slot: int = -1) -> torch.Tensor:
+    return _load_face(name=str(record.name),
+                      path=str(record['path'] if 'path' in record else record.name),
+                      bb=(record['left'], record['top'], record['right'], record['bottom']),
+                      root=root, size=size, scale=scale, transformer=transformer, store=store, slot=slot)
+
+
+def _autocache_path(name: str, root: str, size: int, scale: str) -> str:
     if scale in ['crop', 'scale', ]:
-        cached_path = str(Path(root).joinpath('autocache', scale, str(size), str(record.name)).with_suffix('.jpg'))
-    else:
-        # when self.scale == 'tight' the extracted face is not dependent on size
-        cached_path = str(Path(root).joinpath('autocache', scale, str(record.name)).with_suffix('.jpg'))
+        return str(Path(root).joinpath('autocache', scale, str(size), name).with_suffix('.jpg'))
+    # when self.scale == 'tight' the extracted face is not dependent on size
+    return str(Path(root).joinpath('autocache', scale, name).with_suffix('.jpg'))
+
+
+def _load_face(name: str, path: str, bb: tuple, root: str, size: int, scale: str, transformer: A.BasicTransform,
+               store: FaceStore = None, slot: int = -1) -> torch.Tensor or np.ndarray:
+    """
+    load_face on the fields of a record. With transformer None the raw uint8 face is returned
+    """
+    if store is not None:
+        # Zero-copy view of the packed face, fall back to the JPEG autocache if the slot has not been filled
+        face = store.get(slot)
+        if face is not None:
+            telemetry.count('cache_hits', cache='face_store')
+            return transformer(image=face)['image'] if transformer is not None else face
+
+    path = os.path.join(str(root), path)
+    autocache = size < 256 or scale == 'tight'
+    cached_path = _autocache_path(name, root, size, scale)
 
     face = np.zeros((size, size, 3), dtype=np.uint8)
     if os.path.exists(cached_path):
+        telemetry.count('cache_hits', cache='autocache')
         try:
             face = Image.open(cached_path)
             face = np.array(face)
@@ -50,9 +136,9 @@ def load_face(record: pd.Series, root: str, size: int, scale: str, transformer:
             face = np.zeros((size, size, 3), dtype=np.uint8)
 
     if not os.path.exists(cached_path):
+        telemetry.count('cache_misses', cache='autocache')
         try:
             frame = Image.open(path)
-            bb = record['left'], record['top'], record['right'], record['bottom']
             face = extract_bb(frame, bb=bb, size=size, scale=scale)
 
             if autocache:
@@ -70,11 +156,140 @@ def load_face(record: pd.Series, root: str, size: int, scale: str, transformer:
             print(e)
             face = np.zeros((size, size, 3), dtype=np.uint8)
 
-    face = transformer(image=face)['image']
+    if transformer is not None:
+        face = transformer(image=face)['image']
 
     return face
 
 
+def load_faces(paths: List[str], bbs: np.ndarray, root: str, size: int, scale: str, store: FaceStore = None,
+               slots: np.ndarray = None, draft: bool = False, names: List[str] = None) -> List[np.ndarray]:
+    """
+    Load a batch of faces, decoding each source image once for all the faces it contains.
+    Faces are not transformed. With names, the JPEG autocache is read and written as in load_face, and the faces are
+    the same as load_face's.
+    :param paths: source image of each face, relative to root (see source_paths)
+    :param bbs: (N, 4) bounding boxes (left, top, right, bottom)
+    :param root: root folder for frames cache
+    :param size: face size
+    :param scale: face policy
+    :param store: optional packed face store, faces found in the store are not extracted
+    :param slots: slots of the records in store
+    :param draft: with scale == 'scale', decode JPEG images at 1/2, 1/4 or 1/8 of their size when all their faces
+                  are still at least size pixels wide after the reduction. Faster, but the faces differ slightly
+                  from load_face's, and reduced faces are not written to the autocache
+    :param names: optional face names, to use the autocache
+    :return: list of (height, width, 3) uint8 faces
+    """
+    faces = [None] * len(paths)
+    if store is not None:
+        for pos, slot in enumerate(slots):
+            faces[pos] = store.get(slot)
+    cached_paths = [None] * len(paths)
+    autocache = names is not None and (size < 256 or scale == 'tight')
+    if names is not None:
+        for pos, name in enumerate(names):
+            if faces[pos] is not None:
+                continue
+            cached_paths[pos] = _autocache_path(name, root, size, scale)
+            if os.path.exists(cached_paths[pos]):
+                telemetry.count('cache_hits', cache='autocache')
+                try:
+                    face = np.array(Image.open(cached_paths[pos]))
+                    if len(face.shape) != 3:
+                        raise RuntimeError('Incorrect format: {}'.format(cached_paths[pos]))
+                    faces[pos] = face
+                except KeyboardInterrupt as e:
+                    # We want keybord interrupts to be propagated
+                    raise e
+                except (OSError, IOError) as e:
+                    print('Deleting corrupted cache file: {}'.format(cached_paths[pos]))
+                    print(e)
+                    os.unlink(cached_paths[pos])
+            else:
+                telemetry.count('cache_misses', cache='autocache')
+
+    bbs = np.asarray(bbs)
+    todo = defaultdict(list)
+    for pos, path in enumerate(paths):
+        if faces[pos] is None:
+            todo[path].append(pos)
+
+    for path, positions in todo.items():
+        full_path = os.path.join(str(root), path)
+        try:
+            frame = Image.open(full_path)
+            frame_size = frame.size
+            reduction = 1
+            if draft and scale == 'scale' and frame.format == 'JPEG':
+                boxes = face_crop_boxes(frame_size[1], frame_size[0], bbs[positions], scale, size)
+                min_side = np.min(np.minimum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]))
+                reduction = max([1] + [r for r in (2, 4, 8) if min_side // r >= size])
+                if reduction > 1:
+                    frame.draft('RGB', (-(-frame_size[0] // reduction), -(-frame_size[1] // reduction)))
+            for pos, face in zip(positions, extract_bbs(frame, bbs[positions], scale, size, frame_size=frame_size)):
+                if autocache and reduction == 1:
+                    os.makedirs(os.path.dirname(cached_paths[pos]), exist_ok=True)
+                    face.save(cached_paths[pos], quality=95, subsampling='4:4:4')
+                faces[pos] = np.array(face)
+                if len(faces[pos].shape) != 3:
+                    raise RuntimeError('Incorrect format: {}'.format(full_path))
+        except KeyboardInterrupt as e:
+            # We want keybord interrupts to be propagated
+            raise e
+        except (OSError, IOError, RuntimeError) as e:
+            print('Error while reading: {}'.format(full_path))
+            print(e)
+            for pos in positions:
+                faces[pos] = np.zeros((size, size, 3), dtype=np.uint8)
+
+    return faces
+
+
+class FrameGroupedBatchSampler(Sampler):
+    """
+    Batch sampler that keeps the faces of the same source frame in the same batch, so that batched loading
+    (FrameFaceDatasetTest.__getitems__) decodes each frame once. Groups are shuffled, not their faces.
+    """
+
+    def __init__(self, df: pd.DataFrame, batch_size: int, shuffle: bool = False, drop_last: bool = False,
+                 seed: int = None):
+        """
+
+        :param df: faces DataFrame of the dataset
+        :param batch_size:
+        :param shuffle: shuffle the order of the frames at every epoch
+        :param drop_last: drop the last incomplete batch
+        :param seed: seed for shuffling, combined with the epoch set with set_epoch
+        """
+        self.groups = frame_groups(df)
+        self.num_samples = len(df)
+        self.batch_size = int(batch_size)
+        self.shuffle = bool(shuffle)
+        self.drop_last = bool(drop_last)
+        self.seed = int(seed) if seed is not None else np.random.choice(2 ** 32)
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = int(epoch)
+
+    def __iter__(self):
+        order = np.arange(len(self.groups))
+        if self.shuffle:
+            order = np.random.RandomState((self.seed + self.epoch) % 2 ** 32).permutation(order)
+        positions = np.concatenate([self.groups[idx] for idx in order] + [np.zeros(0, dtype=np.int64)])
+        for start in range(0, len(positions), self.batch_size):
+            batch = positions[start:start + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                break
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
 class FrameFaceIterableDataset(IterableDataset):
 
     def __init__(self,
@@ -85,7 +300,10 @@ class FrameFaceIterableDataset(IterableDataset):
                  transformer: A.BasicTransform = ToTensorV2(),
                  output_index: bool = False,
                  labels_map: dict = None,
-                 seed: int = None):
+                 seed: int = None,
+                 face_stores: List[FaceStore] = None,
+                 rank: int = None,
+                 world_size: int = None):
         """
 
         :param roots: List of root folders for frames cache
@@ -98,6 +316,9 @@ class FrameFaceIterableDataset(IterableDataset):
         :param transformer:
         :param output_index: enable output of df_frames index
         :param labels_map: map from 'REAL' and 'FAKE' to actual labels
+        :param face_stores: optional list of packed face stores, one for each root (None entries are allowed)
+        :param rank: distributed rank, from torch.distributed if initialized
+        :param world_size: number of distributed ranks, from torch.distributed if initialized
         """
 
         self.dfs = dfs
@@ -105,19 +326,16 @@ class FrameFaceIterableDataset(IterableDataset):
 
         self.seed0 = int(seed) if seed is not None else np.random.choice(2 ** 32)
 
-        # adapt indices
-        dfs_adapted = [df.copy() for df in self.dfs]
-        for df_idx, df in enumerate(dfs_adapted):
-            mi = pd.MultiIndex.from_tuples([(df_idx, key) for key in df.index], names=['df_idx', 'df_key'])
-            df.index = mi
-        # Concat
-        self.df = pd.concat(dfs_adapted, axis=0, join='inner')
+        # Concat, rows are addressed by their integer position in the compiled records
+        self.df = pd.concat(self.dfs, axis=0, join='inner', ignore_index=True)
+        self.records = FaceRecords(self.dfs)
 
-        self.df_real = self.df[self.df['label'] == 0]
-        self.df_fake = self.df[self.df['label'] == 1]
+        self.sampler = RealFakeSampler(real_positions=np.flatnonzero(self.records.labels == 0),
+                                       fake_positions=np.flatnonzero(self.records.labels == 1),
+                                       seed=self.seed0, rank=rank, world_size=world_size)
 
-        self.longer_set = 'real' if len(self.df_real) > len(self.df_fake) else 'fake'
-        self.num_samples = max(len(self.df_real), len(self.df_fake)) * 2
+        self.longer_set = self.sampler.longer_set
+        self.num_samples = max(len(self.sampler.real_positions), len(self.sampler.fake_positions)) * 2
         self.num_samples = min(self.num_samples, num_samples) if num_samples > 0 else self.num_samples
 
         self.output_idx = bool(output_index)
@@ -126,76 +344,134 @@ class FrameFaceIterableDataset(IterableDataset):
         self.roots = [str(r) for r in roots]
         self.transformer = transformer
 
+        self.face_stores = list(face_stores) if face_stores is not None else [None] * len(self.dfs)
+        self.store_slots = np.concatenate([store.slots(df.index) if store is not None else np.full(len(df), -1)
+                                           for df, store in zip(self.dfs, self.face_stores)]).astype(np.int64)
+
         self.labels_map = labels_map
         if self.labels_map is None:
             self.labels_map = {False: np.array([0., ]), True: np.array([1., ])}
         else:
             self.labels_map = dict(self.labels_map)
 
-    def _get_face(self, item: pd.Index) -> (torch.Tensor, torch.Tensor) or (torch.Tensor, torch.Tensor, str):
+    def _get_face(self, item: int) -> (torch.Tensor, torch.Tensor) or (torch.Tensor, torch.Tensor, str):
 
-        record = self.dfs[item[0]].loc[item[1]]
-        face = load_face(record=record,
-                         root=self.roots[item[0]],
-                         size=self.size,
-                         scale=self.scale,
-                         transformer=self.transformer)
+        df_idx = self.records.df_idxs[item]
+        face = _load_face(name=self.records.names[item],
+                          path=self.records.path(item),
+                          bb=tuple(self.records.bbs[item].tolist()),
+                          root=self.roots[df_idx],
+                          size=self.size,
+                          scale=self.scale,
+                          transformer=self.transformer,
+                          store=self.face_stores[df_idx],
+                          slot=self.store_slots[item])
 
-        label = self.labels_map[record.label]
+        label = self.labels_map[self.records.labels[item]]
         if self.output_idx:
-            return face, label, record.name
+            return face, label, self.records.names[item]
         else:
             return face, label
 
     def __len__(self):
-        return self.num_samples
+        return self.num_samples // self.sampler.world_size
+
+    def set_epoch(self, epoch: int):
+        """
+        Draw a different sampling at every epoch. Must be called before iterating, as with DistributedSampler;
+        with persistent DataLoader workers the epoch is only seen by newly started workers
+        """
+        self.sampler.set_epoch(epoch)
 
     def __iter__(self):
+        fake_idxs, real_idxs = self.sampler.sample(self.num_samples)
+        for fake_idx, real_idx in zip(fake_idxs, real_idxs):
+            yield self._get_face(fake_idx)
+            yield self._get_face(real_idx)
 
-        random_fake_idxs, random_real_idxs = get_iterative_real_fake_idxs(
-            df_real=self.df_real,
-            df_fake=self.df_fake,
-            num_samples=self.num_samples,
-            seed0=self.seed0
-        )
 
-        while len(random_fake_idxs) >= 1 and len(random_real_idxs) >= 1:
-            yield self._get_face(random_fake_idxs.pop())
-            yield self._get_face(random_real_idxs.pop())
+class RealFakeSampler:
+    """
+    Balanced sampling of real and fake faces, by integer position.
 
+    Each epoch, a random subset of the longer class is drawn without replacement and split among all the shards,
+    one for each DataLoader worker of each distributed rank. Each shard pairs its part with faces of the shorter
+    class drawn with replacement from its own numpy.random.Generator stream. Streams are seeded with
+    (seed, epoch[, shard]), so every epoch gets a different sampling without re-creating the dataset.
+    """
 
-def get_iterative_real_fake_idxs(df_real: pd.DataFrame, df_fake: pd.DataFrame,
-                                 num_samples: int, seed0: int):
-    longer_set = 'real' if len(df_real) > len(df_fake) else 'fake'
-    worker_info = torch.utils.data.get_worker_info()
-    if worker_info is None:
-        seed = seed0
-        np.random.seed(seed)
-        worker_num_couple_samples = num_samples // 2
-        fake_idxs_portion = np.random.choice(df_fake.index, worker_num_couple_samples,
-                                             replace=longer_set == 'real')
-        real_idxs_portion = np.random.choice(df_real.index, worker_num_couple_samples,
-                                             replace=longer_set == 'fake')
-    else:
-        worker_id = worker_info.id
-        seed = seed0 + worker_id
-        np.random.seed(seed)
-        worker_num_couple_samples = (num_samples // 2) // worker_info.num_workers
-        if longer_set == 'fake':
-            fake_idxs_portion = df_fake.index[
-                                worker_id * worker_num_couple_samples:(worker_id + 1) * worker_num_couple_samples]
-            real_idxs_portion = np.random.choice(df_real.index, worker_num_couple_samples, replace=True)
+    def __init__(self, real_positions: np.ndarray, fake_positions: np.ndarray, seed: int, rank: int = None,
+                 world_size: int = None):
+        """
+
+        :param real_positions: positions of the real faces
+        :param fake_positions: positions of the fake faces
+        :param seed:
+        :param rank: distributed rank, from torch.distributed if initialized
+        :param world_size: number of distributed ranks, from torch.distributed if initialized
+        """
+        # int32 positions halve the memory of the index arrays for tables up to 2^31 faces
+        self.real_positions = np.asarray(real_positions)
+        self.fake_positions = np.asarray(fake_positions)
+        if max(len(self.real_positions), len(self.fake_positions)) and max(
+                self.real_positions.max(initial=0), self.fake_positions.max(initial=0)) < 2 ** 31:
+            self.real_positions = self.real_positions.astype(np.int32)
+            self.fake_positions = self.fake_positions.astype(np.int32)
+        self.longer_set = 'real' if len(self.real_positions) > len(self.fake_positions) else 'fake'
+        self.seed = int(seed)
+        self.epoch = 0
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.rank = int(rank) if rank is not None else (torch.distributed.get_rank() if distributed else 0)
+        self.world_size = int(world_size) if world_size is not None else (
+            torch.distributed.get_world_size() if distributed else 1)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = int(epoch)
+
+    def shard(self) -> (int, int):
+        """
+        :return: index of the shard of the calling DataLoader worker, number of shards
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        return self.rank * num_workers + worker_id, self.world_size * num_workers
+
+    def sample(self, num_samples: int) -> (np.ndarray, np.ndarray):
+        """
+        Positions for the calling shard
+        :param num_samples: number of real and fake samples across all the shards
+        :return: fake positions, real positions, of the same length
+        """
+        shard, num_shards = self.shard()
+        if self.longer_set == 'real':
+            longer, shorter = self.real_positions, self.fake_positions
         else:
-            real_idxs_portion = df_real.index[
-                                worker_id * worker_num_couple_samples:(worker_id + 1) * worker_num_couple_samples]
-            fake_idxs_portion = np.random.choice(df_fake.index, worker_num_couple_samples,
-                                                 replace=True)
-    random_fake_idxs = list(np.random.permutation(fake_idxs_portion))
-    random_real_idxs = list(np.random.permutation(real_idxs_portion))
+            longer, shorter = self.fake_positions, self.real_positions
+        num_couples = min(num_samples // 2, len(longer))
+        if len(shorter) == 0:
+            num_couples = 0
+
+        # Same draw on all the shards, each shard takes every num_shards-th element
+        longer_idxs = np.random.default_rng([self.seed, self.epoch]).choice(len(longer), num_couples, replace=False)
+        longer_idxs = longer[longer_idxs[shard::num_shards]]
+        shard_rng = np.random.default_rng([self.seed, self.epoch, shard])
+        shorter_idxs = shorter[shard_rng.integers(0, max(len(shorter), 1), len(longer_idxs))]
 
-    assert (len(random_fake_idxs) == len(random_real_idxs))
+        if self.longer_set == 'real':
+            return shorter_idxs, longer_idxs
+        return longer_idxs, shorter_idxs
 
-    return random_fake_idxs, random_real_idxs
+
+def get_iterative_real_fake_idxs(df_real: pd.DataFrame, df_fake: pd.DataFrame,
+                                 num_samples: int, seed0: int):
+    """
+    Wrapper of RealFakeSampler working on DataFrame indexes
+    :return: list of fake indexes, list of real indexes, of the same length
+    """
+    sampler = RealFakeSampler(real_positions=np.arange(len(df_real)), fake_positions=np.arange(len(df_fake)),
+                              seed=seed0)
+    fake_positions, real_positions = sampler.sample(num_samples)
+    return list(df_fake.index[fake_positions]), list(df_real.index[real_positions])
 
 
 class FrameFaceDatasetTest(Dataset):
@@ -204,7 +480,9 @@ class FrameFaceDatasetTest(Dataset):
                  size: int, scale: str,
                  transformer: A.BasicTransform = ToTensorV2(),
                  labels_map: dict = None,
-                 aug_transformers: List[A.BasicTransform] = None):
+                 aug_transformers: List[A.BasicTransform] = None,
+                 face_store: FaceStore = None,
+                 draft: bool = False):
         """
 
         :param root: root folder for frames cache
@@ -217,6 +495,9 @@ class FrameFaceDatasetTest(Dataset):
         :param transformer:
         :param labels_map: dcit to map df labels
         :param aug_transformers: if not None, creates multiple copies of the same sample according to the provided augmentations
+        :param face_store: optional packed face store for root
+        :param draft: allow reduced-size JPEG decoding in batched loading, see load_faces. Off by default: batches
+                      then match __getitem__, autocache included
         """
 
         self.df = df
@@ -226,6 +507,14 @@ class FrameFaceDatasetTest(Dataset):
         self.root = str(root)
         self.transformer = transformer
         self.aug_transformers = aug_transformers
+        # Test-time augmentation pipelines are built once, each face is loaded once and augmented in memory
+        self.aug_pipelines = [A.Compose([aug_transf, self.transformer]) for aug_transf in
+                              aug_transformers] if aug_transformers is not None else None
+
+        self.records = FaceRecords([df])
+        self.face_store = face_store
+        self.store_slots = face_store.slots(df.index) if face_store is not None else np.full(len(df), -1)
+        self.draft = bool(draft)
 
         self.labels_map = labels_map
         if self.labels_map is None:
@@ -233,31 +522,42 @@ class FrameFaceDatasetTest(Dataset):
         else:
             self.labels_map = dict(self.labels_map)
 
-    def _get_face(self, item: pd.Index) -> (torch.Tensor, torch.Tensor) or (torch.Tensor, torch.Tensor, str):
-        record = self.df.loc[item]
-        label = self.labels_map[record.label]
-        if self.aug_transformers is None:
-            face = load_face(record=record,
-                             root=self.root,
-                             size=self.size,
-                             scale=self.scale,
-                             transformer=self.transformer)
-            return face, label
-        else:
-            faces = []
-            for aug_transf in self.aug_transformers:
-                faces.append(
-                    load_face(record=record,
-                              root=self.root,
-                              size=self.size,
-                              scale=self.scale,
-                              transformer=A.Compose([aug_transf, self.transformer])
-                              ))
-            faces = torch.stack(faces)
-            return faces, label
+    def _transform(self, face: np.ndarray) -> torch.Tensor:
+        if self.aug_pipelines is None:
+            return self.transformer(image=face)['image']
+        return torch.stack([pipeline(image=face)['image'] for pipeline in self.aug_pipelines])
+
+    def _get_face(self, item: int) -> (torch.Tensor, torch.Tensor):
+        face = _load_face(name=self.records.names[item],
+                          path=self.records.path(item),
+                          bb=tuple(self.records.bbs[item].tolist()),
+                          root=self.root,
+                          size=self.size,
+                          scale=self.scale,
+                          transformer=None,
+                          store=self.face_store,
+                          slot=self.store_slots[item])
+        return self._transform(face), self.labels_map[self.records.labels[item]]
 
     def __len__(self):
         return len(self.df)
 
     def __getitem__(self, item):
-        return self._get_face(self.df.index[item])
+        return self._get_face(item)
+
+    def __getitems__(self, items: List[int]) -> list:
+        """
+        Batched loading, called by the DataLoader with the indices of a whole batch.
+        Each source frame is decoded once, see load_faces and FrameGroupedBatchSampler
+        """
+        faces = load_faces(self.records.paths(items),
+                           self.records.bbs[items],
+                           root=self.root,
+                           size=self.size,
+                           scale=self.scale,
+                           store=self.face_store,
+                           slots=self.store_slots[items],
+                           draft=self.draft,
+                           names=self.records.names[items])
+        return [(self._transform(face), self.labels_map[label])
+                for face, label in zip(faces, self.records.labels[items])]
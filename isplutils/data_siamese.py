@@ -12,10 +12,101 @@ Paolo Bestagini
 from typing import List
 
 import albumentations as A
+import numpy as np
 import pandas as pd
+import torch
 from albumentations.pytorch import ToTensorV2
 
-from .data import FrameFaceIterableDataset, get_iterative_real_fake_idxs
+from .data import FrameFaceIterableDataset
+from .face_store import FaceStore
+
+
+class EmbeddingBank:
+    """
+    In-memory embeddings of the faces of a dataset, addressed by record position.
+
+    The bank lives in shared memory, so DataLoader workers forked after its creation see every refresh made by the
+    training process. Refresh it periodically from the training loop, e.g. every few hundred iterations:
+
+        bank = EmbeddingBank(len(dataset.records), dim=1792)
+        dataset = FrameFaceTripletIterableDataset(..., embedding_bank=bank)
+        ...
+        if iteration % 500 == 0:
+            bank.refresh(net, dataset, num_records=20000)
+
+    Positions that have never been embedded are marked as not valid and are not used for mining.
+    """
+
+    def __init__(self, num_records: int, dim: int):
+        """
+
+        :param num_records: number of records of the dataset
+        :param dim: size of the embeddings
+        """
+        self.embeddings = torch.zeros((num_records, dim), dtype=torch.float32).share_memory_()
+        self.valid = torch.zeros(num_records, dtype=torch.bool).share_memory_()
+        self._refresh_step = 0
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def update(self, positions: np.ndarray, embeddings: torch.Tensor):
+        """
+        Write the embeddings of some records, e.g. the anchors, positives and negatives of a training batch
+        :param positions: record positions
+        :param embeddings: (len(positions), dim) tensor
+        """
+        positions = torch.as_tensor(np.asarray(positions, dtype=np.int64))
+        self.embeddings[positions] = embeddings.detach().float().cpu()
+        self.valid[positions] = True
+
+    def refresh(self, net: torch.nn.Module, dataset: FrameFaceIterableDataset, num_records: int = None,
+                batch_size: int = 64, device: torch.device = None):
+        """
+        Embed a random subset of the records with the current network, a different subset at each call.
+        Faces are loaded as the dataset serves them, with its transformer
+        :param net: network with a features() method, e.g. a TripletNet
+        :param dataset: dataset the bank refers to
+        :param num_records: number of records to embed, all by default
+        :param batch_size:
+        :param device: device of the network, inferred from its parameters by default
+        """
+        if device is None:
+            device = next(net.parameters()).device
+        rng = np.random.default_rng([dataset.seed0, self._refresh_step])
+        self._refresh_step += 1
+        positions = rng.permutation(len(self))[:num_records]
+        was_training = net.training
+        net.eval()
+        with torch.no_grad():
+            for start in range(0, len(positions), batch_size):
+                batch = positions[start:start + batch_size]
+                faces = torch.stack([dataset._get_face(pos)[0] for pos in batch])
+                self.update(batch, net.features(faces.to(device)))
+        net.train(was_training)
+
+    def mine_negatives(self, anchors: np.ndarray, positives: np.ndarray, candidates: np.ndarray,
+                       margin: float) -> np.ndarray:
+        """
+        Pick a semi-hard negative for each triplet: the closest candidate to the anchor that is farther than the
+        positive, within margin. Triplets without a semi-hard candidate, or whose anchor and positive have not
+        been embedded, keep their first candidate.
+        :param anchors: (N,) anchor positions
+        :param positives: (N,) positive positions
+        :param candidates: (N, K) negative candidate positions
+        :param margin: triplet loss margin
+        :return: (N,) negative positions
+        """
+        embeddings = self.embeddings.numpy()
+        valid = self.valid.numpy()
+        a = embeddings[anchors]
+        d_ap = np.linalg.norm(a - embeddings[positives], axis=1)
+        d_an = np.linalg.norm(a[:, None] - embeddings[candidates], axis=2)
+        semi_hard = (d_an > d_ap[:, None]) & (d_an < d_ap[:, None] + margin) & valid[candidates]
+        semi_hard &= (valid[anchors] & valid[positives])[:, None]
+        choice = np.where(semi_hard, d_an, np.inf).argmin(axis=1)
+        choice[~semi_hard.any(axis=1)] = 0
+        return candidates[np.arange(len(candidates)), choice]
 
 
 class FrameFaceTripletIterableDataset(FrameFaceIterableDataset):
@@ -27,7 +118,14 @@ class FrameFaceTripletIterableDataset(FrameFaceIterableDataset):
                  scale: str,
                  num_triplets: int = -1,
                  transformer: A.BasicTransform = ToTensorV2(),
-                 seed: int = None):
+                 seed: int = None,
+                 face_stores: List[FaceStore] = None,
+                 rank: int = None,
+                 world_size: int = None,
+                 embedding_bank: EmbeddingBank = None,
+                 mining_candidates: int = 16,
+                 mining_margin: float = 1.,
+                 mining_chunk: int = 128):
         """
 
         :param roots: List of root folders for frames cache
@@ -40,6 +138,14 @@ class FrameFaceTripletIterableDataset(FrameFaceIterableDataset):
                       If false crop around center to the given size
         :param transformer:
         :param seed:
+        :param face_stores: optional list of packed face stores, one for each root
+        :param rank: distributed rank, from torch.distributed if initialized
+        :param world_size: number of distributed ranks, from torch.distributed if initialized
+        :param embedding_bank: optional embeddings of the records, to mine semi-hard negatives. Random negatives
+                               are used without it
+        :param mining_candidates: negatives drawn for each triplet, among which the semi-hard one is mined
+        :param mining_margin: triplet loss margin, defines the semi-hard negatives
+        :param mining_chunk: triplets mined at once, each chunk is mined from the bank as refreshed so far
         """
         super(FrameFaceTripletIterableDataset, self).__init__(
             roots=roots,
@@ -48,31 +154,60 @@ class FrameFaceTripletIterableDataset(FrameFaceIterableDataset):
             scale=scale,
             num_samples=num_triplets * 3,
             transformer=transformer,
-            seed=seed
+            seed=seed,
+            face_stores=face_stores,
+            rank=rank,
+            world_size=world_size
         )
 
         self.num_triplet_couples = self.num_samples // 6
         self.num_triplets = self.num_triplet_couples * 2
         self.num_samples = self.num_triplets * 3
 
+        self.embedding_bank = embedding_bank
+        self.mining_candidates = int(mining_candidates)
+        self.mining_margin = float(mining_margin)
+        self.mining_chunk = int(mining_chunk)
+
+    def _mine(self, anchors: np.ndarray, positives: np.ndarray, negatives: np.ndarray, fake_anchor: np.ndarray,
+              rng: np.random.Generator) -> np.ndarray:
+        """
+        Replace the random negatives with semi-hard negatives mined from the embedding bank
+        :param anchors: anchor positions
+        :param positives: positive positions
+        :param negatives: random negative positions, used as first candidates
+        :param fake_anchor: True for the triplets whose anchor is fake
+        :param rng: generator of the other candidates
+        :return: negative positions
+        """
+        real, fake = self.sampler.real_positions, self.sampler.fake_positions
+        candidates = np.empty((len(anchors), self.mining_candidates), dtype=np.int64)
+        candidates[:, 0] = negatives
+        num_other = self.mining_candidates - 1
+        candidates[fake_anchor, 1:] = real[rng.integers(0, len(real), (fake_anchor.sum(), num_other))]
+        candidates[~fake_anchor, 1:] = fake[rng.integers(0, len(fake), ((~fake_anchor).sum(), num_other))]
+        return self.embedding_bank.mine_negatives(anchors, positives, candidates, self.mining_margin)
+
     def __len__(self):
-        return self.num_triplets
+        return self.num_triplets // self.sampler.world_size
 
     def __iter__(self):
-        random_fake_idxs, random_real_idxs = get_iterative_real_fake_idxs(
-            df_real=self.df_real,
-            df_fake=self.df_fake,
-            num_samples=self.num_samples,
-            seed0=self.seed0
-        )
+        fake_idxs, real_idxs = self.sampler.sample(self.num_samples)
 
-        while len(random_fake_idxs) >= 3 and len(random_real_idxs) >= 3:
-            a = self._get_face(random_fake_idxs.pop())[0]
-            p = self._get_face(random_fake_idxs.pop())[0]
-            n = self._get_face(random_real_idxs.pop())[0]
-            yield a, p, n
+        # Triplets alternate a fake anchor and positive with a real negative, and the other way around
+        starts = np.arange(0, len(fake_idxs) - 2, 3)
+        anchors = np.stack((fake_idxs[starts], real_idxs[starts + 1]), axis=1).ravel()
+        positives = np.stack((fake_idxs[starts + 1], real_idxs[starts + 2]), axis=1).ravel()
+        negatives = np.stack((real_idxs[starts], fake_idxs[starts + 2]), axis=1).ravel()
+        fake_anchor = np.tile([True, False], len(starts))
 
-            a = self._get_face(random_real_idxs.pop())[0]
-            p = self._get_face(random_real_idxs.pop())[0]
-            n = self._get_face(random_fake_idxs.pop())[0]
-            yield a, p, n
+        shard, _ = self.sampler.shard()
+        rng = np.random.default_rng([self.sampler.seed, self.sampler.epoch, shard, 1])
+        for start in range(0, len(anchors), self.mining_chunk):
+            chunk = slice(start, start + self.mining_chunk)
+            chunk_negatives = negatives[chunk]
+            if self.embedding_bank is not None and self.mining_candidates > 1:
+                chunk_negatives = self._mine(anchors[chunk], positives[chunk], chunk_negatives, fake_anchor[chunk],
+                                             rng)
+            for a, p, n in zip(anchors[chunk], positives[chunk], chunk_negatives):
+                yield self._get_face(a)[0], self._get_face(p)[0], self._get_face(n)[0]
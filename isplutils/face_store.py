@@ -0,0 +1,198 @@
+"""
+Video Face Manipulation Detection Through Ensemble of CNNs
+
+Image and Sound Processing Lab - Politecnico di Milano
+
+Nicolò Bonettini
+Edoardo Daniele Cannas
+Sara Mandelli
+Luca Bondi
+Paolo Bestagini
+"""
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable
+
+import numpy as np
+import pandas as pd
+
+store_policies = ['scale', 'crop', ]
+
+
+def face_store_path(root: str, scale: str, size: int) -> Path:
+    """
+    Default location of the face store of a faces root folder, next to the JPEG autocache
+    :param root: root folder for frames cache
+    :param scale: face policy
+    :param size: face size
+    :return:
+    """
+    return Path(root).joinpath('facestore', scale, str(size))
+
+
+class PackedStore:
+    """
+    Base of the packed stores: arrays memory-mapped from .npy files, with one row (slot) per record name.
+
+    names.npy holds the record names of the slots and filled.npy marks the slots that have been written. Subclasses
+    list the names of their other arrays in arrays, each memory-mapped from <name>.npy into self._<name>.
+    """
+    arrays = ()
+    description = 'Store'
+
+    def __init__(self, path: str or Path, mode: str):
+        """
+        Open an existing store
+        :param path: folder of the store
+        :param mode: memory map mode of the arrays, 'r+' to fill the store
+        """
+        self.path = Path(path)
+        self.mode = mode
+        if not self.path.joinpath('names.npy').exists():
+            raise FileNotFoundError('{} not found: {}'.format(self.description, self.path))
+        self.names = pd.Index([name.decode('utf-8') for name in np.load(self.path.joinpath('names.npy'))])
+        for name in self.arrays + ('filled',):
+            setattr(self, '_' + name, None)
+
+    @classmethod
+    def _create(cls, path: str or Path, names: Iterable[str], layout: Dict[str, tuple],
+                matches: Callable[['PackedStore'], bool]) -> 'PackedStore':
+        """
+        Create an empty store, or open the existing one if it holds the same names
+        :param path: folder of the store
+        :param names: record names, usually the index of the faces DataFrame
+        :param layout: dtype and shape of each array, without the slots dimension
+        :param matches: whether an existing store has the same layout
+        :return: the store, open for writing
+        """
+        path = Path(path)
+        names = pd.Index([str(name) for name in names])
+        if not names.is_unique:
+            raise ValueError('{} names must be unique'.format(cls.description))
+        if path.joinpath('names.npy').exists():
+            store = cls(path, mode='r+')
+            if not matches(store) or not store.names.equals(names):
+                raise ValueError('A different {} already exists in {}'.format(cls.description.lower(), path))
+            return store
+
+        os.makedirs(path, exist_ok=True)
+        for name, (dtype, shape) in dict(layout, filled=(bool, ())).items():
+            np.lib.format.open_memmap(path.joinpath(name + '.npy'), mode='w+', dtype=dtype,
+                                      shape=(len(names),) + shape).flush()
+        # Names are written last, their presence marks a complete store layout
+        np.save(path.joinpath('names.npy'), np.array([name.encode('utf-8') for name in names]))
+        return cls(path, mode='r+')
+
+    def _open(self):
+        if self._filled is None:
+            for name in self.arrays + ('filled',):
+                setattr(self, '_' + name, np.load(self.path.joinpath(name + '.npy'), mmap_mode=self.mode))
+
+    def __getstate__(self):
+        # Memory maps are reopened in each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        for name in self.arrays + ('filled',):
+            state['_' + name] = None
+        return state
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def filled(self) -> np.ndarray:
+        self._open()
+        return self._filled
+
+    def slots(self, names: Iterable[str]) -> np.ndarray:
+        """
+        Slots of the given record names
+        :param names: record names, e.g. the index of a split DataFrame
+        :return: int array, -1 for the names not in the store
+        """
+        return self.names.get_indexer([str(name) for name in names])
+
+    def flush(self):
+        if self._filled is not None and self.mode == 'r+':
+            for name in self.arrays + ('filled',):
+                getattr(self, '_' + name).flush()
+
+
+class FaceStore(PackedStore):
+    """
+    Packed store of the faces extracted with a given policy and size.
+
+    All the faces live in a single uint8 array of shape (num_faces, size, size, 3), memory-mapped from faces.npy.
+    Each record name of the faces DataFrame is assigned a slot; shapes.npy holds the actual height and width of each
+    face (a 'crop' face can be smaller than size x size near the frame border) and filled.npy marks the slots that
+    have been written. Only policies that produce faces of bounded size ('scale' and 'crop') can be stored.
+
+    Faces are returned as views of the memory map, opened copy-on-write so that transformations can modify them in
+    place without touching the file.
+    """
+    arrays = ('faces', 'shapes')
+    description = 'Face store'
+
+    def __init__(self, path: str or Path, mode: str = 'c'):
+        """
+        Open an existing face store
+        :param path: folder of the store
+        :param mode: 'c' to read (copy-on-write), 'r+' to fill the store
+        """
+        super(FaceStore, self).__init__(path, mode)
+
+    @classmethod
+    def create(cls, path: str or Path, names: Iterable[str], size: int) -> 'FaceStore':
+        """
+        Create an empty face store, or open the existing one if it holds the same names
+        :param path: folder of the store
+        :param names: record names, usually the index of the faces DataFrame
+        :param size: face size
+        :return: the store, open for writing
+        """
+        return cls._create(path, names, {'faces': (np.uint8, (size, size, 3)), 'shapes': (np.uint16, (2,))},
+                           lambda store: store.size == size)
+
+    @property
+    def size(self) -> int:
+        self._open()
+        return self._faces.shape[1]
+
+    def get(self, slot: int) -> np.ndarray or None:
+        """
+        Zero-copy view of a face
+        :param slot:
+        :return: (height, width, 3) uint8 array, None if the slot has not been filled
+        """
+        self._open()
+        if slot < 0 or not self._filled[slot]:
+            return None
+        height, width = self._shapes[slot]
+        return self._faces[slot, :height, :width]
+
+    def put(self, slot: int, face: np.ndarray):
+        """
+        Write a face into its slot
+        :param slot:
+        :param face: (height, width, 3) uint8 array, at most size x size
+        """
+        self._open()
+        face = np.asarray(face)
+        if face.ndim != 3 or face.shape[0] > self.size or face.shape[1] > self.size:
+            raise ValueError('Face of shape {} does not fit a store of size {}'.format(face.shape, self.size))
+        self._faces[slot, :face.shape[0], :face.shape[1]] = face
+        self._shapes[slot] = face.shape[:2]
+        self._filled[slot] = True
+
+
+def open_face_store(root: str, scale: str, size: int) -> FaceStore or None:
+    """
+    Open the face store of a faces root folder, if it has been built
+    :param root: root folder for frames cache
+    :param scale: face policy
+    :param size: face size
+    :return: the store, None if missing or if the policy cannot be stored
+    """
+    path = face_store_path(root, scale, size)
+    if scale not in store_policies or not path.joinpath('names.npy').exists():
+        return None
+    return FaceStore(path)
@@ -0,0 +1,95 @@
+"""
+Video Face Manipulation Detection Through Ensemble of CNNs
+
+Image and Sound Processing Lab - Politecnico di Milano
+
+Nicolò Bonettini
+Edoardo Daniele Cannas
+Sara Mandelli
+Luca Bondi
+Paolo Bestagini
+"""
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from .face_store import PackedStore
+
+
+def feature_store_path(root: str, tag: str, scale: str, size: int) -> Path:
+    """
+    Default location of the feature store of a faces root folder, next to the face stores
+    :param root: root folder for frames cache
+    :param tag: backbone identifier, e.g. network name and weights
+    :param scale: face policy
+    :param size: face size
+    :return:
+    """
+    return Path(root).joinpath('featurestore', tag, scale, str(size))
+
+
+class FeatureStore(PackedStore):
+    """
+    Packed store of the backbone features of the faces of a root folder.
+
+    Features live in a single array of shape (num_faces, dim), memory-mapped from features.npy. As in FaceStore,
+    each record name of the faces DataFrame is assigned a slot and filled.npy marks the slots that have been
+    written. Features are stored in float16 by default, the heads are trained in float32.
+    """
+    arrays = ('features',)
+    description = 'Feature store'
+
+    def __init__(self, path: str or Path, mode: str = 'r'):
+        """
+        Open an existing feature store
+        :param path: folder of the store
+        :param mode: 'r' to read, 'r+' to fill the store
+        """
+        super(FeatureStore, self).__init__(path, mode)
+
+    @classmethod
+    def create(cls, path: str or Path, names: Iterable[str], dim: int, dtype: str = 'float16') -> 'FeatureStore':
+        """
+        Create an empty feature store, or open the existing one if it holds the same names
+        :param path: folder of the store
+        :param names: record names, usually the index of the faces DataFrame
+        :param dim: size of the features
+        :param dtype: storage type of the features
+        :return: the store, open for writing
+        """
+        return cls._create(path, names, {'features': (dtype, (dim,))},
+                           lambda store: store.dim == dim and store.dtype == np.dtype(dtype))
+
+    @property
+    def dim(self) -> int:
+        self._open()
+        return self._features.shape[1]
+
+    @property
+    def dtype(self) -> np.dtype:
+        self._open()
+        return self._features.dtype
+
+    def get(self, slots: np.ndarray) -> np.ndarray:
+        """
+        Features of a set of slots, all of them must have been filled
+        :param slots:
+        :return: (len(slots), dim) float32 array
+        """
+        self._open()
+        slots = np.asarray(slots)
+        if (slots < 0).any() or not self._filled[slots].all():
+            raise ValueError('{:d} features have not been extracted'.format(
+                ((slots < 0) | ~self._filled[np.maximum(slots, 0)]).sum()))
+        return np.asarray(self._features[slots], dtype=np.float32)
+
+    def put(self, slots: np.ndarray, features: np.ndarray):
+        """
+        Write the features of a batch of slots
+        :param slots:
+        :param features: (len(slots), dim) array
+        """
+        self._open()
+        self._features[slots] = features
+        self._filled[slots] = True
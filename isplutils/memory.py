@@ -0,0 +1,310 @@
+"""
+Video Face Manipulation Detection Through Ensemble of CNNs
+
+Image and Sound Processing Lab - Politecnico di Milano
+
+Nicolò Bonettini
+Edoardo Daniele Cannas
+Sara Mandelli
+Luca Bondi
+Paolo Bestagini
+
+Memory budgeting of video requests: plan_video() fits a request in the memory budget by decoding the frames in
+chunks, or reading fewer frames, and reserve_video() shares the budget between the requests running concurrently.
+"""
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+import numpy as np
+import torch
+
+# Peak bytes per 128x128 BlazeFace tile: uint8 tile, float input and activations (measured on CPU, fp32)
+tile_bytes = int(2.5 * 2 ** 20)
+# Peak activation bytes per 224x224 face in the classifier forward pass (measured on CPU, fp32, no_grad)
+classifier_face_bytes = {
+    'EfficientNetB0': 16 * 2 ** 20,
+    'EfficientNetB4': 26 * 2 ** 20,
+    'EfficientNetB4ST': 26 * 2 ** 20,
+    'EfficientNetAutoAttB4': 26 * 2 ** 20,
+    'EfficientNetAutoAttB4ST': 26 * 2 ** 20,
+    'Xception': 26 * 2 ** 20,
+}
+default_classifier_face_bytes = 26 * 2 ** 20
+# Faces per classifier forward pass when the budget is not limiting
+max_classifier_batch = 64
+
+
+def _read_int(path: str) -> int or None:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def _meminfo(key: str) -> int or None:
+    try:
+        with open('/proc/meminfo') as f:
+            match = re.search(r'^{}:\s+(\d+) kB'.format(key), f.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return int(match.group(1)) * 1024 if match else None
+
+
+def cgroup_available() -> int or None:
+    """
+    Bytes the cgroup of the process can still allocate, None without a cgroup limit
+    """
+    for limit_path, usage_path in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        limit = _read_int(limit_path)
+        # cgroup v1 reports "no limit" as a huge number
+        if limit is not None and limit < 2 ** 60:
+            return max(limit - (_read_int(usage_path) or 0), 0)
+    return None
+
+
+def memory_budget() -> int or None:
+    """
+    Memory budget of a request [bytes], None if it cannot be determined: DEEPFAKE_MEMORY_BUDGET_MB if set, otherwise
+    DEEPFAKE_MEMORY_FRACTION (0.8 by default) of the memory still available to the process, the cgroup (container)
+    limit minus the cgroup usage, capped by MemAvailable
+    """
+    if os.environ.get('DEEPFAKE_MEMORY_BUDGET_MB'):
+        return int(float(os.environ['DEEPFAKE_MEMORY_BUDGET_MB']) * 2 ** 20)
+    available = [value for value in (cgroup_available(), _meminfo('MemAvailable')) if value is not None]
+    if len(available) == 0:
+        return None
+    return int(min(available) * float(os.environ.get('DEEPFAKE_MEMORY_FRACTION', 0.8)))
+
+
+def estimate_video_bytes(height: int, width: int, num_frames: int, chunk_size: int, num_tiles: int,
+                         face_size: int, views: int, classifier_batch: int, face_bytes: int) -> int:
+    """
+    Estimated peak memory of a video request
+    :param height: frame height
+    :param width: frame width
+    :param num_frames: frames read
+    :param chunk_size: frames decoded and searched for faces at a time
+    :param num_tiles: detector tiles per frame
+    :param face_size: classifier input size
+    :param views: views per face, 1 or the test-time augmentation views
+    :param classifier_batch: faces per classifier forward pass
+    :param face_bytes: classifier activation bytes per 224x224 face
+    :return: bytes
+    """
+    chunk_size = min(chunk_size, num_frames)
+    # Decoded frames are listed, then stacked into the chunk buffer
+    frames = 2 * chunk_size * height * width * 3
+    tiles = chunk_size * num_tiles * tile_bytes
+    # Preprocessed faces of all the frames, one (best) face per frame
+    faces = num_frames * views * 3 * face_size * face_size * 4
+    classifier = min(classifier_batch, num_frames * views) * face_bytes * (face_size / 224) ** 2
+    return int(frames + tiles + faces + classifier)
+
+
+class VideoPlan:
+    """
+    How to run a video request within the memory budget
+    """
+
+    def __init__(self, frames: int, chunk_size: int, classifier_batch: int, estimate: int, budget: int or None,
+                 requested_frames: int):
+        self.frames = frames
+        self.chunk_size = chunk_size
+        self.classifier_batch = classifier_batch
+        self.estimate = estimate
+        self.budget = budget
+        self.requested_frames = requested_frames
+
+    @property
+    def chunked(self) -> bool:
+        return self.chunk_size < self.frames
+
+    @property
+    def reduced(self) -> bool:
+        return self.frames < self.requested_frames
+
+    def __repr__(self):
+        return 'VideoPlan(frames={:d}/{:d}, chunk_size={:d}, classifier_batch={:d}, estimate={:.0f}MB, ' \
+               'budget={})'.format(self.frames, self.requested_frames, self.chunk_size, self.classifier_batch,
+                                   self.estimate / 2 ** 20,
+                                   '{:.0f}MB'.format(self.budget / 2 ** 20) if self.budget is not None else None)
+
+
+def plan_video(height: int, width: int, video_frames: int, frames: int, num_tiles: int, face_size: int, views: int,
+               model: str, budget: int = None) -> VideoPlan:
+    """
+    Largest chunk size, or frame count, whose estimated peak memory fits the budget: all the frames at once if they
+    fit, otherwise the frames in the largest chunks that fit with the faces classified in batches, otherwise fewer
+    frames, one per chunk
+    :param height: frame height, e.g. from utils.extract_meta_cv
+    :param width: frame width
+    :param video_frames: frames in the video
+    :param frames: requested frames per video
+    :param num_tiles: detector tiles per frame, e.g. from FaceExtractor.get_tiles_params
+    :param face_size: classifier input size
+    :param views: views per face, 1 or the test-time augmentation views
+    :param model: classifier name
+    :param budget: bytes, memory_budget() by default
+    :return: VideoPlan
+    :raise MemoryError: if not even a single frame fits the budget
+    """
+    budget = memory_budget() if budget is None else budget
+    face_bytes = classifier_face_bytes.get(model, default_classifier_face_bytes)
+    num_frames = max(min(frames, video_frames), 1) if video_frames > 0 else max(frames, 1)
+
+    def estimate(num_frames: int, chunk_size: int, classifier_batch: int) -> int:
+        return estimate_video_bytes(height, width, num_frames, chunk_size, num_tiles, face_size, views,
+                                    classifier_batch, face_bytes)
+
+    if budget is None or estimate(num_frames, num_frames, max_classifier_batch) <= budget:
+        return VideoPlan(num_frames, num_frames, max_classifier_batch,
+                         estimate(num_frames, num_frames, max_classifier_batch), budget, frames)
+    # Small classifier batches cost little throughput, shrink them before the chunks
+    classifier_batch = max_classifier_batch
+    while classifier_batch > 1 and estimate(num_frames, 1, classifier_batch) > budget:
+        classifier_batch //= 2
+    for chunk_size in range(num_frames, 0, -1):
+        if estimate(num_frames, chunk_size, classifier_batch) <= budget:
+            return VideoPlan(num_frames, chunk_size, classifier_batch,
+                             estimate(num_frames, chunk_size, classifier_batch), budget, frames)
+    for reduced_frames in range(num_frames - 1, 0, -1):
+        if estimate(reduced_frames, 1, classifier_batch) <= budget:
+            return VideoPlan(reduced_frames, 1, classifier_batch, estimate(reduced_frames, 1, classifier_batch),
+                             budget, frames)
+    raise MemoryError('A single {:d}x{:d} frame needs about {:.0f}MB, over the memory budget of {:.0f}MB'.format(
+        width, height, estimate(1, 1, 1) / 2 ** 20, budget / 2 ** 20))
+
+
+# Active PeakTrackers, the high-water mark is only reset by a tracker running alone
+_trackers = 0
+_trackers_lock = threading.Lock()
+
+
+# Estimated bytes of the running requests, see reserve_video
+_reserved = 0
+_reserved_cond = threading.Condition()
+
+
+@contextmanager
+def reserve_video(height: int, width: int, video_frames: int, frames: int, num_tiles: int, face_size: int,
+                  views: int, model: str) -> Iterator[VideoPlan]:
+    """
+    Context manager planning a video request (see plan_video) within the budget left by the running requests,
+    and reserving its estimate until the end of the block. A request that does not fit what is left waits for the
+    others to end. With the budget measured from MemAvailable, the memory the running requests already use is
+    counted twice: a conservative approximation
+    :return: VideoPlan
+    :raise MemoryError: if the request would not fit even the whole budget
+    """
+    global _reserved
+    with _reserved_cond:
+        while True:
+            budget = memory_budget()
+            try:
+                plan = plan_video(height, width, video_frames, frames, num_tiles, face_size, views, model,
+                                  budget=max(budget - _reserved, 0) if budget is not None else None)
+                break
+            except MemoryError:
+                if _reserved == 0:
+                    raise
+                # Fail now if the whole budget would not do either, otherwise wait for a running request to end
+                plan_video(height, width, video_frames, frames, num_tiles, face_size, views, model, budget=budget)
+                _reserved_cond.wait()
+        _reserved += plan.estimate
+    try:
+        yield plan
+    finally:
+        with _reserved_cond:
+            _reserved -= plan.estimate
+            _reserved_cond.notify_all()
+
+
+def _status_bytes(key: str) -> int or None:
+    try:
+        with open('/proc/self/status') as f:
+            match = re.search(r'^{}:\s+(\d+) kB'.format(key), f.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return int(match.group(1)) * 1024 if match else None
+
+
+class PeakTracker:
+    """
+    Context manager recording the peak RSS of the process while a request runs, and the bytes of the main arrays
+    of the request. The kernel high-water mark is reset at the start where allowed and when no other tracker is
+    active, as the reset would clear their peaks, otherwise RSS is sampled. RSS is process-wide: with requests
+    running concurrently the peak includes the memory of the others
+    """
+
+    def __init__(self, interval: float = 0.01):
+        """
+        :param interval: RSS sampling interval [s], used when the high-water mark cannot be reset
+        """
+        self.interval = interval
+        self.array_bytes: Dict[str, int] = {}
+        self.start_rss = self.peak_rss = None
+        self.cuda_peak = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._hwm_reset = False
+
+    def add(self, name: str, array: torch.Tensor or np.ndarray):
+        """
+        Record the bytes of an array or tensor, summed by name
+        """
+        nbytes = array.element_size() * array.nelement() if isinstance(array, torch.Tensor) else array.nbytes
+        self.array_bytes[name] = self.array_bytes.get(name, 0) + int(nbytes)
+
+    def __enter__(self):
+        global _trackers
+        self.start_rss = _status_bytes('VmRSS')
+        self.peak_rss = self.start_rss
+        with _trackers_lock:
+            alone = _trackers == 0
+            _trackers += 1
+            if alone:
+                try:
+                    # "5" resets the peak RSS reported as VmHWM
+                    with open('/proc/self/clear_refs', 'w') as f:
+                        f.write('5')
+                    self._hwm_reset = True
+                except OSError:
+                    pass
+        if not self._hwm_reset:
+            self._thread = threading.Thread(target=self._sample, name='memory-peak', daemon=True)
+            self._thread.start()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = _status_bytes('VmRSS')
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _trackers
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        if self._hwm_reset:
+            self.peak_rss = _status_bytes('VmHWM')
+        with _trackers_lock:
+            _trackers -= 1
+        if torch.cuda.is_available():
+            self.cuda_peak = torch.cuda.max_memory_allocated()
+        return False
+
+    def report(self) -> dict:
+        return {'start_rss_mb': self.start_rss / 2 ** 20 if self.start_rss is not None else None,
+                'peak_rss_mb': self.peak_rss / 2 ** 20 if self.peak_rss is not None else None,
+                'cuda_peak_mb': self.cuda_peak / 2 ** 20 if self.cuda_peak is not None else None,
+                'arrays_mb': {name: nbytes / 2 ** 20 for name, nbytes in self.array_bytes.items()}}
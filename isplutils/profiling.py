@@ -0,0 +1,267 @@
+"""
+Video Face Manipulation Detection Through Ensemble of CNNs
+
+Image and Sound Processing Lab - Politecnico di Milano
+
+Nicolò Bonettini
+Edoardo Daniele Cannas
+Sara Mandelli
+Luca Bondi
+Paolo Bestagini
+
+On-demand profiling of single requests under torch.profiler and a sampling profiler of the Python stack, enabled for
+every request with DEEPFAKE_PROFILE=1 or per call with profile=True on the functions decorated with profiled().
+"""
+import functools
+import hashlib
+import inspect
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Iterable
+
+import torch
+
+from .utils import file_hash
+
+# Profile folder, its size budget and the Python stack sampling interval
+profile_dir = os.environ.get('DEEPFAKE_PROFILE_DIR', 'profiles')
+profile_budget = int(float(os.environ.get('DEEPFAKE_PROFILE_BUDGET_MB', 500)) * 2 ** 20)
+sample_interval = float(os.environ.get('DEEPFAKE_PROFILE_INTERVAL_MS', 5)) / 1e3
+
+# Held by the running capture
+_capture_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.environ.get('DEEPFAKE_PROFILE', '0') == '1'
+
+
+class StackSampler:
+    """
+    Sampling profiler of the Python stack of one thread, run from a daemon thread
+    """
+
+    def __init__(self, thread_id: int = None, interval: float = sample_interval):
+        """
+        :param thread_id: thread to sample, the calling one by default
+        :param interval: sampling interval [s]
+        """
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiling-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{:d})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def top_functions(self, n: int = 20) -> list:
+        """
+        Functions with the most samples, including the time spent in the functions they call
+        """
+        inclusive = Counter()
+        for stack, num in self.stacks.items():
+            for function in set(re.sub(r':\d+\)$', ')', frame) for frame in stack.split(';')):
+                inclusive[function] += num
+        total = max(sum(self.stacks.values()), 1)
+        return [{'function': function, 'samples': num, 'fraction': num / total}
+                for function, num in inclusive.most_common(n)]
+
+    def write(self, path: str or Path):
+        with open(path, 'w') as f:
+            for stack, num in self.stacks.most_common():
+                f.write('{} {:d}\n'.format(stack, num))
+
+
+def content_hash(source: str or bytes) -> str or None:
+    """
+    SHA1 of the input of a request, None if it is not available
+    :param source: input file, or the encoded input itself
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return hashlib.sha1(source).hexdigest()
+    if source is not None and os.path.isfile(source):
+        return file_hash(source)
+    return None
+
+
+def capture_prefix(kind: str, path: str or bytes, params: dict) -> str:
+    """
+    Name shared by the files of a capture
+    :param kind: request kind, e.g. 'video'
+    :param path: input file of the request, or the encoded input itself
+    :param params: parameters of the request
+    """
+    digest = (content_hash(path) or 'nohash')[:12]
+    # No dots: the files of a capture are grouped on the name before the first one
+    tags = re.sub(r'[^A-Za-z0-9=,-]+', '', ','.join('{}={}'.format(k, v) for k, v in params.items()))[:96]
+    now = time.time()
+    return '{}-{:03d}_{}_{}_{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int(now * 1e3) % 1000,
+                                       kind, digest, tags)
+
+
+def rotate(directory: str or Path, budget: int) -> list:
+    """
+    Delete the oldest captures until the folder fits in the budget. The newest capture is always kept
+    :param directory: profile folder
+    :param budget: size budget [bytes]
+    :return: deleted files
+    """
+    groups = {}
+    for path in Path(directory).iterdir():
+        if path.is_file():
+            group = groups.setdefault(path.name.split('.', 1)[0], [0, 0., []])
+            stat = path.stat()
+            group[0] += stat.st_size
+            group[1] = max(group[1], stat.st_mtime)
+            group[2].append(path)
+    deleted = []
+    total = 0
+    for idx, (size, _, paths) in enumerate(sorted(groups.values(), key=lambda g: g[1], reverse=True)):
+        total += size
+        if idx > 0 and total > budget:
+            for path in paths:
+                try:
+                    path.unlink()
+                    deleted.append(path)
+                except OSError as e:
+                    print('Cannot delete profile {}: {}'.format(path, e))
+    return deleted
+
+
+class Capture:
+    """
+    Context manager profiling the enclosed code. The capture is written to the profile folder, all the files with the
+    same prefix <time>_<kind>_<content hash>_<parameters>:
+        .trace.json    torch.profiler Chrome trace, open with chrome://tracing or Perfetto
+        .stacks.txt    sampled Python stacks in collapsed format, one "frame;frame;frame count" line per stack,
+                       e.g. for flamegraph.pl or speedscope
+        .json          parameters, content hash, wall time, top operators and top Python functions
+    The oldest captures are deleted once the folder exceeds the size budget. torch.profiler cannot run in two threads
+    at once, so one capture runs at a time: a request that starts while another one is captured runs without profiling
+    """
+
+    def __init__(self, kind: str, path: str or bytes = None, params: dict = None, directory: str = None,
+                 budget: int = None):
+        """
+        :param kind: request kind, e.g. 'video'
+        :param path: input file, or the encoded input itself, its content hash tags the capture
+        :param params: parameters of the request, they tag the capture
+        :param directory: profile folder, profile_dir by default
+        :param budget: size budget of the folder [bytes], profile_budget by default
+        """
+        self.kind = kind
+        self.path = path
+        self.params = params or {}
+        self.directory = Path(directory or profile_dir)
+        self.budget = profile_budget if budget is None else budget
+        self.prefix = None
+
+    def __enter__(self):
+        self.active = _capture_lock.acquire(blocking=False)
+        if not self.active:
+            print('Another request is being profiled, {} request not profiled'.format(self.kind))
+            return self
+        try:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.sampler = StackSampler()
+            self.t0 = time.perf_counter()
+            self.profiler.__enter__()
+            self.sampler.start()
+        except BaseException:
+            _capture_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.active:
+            return False
+        try:
+            self.sampler.stop()
+            self.profiler.__exit__(exc_type, exc_value, traceback)
+            wall = time.perf_counter() - self.t0
+            try:
+                self._write(wall, exc_type)
+            except (OSError, RuntimeError) as e:
+                print('Cannot write profile: {}'.format(e))
+        finally:
+            _capture_lock.release()
+        return False
+
+    def _write(self, wall: float, exc_type):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.prefix = capture_prefix(self.kind, self.path, self.params)
+        base = self.directory.joinpath(self.prefix)
+        self.profiler.export_chrome_trace(str(base) + '.trace.json')
+        self.sampler.write(str(base) + '.stacks.txt')
+        averages = sorted(self.profiler.key_averages(), key=lambda e: e.self_cpu_time_total, reverse=True)
+        meta = {
+            'kind': self.kind,
+            'file': os.path.basename(self.path) if isinstance(self.path, str) else None,
+            'sha1': content_hash(self.path),
+            'params': self.params,
+            'wall_ms': 1e3 * wall,
+            'error': exc_type.__name__ if exc_type is not None else None,
+            'samples': sum(self.sampler.stacks.values()),
+            'top_ops': [{'op': e.key, 'calls': e.count, 'self_cpu_ms': e.self_cpu_time_total / 1e3,
+                         'cpu_ms': e.cpu_time_total / 1e3} for e in averages[:20]],
+            'top_functions': self.sampler.top_functions(),
+        }
+        with open(str(base) + '.json', 'w') as f:
+            json.dump(meta, f, indent=2, default=str)
+        rotate(self.directory, self.budget)
+
+
+def profiled(kind: str, path_arg: str, params: Iterable[str], data_arg: str = None) -> Callable:
+    """
+    Decorator adding a profile keyword argument to a request function: profile=True captures the call,
+    profile=None (default) captures it if DEEPFAKE_PROFILE=1
+    :param kind: request kind, e.g. 'video'
+    :param path_arg: name of the argument with the input file
+    :param params: names of the arguments tagging the capture
+    :param data_arg: optional name of the argument with the encoded input, used instead of the file when set
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, profile: bool = None, **kwargs):
+            if not (enabled() if profile is None else profile):
+                return fn(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            source = bound.arguments[path_arg]
+            if data_arg is not None and isinstance(bound.arguments[data_arg], (bytes, bytearray)):
+                source = bound.arguments[data_arg]
+            with Capture(kind, source, {name: bound.arguments[name] for name in params}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -10,9 +10,15 @@ Sara Mandelli
 Luca Bondi
 Paolo Bestagini
 """
+import os
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
 
+from . import telemetry
+from .utils import file_hash
+
 available_datasets = [
     'dfdc-35-5-10',
     'ff-c23-720-140-140',
@@ -25,26 +31,166 @@ available_datasets = [
 ]
 
 
-def load_df(dfdc_df_path: str, ffpp_df_path: str, dfdc_faces_dir: str, ffpp_faces_dir: str, dataset: str) -> (pd.DataFrame, str):
+# Bump when the split selection changes, so that cached splits are recomputed
+split_cache_version = 1
+
+# Extension of the columnar formats supported by read_df
+columnar_formats = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'feather': '.feather',
+}
+
+_df_cache = {}
+
+
+def _file_key(path: str) -> Tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def read_df(path: str, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Read a faces DataFrame, once per process as long as the file does not change.
+    The same DataFrame is returned to every caller, do not modify it in place.
+    :param path: path to the DataFrame: pickle, Parquet (.parquet) or Arrow IPC (.arrow, .feather)
+    :param columns: columns to load, all by default. The index is always loaded
+    :return:
+    """
+    key = _file_key(path) + (tuple(columns) if columns is not None else None,)
+    if key not in _df_cache:
+        if Path(path).suffix in columnar_formats.values():
+            df = _read_columnar(path, columns)
+        else:
+            df = pd.read_pickle(path)
+            if columns is not None:
+                df = df[columns]
+        _df_cache[key] = df
+    return _df_cache[key]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('pyarrow is required to read and write Parquet and Arrow faces DataFrames') from e
+    return pyarrow
+
+
+def _read_columnar(path: str, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Read a Parquet or Arrow IPC faces DataFrame with memory mapping. Arrow IPC files are mapped as they are, so
+    unselected columns are never read and numeric columns are not copied until needed.
+    Categorical columns are restored as categorical.
+    """
+    pa = _import_pyarrow()
+    source = pa.memory_map(str(path))
+    if Path(path).suffix == columnar_formats['parquet']:
+        schema = pa.parquet.read_schema(source)
+    else:
+        reader = pa.ipc.open_file(source)
+        schema = reader.schema
+    if columns is not None:
+        # The index is stored as regular columns, listed in the pandas metadata
+        index_columns = [col for col in (schema.pandas_metadata or {}).get('index_columns', [])
+                         if isinstance(col, str)]
+        columns = index_columns + [col for col in columns if col not in index_columns]
+    if Path(path).suffix == columnar_formats['parquet']:
+        table = pa.parquet.read_table(source, columns=columns)
+    else:
+        table = reader.read_all()
+        if columns is not None:
+            table = table.select(columns)
+    # Keep one block per column, so that memory-mapped numeric columns are not copied to consolidate them
+    return table.to_pandas(split_blocks=True)
+
+
+def write_df(df: pd.DataFrame, path: str, categorical: List[str] = None):
+    """
+    Write a faces DataFrame in a columnar format, chosen by the extension of path
+    :param df: faces DataFrame
+    :param path: destination, .parquet, .arrow or .feather
+    :param categorical: columns to store as categorical (dictionary encoded)
+    """
+    pa = _import_pyarrow()
+    df = df.astype({col: 'category' for col in categorical or [] if col in df.columns})
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    if Path(path).suffix == columnar_formats['parquet']:
+        pa.parquet.write_table(table, str(path))
+    elif Path(path).suffix in columnar_formats.values():
+        with pa.ipc.new_file(str(path), table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError('Unknown columnar format: {}'.format(path))
+
+
+def df_path(dfdc_df_path: str, ffpp_df_path: str, dataset: str) -> str:
     if dataset.startswith('dfdc'):
-        df = pd.read_pickle(dfdc_df_path)
-        root = dfdc_faces_dir
+        return dfdc_df_path
     elif dataset.startswith('ff-'):
-        df = pd.read_pickle(ffpp_df_path)
-        root = ffpp_faces_dir
+        return ffpp_df_path
     else:
         raise NotImplementedError('Unknown dataset: {}'.format(dataset))
+
+
+def _load_shared_df(dfdc_df_path: str, ffpp_df_path: str, dfdc_faces_dir: str, ffpp_faces_dir: str, dataset: str,
+                    columns: List[str] = None) -> (pd.DataFrame, str):
+    df = read_df(df_path(dfdc_df_path, ffpp_df_path, dataset), columns=columns)
+    root = dfdc_faces_dir if dataset.startswith('dfdc') else ffpp_faces_dir
     return df, root
 
 
-def get_split_df(df: pd.DataFrame, dataset: str, split: str) -> pd.DataFrame:
+def load_df(dfdc_df_path: str, ffpp_df_path: str, dfdc_faces_dir: str, ffpp_faces_dir: str, dataset: str,
+            columns: List[str] = None) -> (pd.DataFrame, str):
+    """
+    Faces DataFrame and faces root of a dataset. The DataFrame is a copy of the one cached by read_df, callers may
+    modify it
+    """
+    df, root = _load_shared_df(dfdc_df_path, ffpp_df_path, dfdc_faces_dir, ffpp_faces_dir, dataset, columns)
+    return df.copy(), root
+
+
+def _positions(mask: pd.Series or np.ndarray) -> np.ndarray:
+    return np.flatnonzero(np.asarray(mask))
+
+
+def _select_per_video(videos: pd.Series, fpv: int) -> np.ndarray:
+    """
+    Draw fpv faces per video with the global numpy random state. Videos are visited in order of appearance and
+    each draw consumes the random stream as np.random.choice(video_faces, fpv, replace=False) does, so the
+    selection is the same as looping over the videos and choosing among their rows.
+    :param videos: video of each row
+    :param fpv: faces per video
+    :return: positions of the selected rows
+    """
+    codes, _ = pd.factorize(videos)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes))[:-1]
+    idxs = []
+    for group in np.split(order, bounds):
+        if fpv > len(group):
+            raise ValueError("Cannot take a larger sample than population when 'replace=False'")
+        idxs.append(group[np.random.permutation(len(group))[:fpv]])
+    return np.concatenate(idxs) if len(idxs) else np.zeros(0, dtype=np.int64)
+
+
+def get_split_positions(df: pd.DataFrame, dataset: str, split: str) -> np.ndarray:
+    """
+    Positions in df of the records of a split
+    :param df: full faces DataFrame of the dataset
+    :param dataset: dataset name
+    :param split: 'train', 'val' or 'test'
+    :return: int64 array, get_split_df(df, dataset, split) is df.iloc[positions]
+    """
     if dataset == 'dfdc-35-5-10':
         if split == 'train':
-            split_df = df[df['folder'].isin(range(35))]
+            positions = _positions(df['folder'].isin(range(35)))
         elif split == 'val':
-            split_df = df[df['folder'].isin(range(35, 40))]
+            positions = _positions(df['folder'].isin(range(35, 40)))
         elif split == 'test':
-            split_df = df[df['folder'].isin(range(40, 50))]
+            positions = _positions(df['folder'].isin(range(40, 50)))
         else:
             raise NotImplementedError('Unknown split: {}'.format(split))
     elif dataset.startswith('ff-c23-720-140-140'):
@@ -60,21 +206,19 @@ def get_split_df(df: pd.DataFrame, dataset: str, split: str) -> pd.DataFrame:
         val_orig = random_youtube_videos[720:720 + 140]
         test_orig = random_youtube_videos[720 + 140:]
         if split == 'train':
-            split_df = pd.concat((df[df['original'].isin(train_orig)], df[df['video'].isin(train_orig)]), axis=0)
+            split_orig = train_orig
         elif split == 'val':
-            split_df = pd.concat((df[df['original'].isin(val_orig)], df[df['video'].isin(val_orig)]), axis=0)
+            split_orig = val_orig
         elif split == 'test':
-            split_df = pd.concat((df[df['original'].isin(test_orig)], df[df['video'].isin(test_orig)]), axis=0)
+            split_orig = test_orig
         else:
             raise NotImplementedError('Unknown split: {}'.format(split))
+        positions = np.concatenate((_positions(df['original'].isin(split_orig)),
+                                    _positions(df['video'].isin(split_orig))))
 
         if dataset.endswith('fpv'):
             fpv = int(dataset.rsplit('-', 1)[1][:-3])
-            idxs = []
-            for video in split_df['video'].unique():
-                idxs.append(np.random.choice(split_df[split_df['video'] == video].index, fpv, replace=False))
-            idxs = np.concatenate(idxs)
-            split_df = split_df.loc[idxs]
+            positions = positions[_select_per_video(df['video'].iloc[positions], fpv)]
         # Restore random state
         np.random.set_state(st0)
     elif dataset == 'celebdf':
@@ -92,18 +236,68 @@ def get_split_df(df: pd.DataFrame, dataset: str, split: str) -> pd.DataFrame:
         train_orig = random_train_val_real_videos[:num_real_train]
         val_orig = random_train_val_real_videos[num_real_train:]
         if split == 'train':
-            split_df = pd.concat((df[df['original'].isin(train_orig)], df[df['video'].isin(train_orig)]), axis=0)
+            positions = np.concatenate((_positions(df['original'].isin(train_orig)),
+                                        _positions(df['video'].isin(train_orig))))
         elif split == 'val':
-            split_df = pd.concat((df[df['original'].isin(val_orig)], df[df['video'].isin(val_orig)]), axis=0)
+            positions = np.concatenate((_positions(df['original'].isin(val_orig)),
+                                        _positions(df['video'].isin(val_orig))))
         elif split == 'test':
-            split_df = df[df['test'] == True]
+            positions = _positions(df['test'] == True)
         else:
             raise NotImplementedError('Unknown split: {}'.format(split))
         # Restore random state
         np.random.set_state(st0)
     else:
         raise NotImplementedError('Unknown dataset: {}'.format(dataset))
-    return split_df
+    return positions.astype(np.int64)
+
+
+def get_split_df(df: pd.DataFrame, dataset: str, split: str) -> pd.DataFrame:
+    return df.iloc[get_split_positions(df, dataset, split)]
+
+
+def split_cache_path(df_path: str, dataset: str, split: str) -> Path:
+    """
+    Location of the cached positions of a split, next to the DataFrame they refer to
+    :param df_path: path to the full faces DataFrame of the dataset
+    :param dataset: dataset name
+    :param split: split name
+    :return:
+    """
+    return Path(df_path).parent.joinpath('splitcache', '{}_{}_v{:d}_{}.npy'.format(
+        dataset, split, split_cache_version, file_hash(df_path)))
+
+
+def load_split_positions(df_path: str, df: pd.DataFrame, dataset: str, split: str) -> np.ndarray:
+    """
+    Positions of the records of a split, read from the split cache or computed and cached.
+    Cached positions are keyed by dataset, split and hash of the DataFrame file, and are simply recomputed if the
+    cache cannot be read or written.
+    :param df_path: path to the full faces DataFrame of the dataset
+    :param df: the full faces DataFrame, as read from df_path
+    :param dataset: dataset name
+    :param split: split name
+    :return: int64 array of positions in df
+    """
+    cache_path = split_cache_path(df_path, dataset, split)
+    try:
+        positions = np.load(cache_path)
+        if positions.ndim == 1 and (len(positions) == 0 or positions.max() < len(df)):
+            telemetry.count('cache_hits', cache='split')
+            return positions
+    except (OSError, ValueError):
+        pass
+    telemetry.count('cache_misses', cache='split')
+    positions = get_split_positions(df, dataset, split)
+    try:
+        os.makedirs(cache_path.parent, exist_ok=True)
+        tmp_path = cache_path.with_suffix('.{:d}.tmp'.format(os.getpid()))
+        with open(tmp_path, 'wb') as f:
+            np.save(f, positions)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print('Cannot cache split {} {}: {}'.format(dataset, split, e))
+    return positions
 
 
 def make_splits(dfdc_df: str, ffpp_df: str, dfdc_dir: str, ffpp_dir: str, dbs: Dict[str, List[str]]) -> Dict[str, Dict[str, Tuple[pd.DataFrame, str]]]:
@@ -127,9 +321,11 @@ def make_splits(dfdc_df: str, ffpp_df: str, dfdc_dir: str, ffpp_dir: str, dbs: D
         split_dict[split_name] = dict()
         for split_db in split_dbs:
             if split_db not in full_dfs:
-                full_dfs[split_db] = load_df(dfdc_df, ffpp_df, dfdc_dir, ffpp_dir, split_db)
+                # Shared, not copied: only the split rows are taken, with iloc
+                full_dfs[split_db] = _load_shared_df(dfdc_df, ffpp_df, dfdc_dir, ffpp_dir, split_db)
             full_df, root = full_dfs[split_db]
-            split_df = get_split_df(df=full_df, dataset=split_db, split=split_name)
+            positions = load_split_positions(df_path(dfdc_df, ffpp_df, split_db), full_df, split_db, split_name)
+            split_df = full_df.iloc[positions]
             split_dict[split_name][split_db] = (split_df, root)
 
     return split_dict
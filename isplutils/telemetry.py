@@ -0,0 +1,276 @@
+"""
+Video Face Manipulation Detection Through Ensemble of CNNs
+
+Image and Sound Processing Lab - Politecnico di Milano
+
+Nicolò Bonettini
+Edoardo Daniele Cannas
+Sara Mandelli
+Luca Bondi
+Paolo Bestagini
+
+Lightweight instrumentation of the pipeline: spans time the stages, counters count frames, tiles, detections, faces,
+cache hits and bytes read. Disabled unless DEEPFAKE_TELEMETRY=1 or enable() is called.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Tuple
+
+logger = logging.getLogger('deepfake.telemetry')
+
+# Upper bounds of the span duration histogram buckets [s]
+span_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+_spans: Dict[str, list] = {}
+_server = None
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(log_path: str = None):
+    """
+    Start collecting spans and counters. Every finished span is logged as a JSON line by the 'deepfake.telemetry'
+    logger
+    :param log_path: optional file the JSON span lines are appended to, DEEPFAKE_TELEMETRY_LOG when enabled from
+        the environment
+    """
+    global _enabled
+    if log_path is not None and not any(getattr(handler, 'baseFilename', None) == os.path.abspath(log_path)
+                                        for handler in logger.handlers):
+        handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    """
+    Drop all the collected spans and counters
+    """
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+
+
+def count(name: str, value: float = 1, **labels):
+    """
+    Increment a counter
+    :param name: counter name, e.g. 'frames_decoded'
+    :param value: increment
+    :param labels: optional labels, e.g. cache='split'
+    """
+    if not _enabled:
+        return
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def _observe(name: str, seconds: float):
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = [0, 0., [0] * len(span_buckets)]
+        stats[0] += 1
+        stats[1] += seconds
+        for idx, bound in enumerate(span_buckets):
+            if seconds <= bound:
+                stats[2][idx] += 1
+                break
+
+
+class _Span:
+    __slots__ = ('name', 'attrs', 'trace', 'parent', 't0')
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """
+        Add attributes to the JSON line of the span
+        """
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        self.trace = stack[-1].trace if stack else uuid.uuid4().hex[:16]
+        stack.append(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.t0
+        _local.stack.pop()
+        _observe(self.name, seconds)
+        if logger.isEnabledFor(logging.INFO):
+            record = {'ts': time.time(), 'trace': self.trace, 'span': self.name, 'parent': self.parent,
+                      'ms': 1e3 * seconds}
+            if exc_type is not None:
+                record['error'] = exc_type.__name__
+            record.update(self.attrs)
+            logger.info(json.dumps(record, default=str))
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name: str, **attrs):
+    """
+    Context manager timing a stage. Spans opened inside another span of the same thread share its trace id, so the
+    JSON lines of a request can be grouped. While telemetry is disabled a shared no-op span is returned
+    :param name: stage name, e.g. 'blazeface.nms'
+    :param attrs: attributes of the JSON line, more can be added with set() on the returned span
+    """
+    if not _enabled:
+        return _null_span
+    return _Span(name, attrs)
+
+
+def timed(name: str) -> Callable:
+    """
+    Decorator wrapping each call of a function in a span
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(name, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def snapshot() -> dict:
+    """
+    Current counters and span statistics
+    :return: {'counters': {name: value or {labels: value}}, 'spans': {name: {count, total_ms, mean_ms}}}
+    """
+    with _lock:
+        counters = {}
+        for (name, labels), value in _counters.items():
+            if labels:
+                counters.setdefault(name, {})[','.join('{}={}'.format(k, v) for k, v in labels)] = value
+            else:
+                counters[name] = value
+        spans = {name: {'count': stats[0], 'total_ms': 1e3 * stats[1], 'mean_ms': 1e3 * stats[1] / stats[0]}
+                 for name, stats in _spans.items()}
+    return {'counters': counters, 'spans': spans}
+
+
+def _label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _label_value(v)) for k, v in labels) + '}'
+
+
+def prometheus_text(prefix: str = 'deepfake') -> str:
+    """
+    Counters (totals) and per-stage span histograms in the Prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        by_name = {}
+        for (name, labels), value in sorted(_counters.items()):
+            by_name.setdefault(name, []).append((labels, value))
+        for name, values in by_name.items():
+            metric = '{}_{}_total'.format(prefix, name)
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.extend('{}{} {}'.format(metric, _labels(labels), repr(float(value))) for labels, value in values)
+
+        if _spans:
+            metric = '{}_stage_seconds'.format(prefix)
+            lines.append('# HELP {} Duration of the instrumented pipeline stages'.format(metric))
+            lines.append('# TYPE {} histogram'.format(metric))
+            for name, (num, total, buckets) in sorted(_spans.items()):
+                cumulative = 0
+                for bound, bucket in zip(span_buckets, buckets):
+                    cumulative += bucket
+                    lines.append('{}_bucket{} {:d}'.format(metric, _labels((('stage', name), ('le', repr(bound)))),
+                                                            cumulative))
+                lines.append('{}_bucket{} {:d}'.format(metric, _labels((('stage', name), ('le', '+Inf'))), num))
+                lines.append('{}_sum{} {}'.format(metric, _labels((('stage', name),)), repr(total)))
+                lines.append('{}_count{} {:d}'.format(metric, _labels((('stage', name),)), num))
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body, content_type = prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path.split('?')[0] == '/metrics.json':
+            body, content_type = json.dumps(snapshot()).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Serve /metrics (Prometheus text) and /metrics.json from a daemon thread, once per process. Enables telemetry
+    :param port: TCP port
+    :param host: interface to listen on
+    :return: the HTTP server
+    """
+    global _server
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name='telemetry-metrics', daemon=True).start()
+    enable()
+    return _server
+
+
+if os.environ.get('DEEPFAKE_TELEMETRY', '0') == '1':
+    enable(os.environ.get('DEEPFAKE_TELEMETRY_LOG'))
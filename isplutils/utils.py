@@ -9,20 +9,29 @@ Sara Mandelli
 Luca Bondi
 Paolo Bestagini
 """
+import hashlib
+import io
+import os
+import warnings
+from functools import lru_cache
 from pprint import pprint
-from typing import Iterable, List
+from typing import BinaryIO, Iterable, List, Tuple
 
 import albumentations as A
 import cv2
 import numpy as np
 import scipy
 import torch
-from PIL import Image
+from PIL import Image, ImageOps
 from albumentations.pytorch import ToTensorV2
 from matplotlib import pyplot as plt
 from torch import nn as nn
 from torchvision import transforms
 
+from . import telemetry
+
+_hash_cache = {}
+
 
 def extract_meta_av(path: str) -> (int, int, int):
     """
@@ -63,6 +72,35 @@ def extract_meta_cv(path: str) -> (int, int, int):
         return 0, 0, 0
 
 
+def load_image(image: str or bytes or BinaryIO) -> np.ndarray:
+    """
+    Decode an image to RGB, rotated upright according to its EXIF orientation
+    :param image: path, encoded bytes (e.g. an upload) or binary file object
+    :return: (height, width, 3) uint8 array
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = io.BytesIO(image)
+    with Image.open(image) as im:
+        return np.asarray(ImageOps.exif_transpose(im).convert('RGB'))
+
+
+def file_hash(path: str) -> str:
+    """
+    SHA1 of a file content, memoized on its size and modification time
+    :param path:
+    :return: hex digest
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _hash_cache:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _hash_cache[key] = digest.hexdigest()
+    return _hash_cache[key]
+
+
 def adapt_bb(frame_height: int, frame_width: int, bb_height: int, bb_width: int, left: int, top: int, right: int,
              bottom: int) -> (
         int, int, int, int):
@@ -111,6 +149,81 @@ def extract_bb(frame: Image.Image, bb: Iterable, scale: str, size: int) -> Image
     return face
 
 
+def adapt_bbs(frame_height: int, frame_width: int, bb_heights: np.ndarray, bb_widths: np.ndarray,
+              bbs: np.ndarray) -> np.ndarray:
+    """
+    Vectorized adapt_bb for several bounding boxes of the same frame
+    :param frame_height:
+    :param frame_width:
+    :param bb_heights: (N,) target heights
+    :param bb_widths: (N,) target widths
+    :param bbs: (N, 4) integer bounding boxes (left, top, right, bottom)
+    :return: (N, 4) adapted bounding boxes (left, top, right, bottom)
+    """
+    left, top, right, bottom = np.asarray(bbs, dtype=np.int64).T
+    x_ctr = (left + right) // 2
+    y_ctr = (bottom + top) // 2
+    new_top = np.maximum(y_ctr - bb_heights // 2, 0)
+    new_bottom = np.minimum(new_top + bb_heights, frame_height)
+    new_left = np.maximum(x_ctr - bb_widths // 2, 0)
+    new_right = np.minimum(new_left + bb_widths, frame_width)
+    return np.stack([new_left, new_top, new_right, new_bottom], axis=1)
+
+
+def face_crop_boxes(frame_height: int, frame_width: int, bbs: np.ndarray, scale: str, size: int) -> np.ndarray:
+    """
+    Areas of the frame cropped by extract_bb for several bounding boxes
+    :param frame_height:
+    :param frame_width:
+    :param bbs: (N, 4) integer bounding boxes (left, top, right, bottom)
+    :param scale: "scale", "crop" or "tight", see extract_bb
+    :param size: size of the face
+    :return: (N, 4) crop boxes (left, top, right, bottom)
+    """
+    bbs = np.asarray(bbs, dtype=np.int64).reshape(-1, 4)
+    left, top, right, bottom = bbs.T
+    if scale == "scale":
+        bb_width = right - left
+        bb_height = bottom - top
+        valid = (bb_width > 0) & (bb_height > 0)
+        with np.errstate(divide='ignore'):
+            bb_to_desired_ratio = np.where(valid, np.minimum(size / bb_height, size / bb_width), 1.)
+        bb_side = (size / bb_to_desired_ratio).astype(np.int64)
+        return adapt_bbs(frame_height, frame_width, bb_side, bb_side, bbs)
+    elif scale == "crop":
+        return adapt_bbs(frame_height, frame_width, np.full(len(bbs), size), np.full(len(bbs), size), bbs)
+    elif scale == "tight":
+        return adapt_bbs(frame_height, frame_width, bottom - top, right - left, bbs)
+    else:
+        raise ValueError('Unknown scale value: {}'.format(scale))
+
+
+def extract_bbs(frame: Image.Image, bbs: np.ndarray, scale: str, size: int,
+                frame_size: (int, int) = None) -> List[Image.Image]:
+    """
+    Extract several faces from a frame, equivalent to calling extract_bb for each bounding box
+    :param frame: Entire frame, possibly decoded at reduced size with Image.draft
+    :param bbs: (N, 4) integer bounding boxes (left, top, right, bottom) in the reference system of the original frame
+    :param scale: "scale", "crop" or "tight", see extract_bb
+    :param size: size of the face
+    :param frame_size: (width, height) of the original frame, if different from the size of frame.
+                       Only supported with scale == "scale", faces are then resampled from the reduced frame
+    :return: list of faces
+    """
+    width, height = frame_size if frame_size is not None else frame.size
+    boxes = face_crop_boxes(height, width, bbs, scale, size)
+    if (width, height) == frame.size:
+        faces = [frame.crop(tuple(box)) for box in boxes]
+        if scale == "scale":
+            faces = [face.resize((size, size), Image.BILINEAR) for face in faces]
+    elif scale == "scale":
+        ratio = np.array([frame.width / width, frame.height / height] * 2)
+        faces = [frame.resize((size, size), Image.BILINEAR, box=tuple(box * ratio)) for box in boxes]
+    else:
+        raise ValueError('Faces can be extracted from a reduced frame only with scale == "scale"')
+    return faces
+
+
 def showimage(img_tensor: torch.Tensor):
     topil = transforms.Compose([
         transforms.Normalize(mean=[0, 0, 0, ], std=[1 / 0.229, 1 / 0.224, 1 / 0.225]),
@@ -207,6 +320,275 @@ def get_transformer(face_policy: str, patch_size: int, net_normalizer: transform
     return transf
 
 
+# Box scale factors of the test-time augmentation views
+tta_scales = (1.0, 0.9, 1.1)
+
+
+class FaceBatchTransformer:
+    """
+    Batched equivalent of get_transformer(face_policy, patch_size, net_normalizer, train=False).
+
+    Faces stay uint8 until the whole batch is normalized at once on the target device.
+    On CPU every face is resized with OpenCV straight into a preallocated uint8 batch, exactly as
+    albumentations does. On GPU all the faces are resampled together with a single bilinear gather,
+    with the padding folded into the interpolation weights; this matches the albumentations pipeline
+    up to one grey level before normalization, as OpenCV computes bilinear weights in fixed point.
+    """
+
+    def __init__(self, face_policy: str, patch_size: int, net_normalizer: transforms.Normalize,
+                 device: torch.device = None, chunk_size: int = 32):
+        """
+        :param face_policy: "scale" (PadIfNeeded then Resize) or "tight" (LongestMaxSize then PadIfNeeded)
+        :param patch_size: output face size
+        :param net_normalizer: normalizer returned by the network get_normalizer()
+        :param device: device where the batch is normalized and returned
+        :param chunk_size: maximum number of faces resampled together on GPU, bounds the size of the gather indices
+        """
+        if face_policy not in ['scale', 'tight']:
+            raise ValueError('Unknown value for face_policy: {}'.format(face_policy))
+        self.face_policy = face_policy
+        self.patch_size = int(patch_size)
+        self.device = device if device is not None else torch.device('cpu')
+        self.chunk_size = int(chunk_size)
+        # A.Normalize computes (x / 255 - mean) / std
+        self.mean = torch.tensor(net_normalizer.mean, dtype=torch.float32, device=self.device).view(1, 3, 1, 1) * 255
+        self.std = torch.tensor(net_normalizer.std, dtype=torch.float32, device=self.device).view(1, 3, 1, 1) * 255
+
+    @telemetry.timed('faces.preprocess')
+    def __call__(self, faces: List[np.ndarray]) -> torch.Tensor:
+        """
+        Transform a list of faces
+        :param faces: list of uint8 arrays of shape (H, W, 3), possibly of different sizes
+        :return: float tensor of shape (N, 3, patch_size, patch_size)
+        """
+        if len(faces) == 0:
+            return torch.zeros((0, 3, self.patch_size, self.patch_size), device=self.device)
+        heights = np.array([face.shape[0] for face in faces], dtype=np.int64)
+        widths = np.array([face.shape[1] for face in faces], dtype=np.int64)
+        if np.any(heights == 0) or np.any(widths == 0):
+            raise ValueError('Empty face in batch')
+        if self.device.type == 'cpu':
+            return self._normalize(torch.from_numpy(self._resize(faces)))
+        # Pack the faces into a single uint8 buffer of RGB pixels
+        pixels = np.concatenate([np.ascontiguousarray(face, dtype=np.uint8).reshape(-1, 3) for face in faces])
+        offsets = np.concatenate(([0], np.cumsum(heights * widths)[:-1]))
+        return self._normalize(self._resample(torch.from_numpy(pixels), offsets, widths, heights, widths))
+
+    @telemetry.timed('faces.preprocess')
+    def from_frames(self, frames: List[np.ndarray] or np.ndarray, boxes: np.ndarray,
+                    frame_idxs: List[int] or np.ndarray) -> torch.Tensor:
+        """
+        Crop and transform faces straight from the frames they were detected in.
+        Equivalent to calling the transformer on the crops returned by FaceExtractor, without
+        materializing the crops: on CPU each face is resized from a view of its frame, on GPU the
+        faces are resampled from the packed frames with a single gather.
+        :param frames: (num_frames, H, W, 3) uint8 array or list of (H, W, 3) uint8 arrays
+        :param boxes: (N, 4) array of face boxes (ymin, xmin, ymax, xmax) in frame coordinates,
+                      as in the FaceExtractor detections
+        :param frame_idxs: (N,) index of the frame each box refers to
+        :return: float tensor of shape (N, 3, patch_size, patch_size)
+        """
+        boxes = np.asarray(boxes)
+        frame_idxs = np.asarray(frame_idxs, dtype=np.int64)
+        if len(boxes) == 0:
+            return torch.zeros((0, 3, self.patch_size, self.patch_size), device=self.device)
+        # Same truncation as FaceExtractor._crop_faces
+        ymin, xmin, ymax, xmax = boxes[:, :4].astype(np.int32).T.astype(np.int64)
+        heights = ymax - ymin
+        widths = xmax - xmin
+        if np.any(heights <= 0) or np.any(widths <= 0):
+            raise ValueError('Empty face in batch')
+        if self.device.type == 'cpu':
+            faces = [frames[f][y0:y1, x0:x1] for f, y0, x0, y1, x1 in zip(frame_idxs, ymin, xmin, ymax, xmax)]
+            return self._normalize(torch.from_numpy(self._resize(faces)))
+        # Pack only the frames that contain faces
+        used_frames, frame_pos = np.unique(frame_idxs, return_inverse=True)
+        frame_widths = np.array([frames[f].shape[1] for f in used_frames], dtype=np.int64)
+        frame_sizes = np.array([frames[f].shape[0] * frames[f].shape[1] for f in used_frames], dtype=np.int64)
+        frame_offsets = np.concatenate(([0], np.cumsum(frame_sizes)[:-1]))
+        pixels = np.concatenate([np.ascontiguousarray(frames[f]).reshape(-1, 3) for f in used_frames])
+        row_strides = frame_widths[frame_pos]
+        offsets = frame_offsets[frame_pos] + ymin * row_strides + xmin
+        return self._normalize(self._resample(torch.from_numpy(pixels), offsets, row_strides, heights, widths))
+
+    @telemetry.timed('faces.preprocess_tta')
+    def from_frames_tta(self, frames: List[np.ndarray] or np.ndarray, boxes: np.ndarray,
+                        frame_idxs: List[int] or np.ndarray, scales: Tuple[float] = tta_scales) -> torch.Tensor:
+        """
+        Test-time augmentation views of the faces, all in one batch: each box is rescaled around its center by
+        every factor in scales (and clipped to its frame), each crop is taken both as is and horizontally flipped.
+        :param frames: (num_frames, H, W, 3) uint8 array or list of (H, W, 3) uint8 arrays
+        :param boxes: (N, 4) array of face boxes (ymin, xmin, ymax, xmax) in frame coordinates
+        :param frame_idxs: (N,) index of the frame each box refers to
+        :param scales: box scale factors, 1 for the original box
+        :return: float tensor of shape (2 * len(scales) * N, 3, patch_size, patch_size), view-major: the views of
+                 face i are at i, i + N, i + 2N, ... as expected by tta_aggregate
+        """
+        boxes = np.asarray(boxes, dtype=np.float64)[:, :4]
+        frame_idxs = np.asarray(frame_idxs, dtype=np.int64)
+        frame_shapes = np.array([frames[f].shape[:2] for f in frame_idxs], dtype=np.float64).reshape(-1, 2)
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        half_sides = (boxes[:, 2:] - boxes[:, :2]) / 2
+        views = []
+        for scale in scales:
+            view = np.concatenate((centers - half_sides * scale, centers + half_sides * scale), axis=1)
+            view[:, :2] = np.maximum(view[:, :2], 0)
+            view[:, 2:] = np.minimum(view[:, 2:], frame_shapes)
+            views.append(view)
+        batch = self.from_frames(frames, np.concatenate(views), np.tile(frame_idxs, len(scales)))
+        return torch.cat((batch, batch.flip(-1)))
+
+    def _normalize(self, batch: torch.Tensor) -> torch.Tensor:
+        """
+        :param batch: uint8 or float tensor of shape (N, patch_size, patch_size, 3), values in [0, 255]
+        :return: normalized float tensor of shape (N, 3, patch_size, patch_size)
+        """
+        batch = batch.to(self.device).permute(0, 3, 1, 2).float().contiguous()
+        return batch.sub_(self.mean).div_(self.std)
+
+    def _resize(self, faces: List[np.ndarray]) -> np.ndarray:
+        """
+        Pad and resize every face with OpenCV into a single uint8 batch
+        :param faces: list of uint8 arrays of shape (H, W, 3)
+        :return: uint8 array of shape (N, patch_size, patch_size, 3)
+        """
+        S = self.patch_size
+        batch = np.zeros((len(faces), S, S, 3), dtype=np.uint8)
+        for i, face in enumerate(faces):
+            h, w = face.shape[:2]
+            if self.face_policy == 'scale':
+                if h < S or w < S:
+                    top, left = max(S - h, 0) // 2, max(S - w, 0) // 2
+                    face = cv2.copyMakeBorder(face, top, max(S - h, 0) - top, left, max(S - w, 0) - left,
+                                              cv2.BORDER_CONSTANT, value=0)
+                cv2.resize(face, (S, S), dst=batch[i], interpolation=cv2.INTER_LINEAR)
+            else:
+                scale = S / max(h, w)
+                if scale != 1.0:
+                    h, w = int(round(h * scale)), int(round(w * scale))
+                    face = cv2.resize(face, (w, h), interpolation=cv2.INTER_LINEAR)
+                top, left = (S - h) // 2, (S - w) // 2
+                batch[i, top:top + h, left:left + w] = face
+        return batch
+
+    def _axis_coords(self, sizes: np.ndarray, longest: np.ndarray) -> (
+            np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        """
+        Bilinear source indices and weights along one axis, for all the faces at once.
+        Follows OpenCV INTER_LINEAR conventions (half-pixel centers, edge clamping).
+        :param sizes: (N,) face size along the axis
+        :param longest: (N,) longest side of each face, used by the "tight" policy
+        :return: four (N, patch_size) arrays: first and second source index, first and second weight.
+                 Weights are zero where the output pixel falls in the zero padding.
+        """
+        S = self.patch_size
+        r = np.arange(S, dtype=np.float64)[None, :]
+        n = sizes.astype(np.float64)[:, None]
+        if self.face_policy == 'scale':
+            # Pad to at least S, then resize the padded face to S
+            padded = np.maximum(n, S)
+            pad = np.floor((padded - n) / 2)
+            p = np.clip((r + 0.5) * padded / S - 0.5, 0, padded - 1)
+            p0 = np.floor(p)
+            a = p - p0
+            i0 = p0 - pad
+            i1 = np.minimum(p0 + 1, padded - 1) - pad
+            w0 = (1 - a) * ((i0 >= 0) & (i0 < n))
+            w1 = a * ((i1 >= 0) & (i1 < n))
+        else:
+            # Resize the longest side to S, then pad to S
+            resized = np.round(n * (S / longest.astype(np.float64)[:, None]))
+            pad = np.floor((S - resized) / 2)
+            q = r - pad
+            inside = (q >= 0) & (q < resized)
+            p = np.clip((q + 0.5) * n / resized - 0.5, 0, n - 1)
+            p0 = np.floor(p)
+            a = p - p0
+            i0 = p0
+            i1 = np.minimum(p0 + 1, n - 1)
+            w0 = (1 - a) * inside
+            w1 = a * inside
+        i0 = np.clip(i0, 0, n - 1).astype(np.int64)
+        i1 = np.clip(i1, 0, n - 1).astype(np.int64)
+        return i0, i1, w0.astype(np.float32), w1.astype(np.float32)
+
+    def _resample(self, pixels: torch.Tensor, offsets: np.ndarray, row_strides: np.ndarray,
+                  heights: np.ndarray, widths: np.ndarray) -> torch.Tensor:
+        """
+        Resample faces stored in a packed pixel buffer with a single bilinear gather
+        :param pixels: uint8 tensor of shape (num_pixels, 3)
+        :param offsets: (N,) index in pixels of the top-left corner of each face
+        :param row_strides: (N,) distance in pixels between two rows of each face
+        :param heights: (N,) face heights
+        :param widths: (N,) face widths
+        :return: float tensor of shape (N, patch_size, patch_size, 3), values in [0, 255]
+        """
+        longest = np.maximum(heights, widths)
+        y0, y1, wy0, wy1 = [torch.from_numpy(a).to(self.device) for a in self._axis_coords(heights, longest)]
+        x0, x1, wx0, wx1 = [torch.from_numpy(a).to(self.device) for a in self._axis_coords(widths, longest)]
+        offsets = torch.from_numpy(np.asarray(offsets, dtype=np.int64)).to(self.device)
+        row_strides = torch.from_numpy(np.asarray(row_strides, dtype=np.int64)).to(self.device)
+        pixels = pixels.to(self.device)
+
+        batch = []
+        for start in range(0, len(offsets), self.chunk_size):
+            sl = slice(start, start + self.chunk_size)
+            rows0 = (offsets[sl, None] + y0[sl] * row_strides[sl, None])[:, :, None]
+            rows1 = (offsets[sl, None] + y1[sl] * row_strides[sl, None])[:, :, None]
+            faces = 0
+            for rows, wy in ((rows0, wy0[sl]), (rows1, wy1[sl])):
+                for cols, wx in ((x0[sl], wx0[sl]), (x1[sl], wx1[sl])):
+                    weights = wy[:, :, None] * wx[:, None, :]
+                    faces = faces + pixels[rows + cols[:, None, :]].float() * weights[..., None]
+            # OpenCV returns uint8 after resizing
+            batch.append(faces.round_())
+        return torch.cat(batch)
+
+
+precision_dtypes = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+}
+
+
+@lru_cache(maxsize=None)
+def cpu_supports_bf16() -> bool:
+    """
+    Check whether the CPU provides native bfloat16 instructions (AVX-512 BF16 or AMX)
+    :return:
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
+    except OSError:
+        # Not on Linux, ask oneDNN instead
+        try:
+            return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+        except (AttributeError, RuntimeError):
+            return False
+
+
+def resolve_precision(precision: str, device: torch.device) -> str:
+    """
+    Validate the requested inference precision against the hardware, falling back to fp32 when unsupported
+    :param precision: "fp32" or "bf16"
+    :param device: device the models will run on
+    :return: the precision to actually use
+    """
+    if precision not in precision_dtypes:
+        raise ValueError('Unknown precision: {}'.format(precision))
+    if precision == 'bf16':
+        if device.type == 'cuda':
+            supported = torch.cuda.is_bf16_supported()
+        else:
+            supported = cpu_supports_bf16()
+        if not supported:
+            warnings.warn('bf16 not supported on {}, falling back to fp32'.format(device))
+            return 'fp32'
+    return precision
+
+
 def aggregate(x, deadzone: float, pre_mult: float, policy: str, post_mult: float, clipmargin: float, params={}):
     x = x.copy()
     if deadzone > 0:
@@ -245,3 +627,31 @@ def aggregate(x, deadzone: float, pre_mult: float, policy: str, post_mult: float
     else:
         raise NotImplementedError()
     return np.clip(x, clipmargin, 1 - clipmargin)
+
+
+def attention_heatmaps(att: torch.Tensor, patch_size: int) -> np.ndarray:
+    """
+    Attention maps upsampled to the face crops they were computed on
+    :param att: (N, 1, H, W) attention maps, as returned by forward_with_attention
+    :param patch_size: size of the face crops fed to the network
+    :return: (N, patch_size, patch_size) float32 array, values in [0, 1]
+    """
+    att = torch.nn.functional.interpolate(att.float(), size=(patch_size, patch_size), mode='bilinear',
+                                          align_corners=False)
+    return att[:, 0].cpu().numpy()
+
+
+def tta_aggregate(x: np.ndarray, num_faces: int, policy: str = 'mean') -> np.ndarray:
+    """
+    Aggregate the scores of the test-time augmentation views of each face
+    :param x: scores of the views (logits), view-major as returned by FaceBatchTransformer.from_frames_tta
+    :param num_faces: number of faces
+    :param policy: aggregate policy
+    :return: (num_faces,) scores of the faces, back to logits so that they can replace the scores of single crops
+    """
+    if num_faces == 0:
+        return np.zeros(0)
+    views = np.asarray(x).reshape(-1, num_faces)
+    return scipy.special.logit(np.array([
+        aggregate(views[:, face], deadzone=0, pre_mult=1, policy=policy, post_mult=1, clipmargin=1e-6)
+        for face in range(num_faces)], dtype=np.float64).reshape(num_faces))
@@ -0,0 +1,75 @@
+"""
+Models of the inference requests, loaded once per thread.
+
+video_pred and image_pred take the classifier and the face detector from here instead of building them on every
+call. Each thread keeps its own instances: the face detector and the last DEEPFAKE_MODEL_CACHE classifiers it used
+(2 by default, 0 disables the cache), so that the worker threads of service.py load a model once and never share it
+with another thread. The models of a thread are released when it exits.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from architectures import fornet, weights
+from blazeface import BlazeFace
+from isplutils import telemetry
+
+cache_size = int(os.environ.get('DEEPFAKE_MODEL_CACHE', 2))
+
+_local = threading.local()
+
+
+def _classifiers() -> OrderedDict:
+    cache = getattr(_local, 'classifiers', None)
+    if cache is None:
+        cache = _local.classifiers = OrderedDict()
+    return cache
+
+
+def classifier(model: str, dataset: str, device: torch.device, dtype: torch.dtype) -> torch.nn.Module:
+    """
+    Classifier with its trained weights, in eval mode
+    :param model: fornet architecture, e.g. 'EfficientNetAutoAttB4'
+    :param dataset: training dataset of the weights, e.g. 'DFDC'
+    :param device:
+    :param dtype: inference precision, see utils.precision_dtypes
+    """
+    cache = _classifiers()
+    key = (model, dataset, str(device), dtype)
+    if key in cache:
+        telemetry.count('cache_hits', cache='models')
+        cache.move_to_end(key)
+        return cache[key]
+    telemetry.count('cache_misses', cache='models')
+    with telemetry.span('model.load', model=model, dataset=dataset):
+        net = getattr(fornet, model)().eval().to(device)
+        net.load_state_dict(weights.load_state_dict('{:s}_{:s}'.format(model, dataset), map_location=device))
+        net = net.to(dtype)
+    if cache_size > 0:
+        cache[key] = net
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+    return net
+
+
+def face_detector(device: torch.device, dtype: torch.dtype) -> BlazeFace:
+    """
+    BlazeFace with its weights and anchors
+    :param device:
+    :param dtype: inference precision, see utils.precision_dtypes
+    """
+    detectors = getattr(_local, 'detectors', None)
+    if detectors is None:
+        detectors = _local.detectors = {}
+    key = (str(device), dtype)
+    if key in detectors:
+        return detectors[key]
+    facedet = BlazeFace().to(device)
+    facedet.load_weights("blazeface/blazeface.pth")
+    facedet.to(dtype)
+    facedet.load_anchors("blazeface/anchors.npy")
+    if cache_size > 0:
+        detectors[key] = facedet
+    return facedet
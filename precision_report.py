@@ -0,0 +1,128 @@
+"""
+Compare fp32 and bf16 inference on a set of labelled images and videos.
+
+For every precision the face detector and the classifier are loaded once, then each
+sample is scored and the detection and classification times are recorded separately.
+Scores are compared against the fp32 reference and, if both classes are present, the
+AUC and accuracy at the given threshold are reported.
+
+Example:
+    python precision_report.py --real real1.mp4 real2.jpg --fake fake1.mp4 --model EfficientNetB4
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from scipy.special import expit
+from sklearn.metrics import roc_auc_score
+
+import models
+from blazeface import FaceExtractor, VideoReader
+from isplutils import utils
+
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi'}
+
+
+def score_sample(path: str, net, face_extractor: FaceExtractor, transf, device: torch.device,
+                 dtype: torch.dtype) -> (float, float, float):
+    """
+    Score a single image or video
+    :return: fake probability, detection time [s], classification time [s]
+    """
+    t0 = time.perf_counter()
+    if os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS:
+        frames_data = face_extractor.process_video(path)
+        faces = [frame['faces'][0] for frame in frames_data if len(frame['faces'])]
+    else:
+        frame_data = face_extractor.process_image(img=Image.open(path).convert('RGB'))
+        faces = frame_data['faces'][:1]
+    t1 = time.perf_counter()
+    if len(faces) == 0:
+        return np.nan, t1 - t0, 0.
+
+    faces_t = transf(faces)
+    with torch.no_grad():
+        logits = net(faces_t.to(device, dtype)).float().cpu().numpy().flatten()
+    t2 = time.perf_counter()
+    return float(expit(logits.mean())), t1 - t0, t2 - t1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--real', nargs='*', default=[], help='Pristine images or videos')
+    parser.add_argument('--fake', nargs='*', default=[], help='Manipulated images or videos')
+    parser.add_argument('--model', default='EfficientNetAutoAttB4', choices=[
+        'EfficientNetB4', 'EfficientNetB4ST', 'EfficientNetAutoAttB4', 'EfficientNetAutoAttB4ST', 'Xception'])
+    parser.add_argument('--dataset', default='DFDC', choices=['DFDC', 'FFPP'])
+    parser.add_argument('--frames', type=int, default=32, help='Frames per video')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--precisions', nargs='+', default=['fp32', 'bf16'], choices=list(utils.precision_dtypes))
+    parser.add_argument('--out', help='Optional path of the JSON report')
+    args = parser.parse_args()
+
+    samples = [(path, 0) for path in args.real] + [(path, 1) for path in args.fake]
+    if len(samples) == 0:
+        parser.error('At least one sample must be provided with --real or --fake')
+    labels = np.array([label for _, label in samples])
+
+    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    videoreader = VideoReader(verbose=False)
+
+    report = {}
+    all_scores = {}
+    for requested in args.precisions:
+        precision = utils.resolve_precision(requested, device)
+        if precision in report:
+            # Requested precision fell back to one already measured
+            continue
+        dtype = utils.precision_dtypes[precision]
+        net = models.classifier(args.model, args.dataset, device, dtype)
+        facedet = models.face_detector(device, dtype)
+        transf = utils.FaceBatchTransformer('scale', 224, net.get_normalizer(), device=device)
+        face_extractor = FaceExtractor(video_read_fn=lambda x: videoreader.read_frames(x, num_frames=args.frames),
+                                       facedet=facedet)
+
+        # Warm-up run, excluded from timings
+        score_sample(samples[0][0], net, face_extractor, transf, device, dtype)
+
+        scores, det_times, cls_times = [], [], []
+        for path, _ in samples:
+            score, det_time, cls_time = score_sample(path, net, face_extractor, transf, device, dtype)
+            scores.append(score)
+            det_times.append(det_time)
+            cls_times.append(cls_time)
+        scores = np.array(scores)
+        valid = ~np.isnan(scores)
+
+        entry = {
+            'detection_ms': 1000 * float(np.mean(det_times)),
+            'classification_ms': 1000 * float(np.mean(cls_times)),
+            'accuracy': float(np.mean((scores[valid] > args.threshold) == labels[valid])) if valid.any() else None,
+        }
+        if len(np.unique(labels[valid])) == 2:
+            entry['auc'] = float(roc_auc_score(labels[valid], scores[valid]))
+        report[precision] = entry
+        all_scores[precision] = scores
+
+    if 'fp32' in all_scores:
+        reference = all_scores['fp32']
+        for precision, scores in all_scores.items():
+            both = ~np.isnan(scores) & ~np.isnan(reference)
+            if precision == 'fp32' or not both.any():
+                continue
+            report[precision]['max_abs_diff_vs_fp32'] = float(np.max(np.abs(scores[both] - reference[both])))
+            report[precision]['decision_agreement_vs_fp32'] = float(
+                np.mean((scores[both] > args.threshold) == (reference[both] > args.threshold)))
+
+    print(json.dumps(report, indent=2))
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
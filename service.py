@@ -0,0 +1,257 @@
+"""
+HTTP inference service around api.process_image and api.process_video.
+
+Requests go through a bounded queue to a pool of worker threads. Each worker loads its models once (see models.py):
+the default model when the worker starts, the others at their first request. A request is rejected with 429 when
+the queue is full, and with 503 when it waited in the queue longer than --queue_timeout, both with a Retry-After
+header. Once a worker has started a request, the request runs to completion.
+
+Endpoints:
+    POST /v1/image    multipart form: file (jpg, jpeg, png), optional model, dataset, threshold
+    POST /v1/video    multipart form: file (mp4), optional model, dataset, threshold, frames
+    GET  /healthz     workers, busy workers and queue depth
+    GET  /metrics     Prometheus text: the pipeline telemetry, the service counters and gauges
+A scored request returns {"label", "score", "queue_ms", "inference_ms"}, a request that cannot be scored (e.g. no
+face found) 422 with {"error"}. A request that does not fit the memory budget gets a 503 with Retry-After, any other
+failure (e.g. the weights cannot be downloaded) a 500.
+
+Example:
+    python service.py --workers 2 --queue 8 --port 8000
+    curl -F file=@video.mp4 -F frames=32 http://localhost:8000/v1/video
+Load test with benchmarks/service_load.py.
+"""
+import argparse
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Callable
+
+import torch
+from flask import Flask, jsonify, request
+from PIL import UnidentifiedImageError
+
+import api
+import models
+from architectures import weights
+from isplutils import telemetry, utils
+
+# Errors of requests that cannot be scored: no face found, no attention maps, a file that cannot be decoded
+CLIENT_ERRORS = (ValueError, UnidentifiedImageError)
+
+
+class Job:
+    """
+    Request waiting in the queue or run by a worker
+    """
+
+    def __init__(self, fn: Callable, kwargs: dict):
+        self.fn = fn
+        self.kwargs = kwargs
+        self.state = 'queued'
+        self.result = self.error = None
+        self.queue_time = self.run_time = None
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+
+class WorkerPool:
+    """
+    Worker threads running the jobs of a bounded queue
+    """
+
+    def __init__(self, workers: int, queue_size: int, warmup: Callable = None):
+        """
+        :param workers: number of worker threads
+        :param queue_size: jobs waiting for a worker beyond which submit() fails
+        :param warmup: optional function run by each worker before its first job, e.g. to load the models
+        """
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.busy = 0
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, args=(warmup,), name='inference-{:d}'.format(idx),
+                                         daemon=True) for idx in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self, warmup: Callable):
+        if warmup is not None:
+            try:
+                warmup()
+            except Exception as e:
+                print('Worker warmup failed: {}'.format(e))
+        while True:
+            job = self.queue.get()
+            with job.lock:
+                if job.state == 'cancelled':
+                    continue
+                job.state = 'running'
+            job.queue_time = time.perf_counter() - job.submitted
+            with self._lock:
+                self.busy += 1
+            try:
+                job.result = job.fn(**job.kwargs)
+            except Exception as e:
+                job.error = e
+                if not isinstance(e, CLIENT_ERRORS):
+                    traceback.print_exception(*sys.exc_info())
+            finally:
+                job.run_time = time.perf_counter() - job.submitted - job.queue_time
+                with self._lock:
+                    self.busy -= 1
+                job.state = 'done'
+                job.done.set()
+
+    def submit(self, fn: Callable, **kwargs) -> Job:
+        """
+        Queue a job
+        :raise queue.Full: if the queue is full
+        """
+        job = Job(fn, kwargs)
+        self.queue.put_nowait(job)
+        return job
+
+    def wait(self, job: Job, timeout: float) -> bool:
+        """
+        Wait for a job to complete. A job still queued after timeout is cancelled
+        :return: False if the job was cancelled
+        """
+        if job.done.wait(timeout):
+            return True
+        with job.lock:
+            if job.state == 'queued':
+                job.state = 'cancelled'
+                return False
+        job.done.wait()
+        return True
+
+    def status(self) -> dict:
+        return {'workers': sum(thread.is_alive() for thread in self.threads), 'busy': self.busy,
+                'queued': self.queue.qsize(), 'queue_size': self.queue.maxsize}
+
+
+def create_app(pool: WorkerPool, args: argparse.Namespace) -> Flask:
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = int(args.max_upload_mb * 2 ** 20)
+
+    def rejected(kind: str, status: int, message: str):
+        telemetry.count('service_responses', kind=kind, status=status)
+        response = jsonify({'error': message})
+        response.status_code = status
+        if status in (429, 503):
+            response.headers['Retry-After'] = str(args.retry_after)
+        return response
+
+    def predict(kind: str, extensions: set, fn: Callable, **kwargs):
+        upload = request.files.get('file')
+        if upload is None or not api.allowed_file(upload.filename, extensions):
+            return rejected(kind, 400, 'A file with one of the extensions {} is required'.format(sorted(extensions)))
+        model = request.form.get('model', args.model)
+        dataset = request.form.get('dataset', args.dataset)
+        if '{:s}_{:s}'.format(model, dataset) not in weights.weight_url:
+            return rejected(kind, 400, 'Unknown model {:s} trained on {:s}'.format(model, dataset))
+        try:
+            threshold = float(request.form.get('threshold', args.threshold))
+        except ValueError:
+            return rejected(kind, 400, 'threshold must be a number')
+
+        if kind == 'video':
+            # process_video deletes the file once done
+            fd, path = tempfile.mkstemp(suffix='.mp4', dir=args.upload_dir)
+            with os.fdopen(fd, 'wb') as f:
+                upload.save(f)
+            kwargs['video_path'] = path
+        else:
+            path = None
+            kwargs['image'] = upload.stream
+        try:
+            job = pool.submit(fn, model=model, dataset=dataset, threshold=threshold, raise_errors=True, **kwargs)
+        except queue.Full:
+            job = None
+        if job is None or not pool.wait(job, args.queue_timeout):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+            if job is None:
+                return rejected(kind, 429, 'Too many requests, {:d} already queued'.format(pool.queue.maxsize))
+            return rejected(kind, 503, 'No worker available within {:g}s'.format(args.queue_timeout))
+
+        if isinstance(job.error, CLIENT_ERRORS):
+            return rejected(kind, 422, str(job.error))
+        if isinstance(job.error, MemoryError):
+            return rejected(kind, 503, 'Not enough memory for the request: {}'.format(job.error))
+        if job.error is not None:
+            return rejected(kind, 500, 'Internal error: {}'.format(job.error))
+        label, score = job.result
+        telemetry.count('service_responses', kind=kind, status=200)
+        return jsonify({'label': label, 'score': float(score), 'queue_ms': 1e3 * job.queue_time,
+                        'inference_ms': 1e3 * job.run_time})
+
+    @app.route('/v1/image', methods=['POST'])
+    def image():
+        return predict('image', api.ALLOWED_IMAGE_EXTENSIONS, api.process_image)
+
+    @app.route('/v1/video', methods=['POST'])
+    def video():
+        try:
+            frames = int(request.form.get('frames', args.frames))
+        except ValueError:
+            return rejected('video', 400, 'frames must be an integer')
+        if frames < 1:
+            return rejected('video', 400, 'frames must be positive')
+        return predict('video', api.ALLOWED_VIDEO_EXTENSIONS, api.process_video, frames=frames)
+
+    @app.route('/healthz')
+    def healthz():
+        return jsonify(pool.status())
+
+    @app.route('/metrics')
+    def metrics():
+        lines = [telemetry.prometheus_text().rstrip('\n')]
+        for name, value in pool.status().items():
+            lines.append('# TYPE deepfake_service_{} gauge'.format(name))
+            lines.append('deepfake_service_{} {:d}'.format(name, value))
+        return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=2, help='Requests run in parallel')
+    parser.add_argument('--queue', type=int, default=8, help='Requests waiting for a worker, more get a 429')
+    parser.add_argument('--queue_timeout', type=float, default=30,
+                        help='Seconds a request may wait for a worker before a 503')
+    parser.add_argument('--retry_after', type=int, default=5, help='Retry-After of 429 and 503 responses [s]')
+    parser.add_argument('--torch_threads', type=int,
+                        help='Intra-op threads of torch, by default the CPUs split among the workers')
+    parser.add_argument('--model', default='EfficientNetAutoAttB4', help='Default model, loaded at startup')
+    parser.add_argument('--dataset', default='DFDC', help='Default training dataset')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--frames', type=int, default=32, help='Default frames per video')
+    parser.add_argument('--upload_dir', default='uploads')
+    parser.add_argument('--max_upload_mb', type=float, default=200)
+    args = parser.parse_args()
+
+    os.makedirs(args.upload_dir, exist_ok=True)
+    torch.set_num_threads(args.torch_threads or max(1, (os.cpu_count() or 1) // args.workers))
+    telemetry.enable(os.environ.get('DEEPFAKE_TELEMETRY_LOG'))
+
+    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    dtype = utils.precision_dtypes[utils.resolve_precision(api.PRECISION, device)]
+
+    def warmup():
+        models.classifier(args.model, args.dataset, device, dtype)
+        models.face_detector(device, dtype)
+
+    pool = WorkerPool(args.workers, args.queue, warmup)
+    create_app(pool, args).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Accuracy vs latency sweep over frames per video, models, face policies and aggregation policies.
+
+Each labelled video is decoded and searched for faces once, at the largest frame count of the sweep, and the logits
+of the best face of every frame are computed once per model and face policy. Detections, logits and stage timings
+are cached per video content, so that adding a model or a frame count to a later sweep only runs what is missing.
+Smaller frame counts are evaluated offline: the frames read at N frames per video are the evenly spaced indices
+VideoReader.read_frames would pick, matched to the nearest frame read at the largest count.
+
+The latency of a configuration is estimated per video from the timings of the single pass: decoding up to the last
+frame (VideoReader grabs every frame, a constant cost) plus, for each frame read, the frame conversion, face
+detection, face preprocessing and classification per-frame costs. Aggregation cost is negligible.
+The output lists AUC and milliseconds per video of every configuration and marks the Pareto front, the
+configurations that no other one beats on both.
+
+Example:
+    python sweep.py --real real/*.mp4 --fake fake/*.mp4 --models EfficientNetB4_DFDC EfficientNetAutoAttB4_DFDC \
+        --frames 10 20 30 50 100 --out sweep.json --plot sweep.png
+"""
+import argparse
+import json
+import os
+import time
+from typing import Dict, List
+
+import cv2
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+from tqdm import tqdm
+
+from blazeface import FaceExtractor, VideoReader
+from isplutils import utils
+from models import classifier, face_detector
+
+
+def read_frames_timed(reader: VideoReader, path: str, num_frames: int, timings: dict):
+    """
+    Same frames as VideoReader.read_frames, with the time spent grabbing (decoding) and retrieving (converting)
+    frames stored in timings
+    """
+    t0 = time.perf_counter()
+    capture = cv2.VideoCapture(path)
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    timings.update(frame_count=frame_count, grab_s=0., retrieve_s=0.)
+    if frame_count <= 0:
+        return None
+    frame_idxs = np.unique(np.linspace(0, frame_count - 1, num_frames, endpoint=True, dtype=np.int32))
+    frames, idxs_read = [], []
+    for frame_idx in range(frame_idxs[0], frame_idxs[-1] + 1):
+        if not capture.grab():
+            break
+        if frame_idx == frame_idxs[len(idxs_read)]:
+            t1 = time.perf_counter()
+            ret, frame = capture.retrieve()
+            if not ret or frame is None:
+                break
+            frames.append(reader._postprocess_frame(frame))
+            idxs_read.append(frame_idx)
+            timings['retrieve_s'] += time.perf_counter() - t1
+    capture.release()
+    # Opening the file and grabbing frames count as decoding
+    timings['grab_s'] = time.perf_counter() - t0 - timings['retrieve_s']
+    if len(frames) == 0:
+        return None
+    return np.stack(frames), idxs_read
+
+
+def subset_positions(frame_idxs: np.ndarray, frame_count: int, num_frames: int) -> np.ndarray:
+    """
+    Positions, among the frames read at the largest frame count, of the frames read at num_frames
+    :param frame_idxs: sorted indices of the frames read at the largest frame count
+    """
+    targets = np.unique(np.linspace(0, frame_count - 1, num_frames, endpoint=True, dtype=np.int32))
+    right = np.clip(np.searchsorted(frame_idxs, targets), 1, len(frame_idxs) - 1) if len(frame_idxs) > 1 else \
+        np.zeros(len(targets), dtype=np.int64)
+    left = np.maximum(right - 1, 0)
+    nearest = np.where(np.abs(frame_idxs[left] - targets) <= np.abs(frame_idxs[right] - targets), left, right)
+    return np.unique(nearest)
+
+
+class VideoCache:
+    """
+    Detections, logits and timings of the videos, one npz file per video and per (video, model, face policy)
+    """
+
+    def __init__(self, root: str, max_frames: int, size: int, precision: str):
+        self.root = root
+        self.max_frames = max_frames
+        self.size = size
+        self.precision = precision
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, path: str, *tags) -> str:
+        return os.path.join(self.root,
+                            '_'.join([utils.file_hash(path)[:16], str(self.max_frames)] + list(tags)) + '.npz')
+
+    def detections_path(self, path: str) -> str:
+        return self._path(path, 'det')
+
+    def logits_path(self, path: str, model: str, face: str) -> str:
+        return self._path(path, model, face, str(self.size), self.precision)
+
+    @staticmethod
+    def load(path: str) -> dict or None:
+        try:
+            with np.load(path) as data:
+                return dict(data)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def save(path: str, **arrays):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+
+def process_videos(paths: List[str], cache: VideoCache, models: List[str], faces: List[str], device: torch.device,
+                   dtype: torch.dtype) -> Dict[str, dict]:
+    """
+    Fill the cache for all the videos, models and face policies
+    :return: detection entry of each video read
+    """
+    reader = VideoReader(verbose=False)
+    timings = {}
+    facedet = face_detector(device, dtype)
+    extractor = FaceExtractor(video_read_fn=lambda x: read_frames_timed(reader, x, cache.max_frames, timings),
+                              facedet=facedet)
+    nets, transformers = {}, {}
+
+    entries = {}
+    for path in tqdm(paths):
+        detections = cache.load(cache.detections_path(path))
+        missing = [(model, face) for model in models for face in faces
+                   if cache.load(cache.logits_path(path, model, face)) is None]
+        if detections is not None and len(missing) == 0:
+            entries[path] = detections
+            continue
+
+        t0 = time.perf_counter()
+        result = extractor.process_video(path)
+        total_s = time.perf_counter() - t0
+        if len(result) == 0:
+            print('Cannot read {}'.format(path))
+            continue
+        frame_pos, best_detections = result.best_faces()
+        if detections is None:
+            detections = {
+                'frame_count': np.int64(timings['frame_count']),
+                'frame_idxs': result.frame_idxs.astype(np.int64),
+                'face_pos': frame_pos.astype(np.int64),
+                'boxes': best_detections[:, :4],
+                'grab_s': np.float64(timings['grab_s']),
+                'retrieve_s': np.float64(timings['retrieve_s']),
+                'detect_s': np.float64(total_s - timings['grab_s'] - timings['retrieve_s']),
+            }
+            cache.save(cache.detections_path(path), **detections)
+        entries[path] = detections
+
+        for model, face in missing:
+            if model not in nets:
+                # Registered weights, '<model>_<dataset>'
+                nets[model] = classifier(*model.rsplit('_', 1), device, dtype)
+            if (model, face) not in transformers:
+                transformers[(model, face)] = utils.FaceBatchTransformer(face, cache.size, nets[model].get_normalizer(),
+                                                                         device=device)
+            t0 = time.perf_counter()
+            faces_t = transformers[(model, face)].from_frames(result.frames, detections['boxes'],
+                                                              detections['face_pos'])
+            t1 = time.perf_counter()
+            with torch.no_grad():
+                logits = nets[model](faces_t.to(device, dtype)).float().cpu().numpy().flatten() if len(faces_t) else \
+                    np.zeros(0, dtype=np.float32)
+            t2 = time.perf_counter()
+            cache.save(cache.logits_path(path, model, face), logits=logits, preprocess_s=np.float64(t1 - t0),
+                       classify_s=np.float64(t2 - t1))
+    return entries
+
+
+def video_score(logits: np.ndarray, policy: str) -> float:
+    """
+    Fake probability of a video from the logits of its faces, 0.5 if no face was found
+    """
+    if len(logits) == 0:
+        return 0.5
+    return float(utils.aggregate(logits, deadzone=0, pre_mult=1, policy=policy, post_mult=1, clipmargin=1e-6))
+
+
+def evaluate(samples: List[tuple], entries: Dict[str, dict], cache: VideoCache, models: List[str], faces: List[str],
+             policies: List[str], frame_counts: List[int]) -> List[dict]:
+    """
+    AUC and estimated latency of every configuration
+    """
+    samples = [(path, label) for path, label in samples if path in entries]
+    labels = np.array([label for _, label in samples])
+    points = []
+    for model in models:
+        for face in faces:
+            logits_entries = [cache.load(cache.logits_path(path, model, face)) for path, _ in samples]
+            for num_frames in frame_counts:
+                video_logits, latencies, no_face = [], [], 0
+                for (path, _), logits_entry in zip(samples, logits_entries):
+                    det = entries[path]
+                    num_read = len(det['frame_idxs'])
+                    positions = subset_positions(det['frame_idxs'], int(det['frame_count']), num_frames)
+                    selected = np.isin(det['face_pos'], positions)
+                    video_logits.append(logits_entry['logits'][selected])
+                    no_face += int(selected.sum() == 0)
+                    num_faces = max(len(det['face_pos']), 1)
+                    per_frame_s = (det['retrieve_s'] + det['detect_s']) / num_read
+                    per_face_s = (logits_entry['preprocess_s'] + logits_entry['classify_s']) / num_faces
+                    latencies.append(det['grab_s'] + len(positions) * per_frame_s + selected.sum() * per_face_s)
+                for policy in policies:
+                    scores = np.array([video_score(logits, policy) for logits in video_logits])
+                    auc = float(roc_auc_score(labels, scores)) if len(np.unique(labels)) == 2 else float('nan')
+                    points.append({'model': model, 'face': face, 'policy': policy, 'frames': num_frames,
+                                   'auc': auc, 'ms_per_video': 1e3 * float(np.mean(latencies)),
+                                   'videos_without_faces': no_face})
+    return points
+
+
+def mark_pareto(points: List[dict]):
+    """
+    Set 'pareto' on each point: True if no other point has higher AUC and lower latency
+    """
+    best_auc = -np.inf
+    for point in sorted(points, key=lambda p: (p['ms_per_video'], -p['auc'])):
+        point['pareto'] = bool(point['auc'] > best_auc)
+        if point['pareto']:
+            best_auc = point['auc']
+
+
+def plot(points: List[dict], path: str):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(9, 6))
+    for model in sorted({p['model'] for p in points}):
+        for face in sorted({p['face'] for p in points}):
+            group = [p for p in points if p['model'] == model and p['face'] == face]
+            ax.scatter([p['ms_per_video'] for p in group], [p['auc'] for p in group], s=12, alpha=0.6,
+                       label='{} {}'.format(model, face))
+    front = sorted([p for p in points if p['pareto']], key=lambda p: p['ms_per_video'])
+    ax.plot([p['ms_per_video'] for p in front], [p['auc'] for p in front], 'k-', drawstyle='steps-post',
+            label='Pareto front')
+    for p in front:
+        ax.annotate('{:d}f {}'.format(p['frames'], p['policy']), (p['ms_per_video'], p['auc']), fontsize=7,
+                    xytext=(3, -9), textcoords='offset points')
+    ax.set_xlabel('ms per video')
+    ax.set_ylabel('AUC')
+    ax.grid(alpha=0.3)
+    ax.legend(fontsize=8)
+    fig.tight_layout()
+    fig.savefig(path, dpi=150)
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--real', nargs='*', default=[], help='Pristine videos')
+    parser.add_argument('--fake', nargs='*', default=[], help='Manipulated videos')
+    parser.add_argument('--models', nargs='+', default=['EfficientNetAutoAttB4_DFDC'],
+                        help='Registered weights, <model>_<dataset>')
+    parser.add_argument('--faces', nargs='+', default=['scale'], choices=['scale', 'tight'])
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--frames', type=int, nargs='+', default=[10, 20, 30, 50, 100], help='Frames per video')
+    parser.add_argument('--policies', nargs='+', default=['mean', 'sigmean', 'median', 'maxabs', 'avgvoting'],
+                        help='utils.aggregate policies')
+    parser.add_argument('--precision', default='fp32', choices=list(utils.precision_dtypes))
+    parser.add_argument('--cache', default='sweepcache', help='Folder of the cached detections and logits')
+    parser.add_argument('--out', help='Optional path of the JSON report')
+    parser.add_argument('--plot', help='Optional path of the AUC vs latency plot')
+    args = parser.parse_args()
+
+    samples = [(path, 0) for path in args.real] + [(path, 1) for path in args.fake]
+    if len(samples) == 0:
+        parser.error('At least one video must be provided with --real or --fake')
+
+    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    precision = utils.resolve_precision(args.precision, device)
+    frame_counts = sorted(set(args.frames))
+    cache = VideoCache(args.cache, max(frame_counts), args.size, precision)
+
+    entries = process_videos([path for path, _ in samples], cache, args.models, args.faces, device,
+                             utils.precision_dtypes[precision])
+    points = evaluate(samples, entries, cache, args.models, args.faces, args.policies, frame_counts)
+    mark_pareto(points)
+
+    print('{:34s} {:6s} {:10s} {:>6s} {:>8s} {:>12s}'.format('model', 'face', 'policy', 'frames', 'AUC',
+                                                            'ms/video'))
+    for p in sorted([p for p in points if p['pareto']], key=lambda p: p['ms_per_video']):
+        print('{model:34s} {face:6s} {policy:10s} {frames:6d} {auc:8.4f} {ms_per_video:12.1f}'.format(**p))
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'videos': len(entries), 'precision': precision, 'device': str(device), 'points': points}, f,
+                      indent=2)
+    if args.plot is not None:
+        plot(points, args.plot)
+
+
+if __name__ == '__main__':
+    main()
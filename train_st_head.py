@@ -0,0 +1,223 @@
+"""
+Train the head of a SiameseTuning network (EfficientNetB4ST, EfficientNetAutoAttB4ST, XceptionST) on precomputed
+backbone features.
+
+With lastonly=True only the BatchNorm1d + Linear head of these networks is trained, so the backbone features of
+each face never change. They are extracted once into a memory-mapped FeatureStore per faces root folder, keyed by
+network and initial weights, and the head is then trained and validated on the stored features only. Features are
+extracted from the faces with the test transformer, without the training augmentations.
+Extraction resumes from the faces not stored yet. The full network, with the trained head, is saved at the lowest
+validation loss and can be loaded like the released weights.
+
+Example:
+    python train_st_head.py --net EfficientNetAutoAttB4ST --init EfficientNetAutoAttB4ST_FFPP \
+        --ffpp_faces_df_path ffpp_faces.pkl --ffpp_faces_dir faces/ffpp \
+        --traindb ff-c23-720-140-140 --valdb ff-c23-720-140-140
+"""
+import argparse
+import os
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.metrics import roc_auc_score
+from torch import nn
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from architectures import fornet, weights
+from isplutils import utils
+from isplutils.data import FrameFaceDatasetTest, FrameGroupedBatchSampler, RealFakeSampler
+from isplutils.face_store import open_face_store
+from isplutils.feature_store import FeatureStore, feature_store_path
+from isplutils.split import available_datasets, load_df, make_splits
+
+st_models = ['EfficientNetB4ST', 'EfficientNetAutoAttB4ST', 'XceptionST']
+
+
+def load_weights(net: nn.Module, net_name: str, init: str) -> str:
+    """
+    Load the initial weights of the network
+    :param net: network
+    :param net_name: network class name
+    :param init: key of architectures.weights.weight_url or path to a state dict, None for ImageNet weights
+    :return: tag identifying the backbone, for the feature store path
+    """
+    if init is None:
+        return '{}_imagenet'.format(net_name)
+    if init in weights.weight_url:
+        net.load_state_dict(weights.load_state_dict(init, map_location='cpu'))
+        return init
+    state = torch.load(init, map_location='cpu')
+    net.load_state_dict(state['net'] if 'net' in state else state)
+    return '{}_{}'.format(net_name, utils.file_hash(init)[:12])
+
+
+def extract_features(net: fornet.SiameseTuning, store: FeatureStore, df: pd.DataFrame, root: str, scale: str,
+                     size: int, batch_size: int, workers: int, device: torch.device, dtype: torch.dtype):
+    """
+    Extract and store the backbone features of the faces of df that are not in the store yet
+    """
+    slots = store.slots(df.index)
+    if (slots < 0).any():
+        raise ValueError('{:d} records are not in the feature store'.format((slots < 0).sum()))
+    pending = np.flatnonzero(~store.filled[slots])
+    print('Features to extract: {:d}/{:d}'.format(len(pending), len(df)))
+    if len(pending) == 0:
+        return
+    pending_df = df.iloc[pending]
+    transformer = utils.get_transformer(scale, size, net.get_normalizer(), train=False)
+    # Full-size decoding and autocache: the features must come from the crops the backbone sees at inference
+    dataset = FrameFaceDatasetTest(root=root, df=pending_df, size=size, scale=scale, transformer=transformer,
+                                   face_store=open_face_store(root, scale, size), draft=False)
+    batches = list(FrameGroupedBatchSampler(pending_df, batch_size))
+    loader = DataLoader(dataset, batch_sampler=batches, num_workers=workers)
+    with torch.no_grad():
+        for batch, (faces, _) in zip(tqdm(batches), loader):
+            features = net.features(faces.to(device, dtype)).float().cpu().numpy()
+            store.put(slots[pending[batch]], features)
+    store.flush()
+
+
+def load_split(stores: Dict[str, FeatureStore], split: Dict[str, Tuple[pd.DataFrame, str]]) -> (
+        torch.Tensor, torch.Tensor):
+    """
+    Stored features and labels of the records of a split, over all its datasets
+    """
+    features, labels = [], []
+    for df, root in split.values():
+        features.append(stores[root].get(stores[root].slots(df.index)))
+        labels.append(df['label'].values.astype(np.float32))
+    return torch.from_numpy(np.concatenate(features)), torch.from_numpy(np.concatenate(labels))
+
+
+def evaluate(head: nn.Module, features: torch.Tensor, labels: torch.Tensor, batch_size: int,
+             device: torch.device) -> (float, float):
+    """
+    :return: validation loss, ROC AUC
+    """
+    head.eval()
+    with torch.no_grad():
+        logits = torch.cat([head(features[start:start + batch_size].to(device)).cpu()
+                            for start in range(0, len(features), batch_size)]).flatten()
+    loss = nn.functional.binary_cross_entropy_with_logits(logits, labels).item()
+    auc = roc_auc_score(labels.numpy(), logits.numpy()) if 0 < labels.sum() < len(labels) else float('nan')
+    return loss, auc
+
+
+def train_head(head: nn.Module, train: Tuple[torch.Tensor, torch.Tensor], val: Tuple[torch.Tensor, torch.Tensor],
+               epochs: int, num_samples: int, batch_size: int, lr: float, seed: int, device: torch.device) -> List[
+    dict]:
+    """
+    Train the head on balanced real/fake batches of stored features, keep the weights with the lowest validation loss
+    :return: per-epoch log
+    """
+    train_features, train_labels = train
+    sampler = RealFakeSampler(real_positions=np.flatnonzero(train_labels.numpy() == 0),
+                              fake_positions=np.flatnonzero(train_labels.numpy() == 1), seed=seed, rank=0,
+                              world_size=1)
+    if num_samples <= 0:
+        num_samples = max(len(sampler.real_positions), len(sampler.fake_positions)) * 2
+    optimizer = torch.optim.Adam(head.parameters(), lr=lr)
+    criterion = nn.BCEWithLogitsLoss()
+    best_loss, best_state, log = np.inf, None, []
+    for epoch in range(epochs):
+        t0 = time.perf_counter()
+        sampler.set_epoch(epoch)
+        fake_positions, real_positions = sampler.sample(num_samples)
+        order = torch.from_numpy(np.stack((fake_positions, real_positions), axis=1).ravel().astype(np.int64))
+        head.train()
+        train_loss = 0.
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            optimizer.zero_grad()
+            loss = criterion(head(train_features[batch].to(device)).flatten(), train_labels[batch].to(device))
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item() * len(batch)
+        val_loss, val_auc = evaluate(head, *val, batch_size, device)
+        log.append({'epoch': epoch, 'train_loss': train_loss / max(len(order), 1), 'val_loss': val_loss,
+                    'val_auc': val_auc, 'time': time.perf_counter() - t0})
+        print('Epoch {epoch:3d} train loss {train_loss:.4f} val loss {val_loss:.4f} val AUC {val_auc:.4f} '
+              '{time:.1f}s'.format(**log[-1]))
+        if val_loss < best_loss:
+            best_loss = val_loss
+            best_state = {key: value.clone() for key, value in head.state_dict().items()}
+    if best_state is not None:
+        head.load_state_dict(best_state)
+    return log
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--net', type=str, required=True, choices=st_models)
+    parser.add_argument('--init', type=str, help='Initial weights: key of architectures.weights.weight_url or '
+                                                 'path to a state dict. ImageNet backbone by default')
+    parser.add_argument('--dfdc_faces_df_path', type=str, help='Path to the Pandas Dataframe obtained from extract_faces.py on the DFDC dataset.')
+    parser.add_argument('--dfdc_faces_dir', type=str, help='Path to the directory containing the faces extracted from the DFDC dataset.')
+    parser.add_argument('--ffpp_faces_df_path', type=str, help='Path to the Pandas Dataframe obtained from extract_faces.py on the FF++ dataset.')
+    parser.add_argument('--ffpp_faces_dir', type=str, help='Path to the directory containing the faces extracted from the FF++ dataset.')
+    parser.add_argument('--traindb', type=str, nargs='+', required=True, choices=available_datasets)
+    parser.add_argument('--valdb', type=str, nargs='+', required=True, choices=available_datasets)
+    parser.add_argument('--face', type=str, default='scale', choices=['scale', 'tight'])
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--feature_dtype', type=str, default='float16', choices=['float16', 'float32'])
+    parser.add_argument('--extract_batch', type=int, default=32, help='Faces per backbone forward pass')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--precision', type=str, default='fp32', choices=list(utils.precision_dtypes),
+                        help='Backbone precision for feature extraction')
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--samples', type=int, default=-1, help='Training samples per epoch, all by default')
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', type=int, default=0)
+    parser.add_argument('--models_dir', type=str, default='weights/st_head')
+    args = parser.parse_args()
+
+    device = torch.device('cuda:{:d}'.format(args.device)) if torch.cuda.is_available() else torch.device('cpu')
+    precision = utils.resolve_precision(args.precision, device)
+    dtype = utils.precision_dtypes[precision]
+    torch.manual_seed(args.seed)
+
+    net = getattr(fornet, args.net)()
+    tag = load_weights(net, args.net, args.init)
+    net = net.eval().to(device)
+
+    splits = make_splits(args.dfdc_faces_df_path, args.ffpp_faces_df_path, args.dfdc_faces_dir,
+                         args.ffpp_faces_dir, {'train': args.traindb, 'val': args.valdb})
+
+    # One store per faces root, over its full DataFrame, so that it serves every split
+    t0 = time.perf_counter()
+    stores = {}
+    num_feat = net.classifier[0].num_features
+    net.to(dtype)
+    for split in splits.values():
+        for dataset, (df, root) in split.items():
+            if root not in stores:
+                full_df, _ = load_df(args.dfdc_faces_df_path, args.ffpp_faces_df_path, args.dfdc_faces_dir,
+                                     args.ffpp_faces_dir, dataset)
+                stores[root] = FeatureStore.create(feature_store_path(root, tag, args.face, args.size),
+                                                   full_df.index, num_feat, dtype=args.feature_dtype)
+            print('{} {}'.format(dataset, root))
+            extract_features(net, stores[root], df, root, args.face, args.size, args.extract_batch, args.workers,
+                             device, dtype)
+    net.float()
+    print('Feature extraction: {:.1f}s'.format(time.perf_counter() - t0))
+
+    train = load_split(stores, splits['train'])
+    val = load_split(stores, splits['val'])
+    print('Training samples: {:d} Validation samples: {:d}'.format(len(train[0]), len(val[0])))
+    train_head(net.classifier, train, val, epochs=args.epochs, num_samples=args.samples, batch_size=args.batch,
+               lr=args.lr, seed=args.seed, device=device)
+
+    os.makedirs(args.models_dir, exist_ok=True)
+    out_path = os.path.join(args.models_dir, '{}_{}_bestval.pth'.format(args.net, '-'.join(args.traindb)))
+    torch.save(net.state_dict(), out_path)
+    print('Saved {}'.format(out_path))
+
+
+if __name__ == '__main__':
+    main()
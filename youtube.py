@@ -1,16 +1,17 @@
+import numpy as np
 import torch
-from torch.utils.model_zoo import load_url
 from scipy.special import expit
 
 import sys
 sys.path.append('..')
 
-from blazeface import FaceExtractor, BlazeFace , VideoReader
+from blazeface import FaceExtractor, VideoReader
 # from blazeface import FaceExtractor, BlazeFace, VideoReader
-from architectures import fornet,weights
-from isplutils import utils
+import models
+from isplutils import memory, profiling, telemetry, utils
 
-def video_pred(threshold=0.5,model='EfficientNetAutoAttB4',dataset='DFDC',frames=100,video_path="notebook/samples/mqzvfufzoq.mp4"):
+@profiling.profiled('video', path_arg='video_path', params=('model', 'dataset', 'frames', 'precision', 'tta'))
+def video_pred(threshold=0.5,model='EfficientNetAutoAttB4',dataset='DFDC',frames=100,video_path="notebook/samples/mqzvfufzoq.mp4",precision='fp32',tta=False,tta_policy='mean',return_attention=False):
     
     """
     Choose an architecture between
@@ -19,6 +20,7 @@ def video_pred(threshold=0.5,model='EfficientNetAutoAttB4',dataset='DFDC',frames
     - EfficientNetAutoAttB4
     - EfficientNetAutoAttB4ST
     - Xception
+    - EfficientNetB0 (students trained with distill.py, registered in weights/registry.json)
     """
     net_model = model
 
@@ -29,39 +31,114 @@ def video_pred(threshold=0.5,model='EfficientNetAutoAttB4',dataset='DFDC',frames
     """
     train_db = dataset
 
+    """
+    Choose an inference precision between
+    - fp32
+    - bf16 (falls back to fp32 if the hardware does not support it)
+    """
+
+    """
+    Test-time augmentation: with tta=True each face is also classified flipped and slightly rescaled, all the views
+    in the same batch, and the scores of each face are aggregated with tta_policy (one of the utils.aggregate policies)
+    """
+
+    """
+    Memory: the frames are decoded and searched for faces in chunks, or fewer frames are read, if the request would
+    not fit the memory budget (DEEPFAKE_MEMORY_BUDGET_MB, or the memory available to the container, see
+    isplutils/memory.py), shared with the requests running concurrently
+    """
+
+    """
+    Profiling: with profile=True (or DEEPFAKE_PROFILE=1) the call is run under torch.profiler and a sampling profiler,
+    the traces are written to DEEPFAKE_PROFILE_DIR (see isplutils/profiling.py)
+    """
+
+    """
+    Attention: with return_attention=True the attention maps of the faces are returned as a third value, a
+    (num_faces, face_size, face_size) array of heatmaps aligned with the face crops, computed in the same forward
+    pass as the scores. Only models with attention (EfficientNetAutoAttB4, EfficientNetAutoAttB4ST) provide them
+    """
+
     # setting the parameters
     device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
     face_policy = 'scale'
     face_size = 224
     frames_per_video = frames
+    precision = utils.resolve_precision(precision, device)
+    dtype = utils.precision_dtypes[precision]
 
     # loading the weights
-    model_url = weights.weight_url['{:s}_{:s}'.format(net_model,train_db)]
-    net = getattr(fornet,net_model)().eval().to(device)
-    net.load_state_dict(load_url(model_url,map_location=device,check_hash=True))
+    net = models.classifier(net_model, train_db, device, dtype)
+    if return_attention and not net.supports_attention:
+        raise ValueError('{:s} does not provide attention maps'.format(net_model))
 
-    transf = utils.get_transformer(face_policy, face_size, net.get_normalizer(), train=False)
+    transf = utils.FaceBatchTransformer(face_policy, face_size, net.get_normalizer(), device=device)
 
-    facedet = BlazeFace().to(device)
-    facedet.load_weights("blazeface/blazeface.pth")
-    facedet.load_anchors("blazeface/anchors.npy")
+    facedet = models.face_detector(device, dtype)
     videoreader = VideoReader(verbose=False)
-    video_read_fn = lambda x: videoreader.read_frames(x, num_frames=frames_per_video)
-    face_extractor = FaceExtractor(video_read_fn=video_read_fn,facedet=facedet)
+    face_extractor = FaceExtractor(facedet=facedet)
 
-    vid_fake_faces = face_extractor.process_video(video_path)
+    # Fit the request in the memory budget: probe the video, then decode and search for faces in chunks of frames,
+    # or read fewer frames, if all the frames at once would not fit
+    height, width, video_frames = utils.extract_meta_cv(video_path)
+    num_h, num_v = face_extractor.get_tiles_params(height, width)[:2]
+    views = 2 * len(utils.tta_scales) if tta else 1
+    with memory.reserve_video(height, width, video_frames, frames_per_video, num_h * num_v, face_size, views,
+                              net_model) as plan, telemetry.span('video.chunks', plan=repr(plan)) as span:
+        if plan.reduced:
+            print('Reading {:d} frames instead of {:d} to fit the memory budget'.format(plan.frames, frames_per_video))
+        faces_fake_pred = []
+        faces_fake_att = []
+        with memory.PeakTracker() as tracker:
+            for frames_chunk, frame_idxs in videoreader.iter_frames(video_path, plan.frames, plan.chunk_size):
+                tracker.add('frames', frames_chunk)
+                vid_fake_faces = face_extractor.process_frames(frames_chunk, frame_idxs)
 
-    # print(vid_fake_faces)
-    faces_fake_t = torch.stack( [ transf(image=frame['faces'][0])['image'] for frame in vid_fake_faces if len(frame['faces'])] )
-    with torch.no_grad():
-        faces_fake_pred = net(faces_fake_t.to(device)).cpu().numpy().flatten()
+                # Best face of each frame, cropped and resized straight from the frames
+                frame_pos, best_detections = vid_fake_faces.best_faces()
+                if len(best_detections) == 0:
+                    continue
+                if tta:
+                    faces_fake_t = transf.from_frames_tta(vid_fake_faces.frames, best_detections[:, :4], frame_pos)
+                else:
+                    faces_fake_t = transf.from_frames(vid_fake_faces.frames, best_detections[:, :4], frame_pos)
+                tracker.add('faces', faces_fake_t)
+                del vid_fake_faces, frames_chunk
+                with torch.no_grad():
+                    # Logits are cast back to fp32 before the sigmoid
+                    chunk_pred, chunk_att = [], []
+                    for start in range(0, len(faces_fake_t), plan.classifier_batch):
+                        batch = faces_fake_t[start:start + plan.classifier_batch].to(device, dtype)
+                        if return_attention:
+                            batch_pred, batch_att = net.forward_with_attention(batch)
+                            chunk_att.append(batch_att)
+                        else:
+                            batch_pred = net(batch)
+                        chunk_pred.append(batch_pred.float().cpu().numpy().flatten())
+                    chunk_pred = np.concatenate(chunk_pred)
+                if tta:
+                    chunk_pred = utils.tta_aggregate(chunk_pred, len(best_detections), tta_policy)
+                if return_attention:
+                    # With TTA the first views are the original crops
+                    faces_fake_att.append(utils.attention_heatmaps(torch.cat(chunk_att)[:len(best_detections)],
+                                                                   face_size))
+                faces_fake_pred.append(chunk_pred)
+        span.set(**tracker.report())
+    if len(faces_fake_pred) == 0:
+        raise ValueError('No face found in the video')
+    faces_fake_pred = np.concatenate(faces_fake_pred)
+    if return_attention:
+        faces_fake_att = np.concatenate(faces_fake_att)
  
     print(expit(faces_fake_pred))
     print(faces_fake_pred)
     print(expit(faces_fake_pred.mean()))
     if faces_fake_pred.mean()> threshold:
-        return 'fake',expit(faces_fake_pred.mean())
+        result = 'fake',expit(faces_fake_pred.mean())
     else:
-        return 'real',expit(faces_fake_pred.mean())
+        result = 'real',expit(faces_fake_pred.mean())
+    if return_attention:
+        return result + (faces_fake_att,)
+    return result
     
 # print(preprocess())
\ No newline at end of file